@@ -116,6 +116,10 @@
             # pollute the user's checkout.
             echo "VERSION = \"${version}\"" > hexagon/_version.py
 
+            # Compile the policy template to plain Python ahead of time, so
+            # `hexagon policy` in dom0 neither imports nor runs Jinja2.
+            python3 -m hexagon.policy_compiler hexagon/_policy_compiled.py
+
             # PEP 517 sdist; --no-isolation uses the env's setuptools (offline).
             python3 -m build --sdist --no-isolation
 
@@ -176,10 +180,11 @@
             pkgs.python313.pkgs.pyyaml
           ];
 
-          # Bake the version string for runtime introspection (same as the RPM
-          # build does in its buildPhase).
+          # Bake the version string for runtime introspection, and the compiled
+          # policy renderer (same as the RPM build does in its buildPhase).
           preConfigure = ''
             echo "VERSION = \"${version}\"" > hexagon/_version.py
+            python3 -m hexagon.policy_compiler hexagon/_policy_compiled.py
           '';
 
           # Tests need a live Qubes Admin API; run them via `just test`.
@@ -0,0 +1,189 @@
+"""Memory-budgeted admission control for bulk VM starts.
+
+Starting dozens of qubes at once asks qmemman for more memory than the host
+has, and the starts that lose the race fail with out-of-memory. A
+``MemoryBudget`` tracks how much of the budget admitted starts have taken and
+admits a start only once its ``memory`` (the initial allocation the VM needs
+to boot, capped by a lower ``maxmem``) fits what's left; the rest block on a
+condition variable and are admitted as earlier starts fail and hand their
+reservation back, or as halts free memory.
+
+A start that still doesn't fit once nothing else is in flight can never be
+admitted (nothing will free memory), so it fails with ``MemoryExhausted``
+instead of waiting forever. The one exception is a VM bigger than the whole
+budget: it's let through on its own, with a warning, so an estimate that's a
+little low can slow a bulk start down but never make a VM unstartable.
+
+The host budget is Xen's free memory (``xl info``), which already excludes
+Xen's own reservation and every domain's allocation -- dom0 and device-model
+stubdomains included -- plus what qmemman can reclaim by ballooning running
+VMs that balance memory back down to their initial size (their allocation in
+``xl list`` over their ``memory``). ``xl`` only works in dom0; from a
+management AppVM pass an explicit budget (``--memory-budget``) instead.
+"""
+
+import contextlib
+import logging
+import subprocess
+import threading
+
+
+def _xl(*args):
+    try:
+        return subprocess.check_output(
+            ["sudo", "-n", "xl"] + list(args), stderr=subprocess.DEVNULL, text=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def xl_free_memory():
+    """Host memory in MiB no domain (nor Xen) holds, from ``xl info``, or None
+    outside dom0."""
+    out = _xl("info")
+    for line in (out or "").splitlines():
+        key, _sep, value = line.partition(":")
+        if key.strip() == "free_memory":
+            return int(value.strip())
+    return None
+
+
+def xl_allocations():
+    """``{domain name: MiB}`` currently allocated, from ``xl list``, or None
+    outside dom0."""
+    out = _xl("list")
+    if out is None:
+        return None
+    allocations = {}
+    for line in out.splitlines()[1:]:
+        fields = line.split()
+        if len(fields) >= 3 and fields[2].isdigit():
+            allocations[fields[0]] = int(fields[2])
+    return allocations
+
+
+def vm_memory(record):
+    """A VM's initial memory in MiB, from its snapshot record (0 if unknown).
+
+    Xen never gives a domain more than its ``maxmem``, so a nonzero ``maxmem``
+    below ``memory`` is what it boots with.
+    """
+    try:
+        memory = int(record.properties.get("memory", 0))
+        maxmem = int(record.properties.get("maxmem") or 0)
+    except (TypeError, ValueError):
+        return 0
+    return min(memory, maxmem) if maxmem > 0 else memory
+
+
+def _balances(record):
+    try:
+        return int(record.properties.get("maxmem") or 0) > 0
+    except (TypeError, ValueError):
+        return False
+
+
+def host_budget(snapshot, free_memory=None, allocations=None):
+    """Estimate MiB available for new domains; None if the host's free memory
+    is unknown.
+
+    Loads properties for every running domain in ``snapshot``, to find which
+    balance memory and what they booted with.
+
+    :param free_memory: MiB Xen has free [default: from ``xl info``].
+    :param allocations: ``{domain: MiB}`` allocated [default: from ``xl list``].
+    """
+    if free_memory is None:
+        free_memory = xl_free_memory()
+    if free_memory is None:
+        return None
+    if allocations is None:
+        allocations = xl_allocations() or {}
+    running = [r for r in snapshot if r.is_running() and r.name != "dom0"]
+    snapshot.load(running, properties=True)
+    reclaimable = sum(
+        max(0, allocations.get(r.name, 0) - vm_memory(r)) for r in running if _balances(r)
+    )
+    return free_memory + reclaimable
+
+
+class MemoryExhausted(Exception):
+    """A start doesn't fit the memory budget, and nothing in flight can free any."""
+
+
+class MemoryBudget(object):
+    """Admit VM starts while their combined ``memory`` fits the budget.
+
+    :param available: MiB available for new domains.
+    :param demands: ``{name: MiB}`` each VM needs to start.
+    """
+
+    def __init__(self, available, demands):
+        self.budget = available
+        self.used = 0
+        self.demands = dict(demands)
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def __repr__(self):
+        return "<MemoryBudget: {} of {} MiB used, {} in flight>".format(
+            self.used, self.budget, self.in_flight
+        )
+
+    @property
+    def available(self):
+        return self.budget - self.used
+
+    def _fits(self, need):
+        return self.used + need <= self.budget
+
+    @contextlib.contextmanager
+    def admit(self, name):
+        """Block until ``name`` fits, hold its reservation for the body.
+
+        The reservation is kept if the body succeeds (the VM is now running
+        and using the memory) and handed back if it raises.
+
+        :raises MemoryExhausted: if ``name`` doesn't fit and nothing in flight
+            could hand memory back.
+        """
+        need = self.demands.get(name, 0)
+        with self._cond:
+            if need > self.budget:
+                logging.warning(
+                    "{} needs {} MiB, more than the whole {} MiB budget; starting it alone".format(
+                        name, need, self.budget
+                    )
+                )
+                self._cond.wait_for(lambda: self.in_flight == 0)
+            else:
+                if not self._fits(need):
+                    logging.debug(
+                        "Queueing start of {} ({} MiB), {} MiB available".format(
+                            name, need, self.available
+                        )
+                    )
+                self._cond.wait_for(lambda: self._fits(need) or self.in_flight == 0)
+                if not self._fits(need):
+                    raise MemoryExhausted(
+                        "{} needs {} MiB, {} MiB of the {} MiB budget left".format(
+                            name, need, self.available, self.budget
+                        )
+                    )
+            self.used += need
+            self.in_flight += 1
+        try:
+            yield
+        except BaseException:
+            self.release(need)
+            raise
+        finally:
+            with self._cond:
+                self.in_flight -= 1
+                self._cond.notify_all()
+
+    def release(self, mib):
+        """Return ``mib`` to the budget, e.g. after a VM halts."""
+        with self._cond:
+            self.used -= mib
+            self._cond.notify_all()
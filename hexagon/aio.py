@@ -0,0 +1,257 @@
+"""asyncio execution engine for fleet operations.
+
+The thread engine in ``cli.main`` holds one OS thread per in-flight VM for the
+whole operation, including the seconds-to-minutes a halt spends waiting. Here
+waits are futures resolved from the Admin API event stream, so a VM that's
+shutting down costs no thread at all, and concurrency is bounded by a
+semaphore rather than by a thread pool's size.
+
+qubesadmin's per-call API is synchronous, so individual calls (``start``,
+``shutdown``, property reads) still run in a bounded worker pool; they're
+short compared to the waits. The synchronous HexagonQube API is untouched --
+the engine drives it, and ``cli --engine=threads`` remains the default.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import time
+
+from .events import HALT_EVENTS, events_available
+from .history import SHUTDOWN, START
+from .qmgr import HexagonQube
+
+
+class AsyncEngine(object):
+    """Run VM operations as coroutines over one shared Session.
+
+    :param session: the shared ``Session``; its event source is reused when
+        one was injected or already opened, else ``admin.Events`` is read
+        natively with qubesadmin's asyncio ``EventsDispatcher``.
+    :param concurrency: cap on VMs operated on at once (``None``: no cap).
+    :param workers: size of the pool blocking Admin API calls run in.
+    :param pause: seconds to wait between waves, as ``WaveScheduler`` does.
+    :param history: a ``DurationHistory``: halts and starts are recorded in
+        it, and each VM's kill timeout comes from it instead of ``timeout``.
+    :param readiness: a ``Readiness``: starts wait until the VM is ready.
+    :param clients: a ``scheduler.NetvmClients``, so halts don't ask qubesd
+        for every domain's netvm.
+    """
+
+    def __init__(
+        self,
+        session,
+        concurrency=None,
+        workers=32,
+        poll_interval=5,
+        timeout=30,
+        pause=0,
+        history=None,
+        readiness=None,
+        clients=None,
+    ):
+        self.session = session
+        self.concurrency = concurrency
+        self.pause = pause
+        self.history = history
+        self.readiness = readiness
+        self.clients = clients
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._waiters = {}
+        self._sem = None
+        self._executor = None
+        self._listener = None
+        self._unsubscribe = None
+
+    def __repr__(self):
+        return "<AsyncEngine: concurrency={}>".format(self.concurrency)
+
+    async def call(self, func, *args, **kwargs):
+        """Run a blocking (qubesadmin) call in the worker pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    # --- events -------------------------------------------------------------
+
+    def _on_event(self, name, event):
+        for events, fut in self._waiters.get(name, ()):
+            if event in events and not fut.done():
+                fut.set_result(event)
+
+    def _expect(self, name, events):
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(name, []).append((frozenset(events), fut))
+        return fut
+
+    def _forget(self, name, fut):
+        waiters = [w for w in self._waiters.get(name, ()) if w[1] is not fut]
+        if waiters:
+            self._waiters[name] = waiters
+        else:
+            self._waiters.pop(name, None)
+
+    def _listen(self):
+        loop = asyncio.get_running_loop()
+        source = self.session.event_source
+        if source is not None:
+            # Thread-fed source: hop onto the loop before touching futures.
+            def forward(name, event):
+                if not loop.is_closed():
+                    loop.call_soon_threadsafe(self._on_event, name, event)
+
+            source.subscribe(forward)
+            # The session, and its source, outlive this run under `hexagon serve`.
+            self._unsubscribe = functools.partial(source.unsubscribe, forward)
+        elif events_available():
+            import qubesadmin.events
+
+            from .session import _new_app
+
+            # Not the session's app: the dispatcher would resolve subjects in
+            # its domain collection while worker threads use it.
+            dispatcher = qubesadmin.events.EventsDispatcher(_new_app())
+            dispatcher.add_handler(
+                "*",
+                lambda subject, event, **kwargs: self._on_event(
+                    getattr(subject, "name", subject), event
+                ),
+            )
+            self._listener = asyncio.ensure_future(dispatcher.listen_for_events())
+
+    async def wait_for_event(self, name, fut, timeout, check):
+        """Wait until ``fut`` resolves or ``check()`` (polled every
+        ``poll_interval`` as a fallback) returns true. Returns whether either
+        happened before ``timeout``."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                event = await asyncio.wait_for(
+                    asyncio.shield(fut), min(self.poll_interval, remaining)
+                )
+                logging.debug("VM '{}' reported {}".format(name, event))
+                return True
+            except asyncio.TimeoutError:
+                pass
+            if await self.call(check):
+                return True
+
+    # --- operations ---------------------------------------------------------
+
+    async def halt(self, name):
+        """Async counterpart of ``HexagonQube.ensure_halted``."""
+        qube = await self.call(HexagonQube, name, session=self.session)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        was_running = await self.call(qube.vm.is_running)
+        killed = False
+        if was_running:
+            timeout = self.timeout
+            if self.history is not None:
+                timeout = self.history.timeout(name, default=self.timeout)
+            fut = self._expect(name, HALT_EVENTS)
+            try:
+                clients = None if self.clients is None else self.clients.get(name)
+                await self.call(qube.request_halt, clients=clients)
+
+                def halted():
+                    power_state = qube.vm.get_power_state()
+                    logging.debug("VM '{}' has power state {}".format(name, power_state))
+                    return power_state in ("Halted", "NA")
+
+                await self.wait_for_event(name, fut, timeout, halted)
+            finally:
+                self._forget(name, fut)
+        if was_running and await self.call(qube.vm.is_running):
+            logging.warning("Halting VM via kill: {}".format(name))
+            await self.call(qube.vm.kill)
+            killed = True
+        # As in cli.halt_vm: only graceful halts are duration samples.
+        if was_running and not killed and self.history is not None:
+            self.history.record(name, SHUTDOWN, loop.time() - start)
+
+    async def start(self, name):
+        qube = await self.call(HexagonQube, name, session=self.session)
+        waiter = None
+        if self.readiness is not None:
+            waiter = await self.call(self.readiness.expect, qube)
+        start = time.monotonic()
+        try:
+            await self.call(qube.vm.start)
+        except BaseException:
+            if waiter is not None:
+                waiter.cancel()
+            raise
+        started = time.monotonic()
+        if self.history is not None:
+            self.history.record(name, START, started - start)
+        logging.debug("VM has started: {}".format(name))
+        if self.readiness is not None:
+            await self.call(self.readiness.wait, qube, waiter, start, started)
+
+    async def reboot(self, name):
+        await self.halt(name)
+        await self.start(name)
+
+    async def reconcile(self, name, **config):
+        qube = await self.call(HexagonQube, name, session=self.session, **config)
+        await self.call(qube.reconcile)
+
+    # --- scheduling ---------------------------------------------------------
+
+    async def _guarded(self, op, name):
+        async with self._sem:
+            await op(name)
+
+    async def run_waves(self, waves, op, skip=()):
+        """Await ``op(name)`` for every VM, wave by wave; each wave runs
+        concurrently. Returns ``[(name, exception or None)]``."""
+        results = []
+        for i, wave in enumerate(waves):
+            wave = [n for n in wave if n not in skip]
+            if not wave:
+                continue
+            if results and self.pause:
+                logging.debug("Pausing {}s before the next wave".format(self.pause))
+                await asyncio.sleep(self.pause)
+            logging.debug("Wave {}/{}: {}".format(i + 1, len(waves), wave))
+            outcomes = await asyncio.gather(
+                *(self._guarded(op, n) for n in wave), return_exceptions=True
+            )
+            results.extend(zip(wave, outcomes))
+        return results
+
+    async def _run_phases(self, phases):
+        self._sem = asyncio.Semaphore(self.concurrency or 2**31)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self._listen()
+        failed = set()
+        results = []
+        try:
+            for phase, waves, op in phases:
+                for name, e in await self.run_waves(waves, op, skip=failed):
+                    if e is not None:
+                        failed.add(name)
+                    results.append((phase, name, e))
+        finally:
+            if self._unsubscribe is not None:
+                self._unsubscribe()
+                self._unsubscribe = None
+            if self._listener is not None:
+                self._listener.cancel()
+            self._executor.shutdown(wait=False)
+        return results
+
+    def run(self, phases):
+        """Run ``[(phase, waves, op)]`` in order on a fresh event loop.
+
+        VMs that fail a phase are skipped by the later ones. Returns
+        ``[(phase, name, exception or None)]``.
+        """
+        return asyncio.run(self._run_phases(phases))
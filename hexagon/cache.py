@@ -0,0 +1,211 @@
+"""Persistent on-disk fleet snapshot, so repeat invocations skip re-reading VMs.
+
+Every ``hexagon`` run starts with one ``admin.vm.List`` anyway. ``FleetCache``
+compares that listing with the one saved last time and reuses the saved
+properties, tags and features of every VM that's unchanged, so a repeat
+``hexagon ls --tags foo`` costs one call instead of one per VM. A VM is
+refetched when:
+
+  * it's new, or its class changed (removed VMs are dropped);
+  * it was marked dirty -- by hexagon after writing to it, or by an event
+    listener (``watch``) that saw a property, tag or feature change;
+  * its record is older than ``max_age`` seconds, which bounds staleness from
+    changes made while nothing was listening (e.g. ``qvm-prefs`` in dom0).
+
+Only ``hexagon serve`` runs a listener, so only there are saved records
+trusted; a plain CLI run can't know what ``qvm-tags`` or ``qvm-prefs`` changed
+since the last one and uses ``max_age=0`` -- it refetches everything it reads,
+and the cache just supplies the generation and stays warm for the daemon.
+Power state always comes fresh from the listing.
+
+The snapshot lives in ``$XDG_CACHE_HOME/hexagon/fleet.json`` as compact JSON,
+written atomically. Dirty marks go to an append-only ``fleet.dirty`` next to
+it (under ``flock``), so concurrent writers -- the CLI, a listener -- never
+lose each other's marks. The saved ``generation`` marker hashes the listing
+together with an epoch bumped on every invalidation; it's unchanged iff
+nothing hexagon can see has moved since it was written.
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from .snapshot import FleetSnapshot, VMRecord, parse_vm_list
+
+FORMAT_VERSION = 1
+
+# Seconds saved records are trusted, even with a listener marking changes.
+MAX_AGE = 300
+
+# Events after which a VM's cached properties/tags/features can't be trusted.
+# Power-state events are omitted: state is re-read from admin.vm.List.
+_DIRTY_EVENT_PREFIXES = ("property-set:", "property-del:", "domain-tag-", "domain-feature-")
+
+
+def default_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "hexagon")
+
+
+def _encode(record, fetched):
+    return [
+        record.klass,
+        record.properties,
+        sorted(record.tags) if record.tags is not None else None,
+        record.features,
+        sorted(record._loaded_features),
+        fetched,
+    ]
+
+
+def _decode(name, power_state, entry):
+    klass, properties, tags, features, loaded_features, fetched = entry
+    record = VMRecord(
+        name,
+        klass=klass,
+        power_state=power_state,
+        properties=properties,
+        tags=tags,
+        features=features,
+    )
+    record._loaded_features = frozenset(loaded_features)
+    return record, fetched
+
+
+class FleetCache(object):
+    """Load and save FleetSnapshots across invocations.
+
+    :param path: directory holding the cache files.
+    :param max_age: seconds after which a VM's saved data is refetched.
+    """
+
+    def __init__(self, path=None, max_age=MAX_AGE):
+        self.path = path or default_cache_dir()
+        self.max_age = max_age
+        self._fetched = {}
+        self._epoch = 0
+        self._dirty_seen = 0
+
+    def __repr__(self):
+        return "<FleetCache: {}>".format(self.path)
+
+    @property
+    def snapshot_file(self):
+        return os.path.join(self.path, "fleet.json")
+
+    @property
+    def dirty_file(self):
+        return os.path.join(self.path, "fleet.dirty")
+
+    def _read(self):
+        try:
+            with open(self.snapshot_file) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("version") != FORMAT_VERSION:
+            return None
+        return data
+
+    def _dirty(self):
+        try:
+            with open(self.dirty_file, "rb") as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                data = f.read()
+        except OSError:
+            data = b""
+        # save() only clears the marks this snapshot accounted for.
+        self._dirty_seen = len(data)
+        return {line for line in data.decode().splitlines() if line}
+
+    def snapshot(self, session):
+        """A FleetSnapshot of every domain, reusing saved data where valid."""
+        app = session.app
+        listing_data = session.listing()
+        listing = parse_vm_list(listing_data)
+        saved = self._read() or {"vms": {}, "epoch": 0}
+        dirty = self._dirty()
+        now = time.time()
+        self._epoch = saved.get("epoch", 0) + (1 if dirty else 0)
+        self._fetched = {}
+        records = []
+        reused = 0
+        for name, (klass, power_state) in listing.items():
+            entry = saved["vms"].get(name)
+            if entry is not None and name not in dirty:
+                record, fetched = _decode(name, power_state, entry)
+                if record.klass == klass and now - fetched < self.max_age:
+                    records.append(record)
+                    self._fetched[name] = fetched
+                    reused += 1
+                    continue
+            records.append(VMRecord(name, klass=klass, power_state=power_state))
+            self._fetched[name] = now
+        logging.debug(
+            "Fleet cache: reused {} of {} VMs ({} marked dirty)".format(
+                reused, len(listing), len(dirty & set(listing))
+            )
+        )
+        generation = self._generation(listing_data, self._epoch)
+        return FleetSnapshot(records, generation=generation, app=app)
+
+    @staticmethod
+    def _generation(listing_data, epoch):
+        digest = hashlib.sha1(listing_data).hexdigest()[:16]
+        return "{}:{}".format(epoch, digest)
+
+    def save(self, snapshot):
+        """Write ``snapshot`` back (including anything loaded since) and clear
+        the dirty marks it accounted for."""
+        data = {
+            "version": FORMAT_VERSION,
+            "epoch": self._epoch,
+            "generation": snapshot.generation,
+            "vms": {r.name: _encode(r, self._fetched.get(r.name, time.time())) for r in snapshot},
+        }
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".fleet-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(tmp, self.snapshot_file)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._clear_dirty()
+
+    def _clear_dirty(self):
+        try:
+            f = open(self.dirty_file, "r+b")
+        except FileNotFoundError:
+            return
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            rest = f.read()[self._dirty_seen :]
+            f.seek(0)
+            f.write(rest)
+            f.truncate()
+        self._dirty_seen = 0
+
+    def invalidate(self, names):
+        """Mark ``names`` dirty, so the next snapshot refetches them."""
+        names = [n for n in names if n]
+        if not names:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.dirty_file, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write("".join("{}\n".format(n) for n in names).encode())
+
+    def watch(self, source):
+        """Mark VMs dirty as ``source`` reports changes to them."""
+
+        def on_event(name, event):
+            if name and event.startswith(_DIRTY_EVENT_PREFIXES):
+                self.invalidate([name])
+
+        source.subscribe(on_event)
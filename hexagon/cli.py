@@ -1,26 +1,22 @@
 import argparse
-import concurrent.futures
+import functools
 import logging
 import os
 import subprocess
 import sys
-from importlib.metadata import PackageNotFoundError, version as _pkg_version
-
-import yaml
-
-
-try:
-    import qubesadmin
-
-    _HAS_QUBESADMIN = True
-    _QUBESADMIN_ERR = None
-except ImportError as exc:
-    _HAS_QUBESADMIN = False
-    _QUBESADMIN_ERR = exc
+import time
 
 from .qmgr import HexagonQube, dom0_update_cmd, vm_update_cmd
+from .session import Session
+from . import daemon as daemon_mod
 from . import policy as policy_mod
 
+# Startup cost matters: automation runs hexagon hundreds of times an hour, and
+# `policy`, `--help` and daemon-forwarded commands never touch the Admin API.
+# So qubesadmin, yaml, importlib.metadata and the snapshot/cache/scheduling
+# modules (concurrent.futures, hashlib, json) are imported where they're used.
+# tests/test_startup.py keeps it that way.
+
 
 def _resolve_version():
     # Prefer the version baked in at build time (see flake.nix); the noarch
@@ -34,6 +30,8 @@ def _resolve_version():
     except ImportError:
         pass
 
+    from importlib.metadata import PackageNotFoundError, version as _pkg_version
+
     try:
         return _pkg_version("hexagon")
     except PackageNotFoundError:
@@ -51,17 +49,30 @@ def _resolve_version():
     return "0.0.0+unknown"
 
 
-VERSION = _resolve_version()
+class _VersionAction(argparse.Action):
+    """Like argparse's ``version`` action, but resolves the version only when
+    ``--version`` is actually passed."""
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, help=None):
+        super().__init__(option_strings, dest=dest, default=argparse.SUPPRESS, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        sys.stdout.write("{} {}\n".format(parser.prog, _resolve_version()))
+        parser.exit()
 
 
 logfmt = "%(asctime)s %(levelname)-8s %(funcName)s() %(message)s"
-logging.basicConfig(format=logfmt, level=logging.DEBUG, datefmt="%Y-%m-%d %H:%M:%S")
+logdatefmt = "%Y-%m-%d %H:%M:%S"
+
+# VMs a wave runs at once under a failure budget, unless --max-concurrency
+# says otherwise: with a whole wave in flight, nothing is left queued to cancel.
+FAILURE_BUDGET_CONCURRENCY = 8
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        "--version", action="version", version="%(prog)s {version}".format(version=VERSION)
+        "--version", action=_VersionAction, help="show program's version number and exit"
     )
     parser.add_argument(
         "--dry-run",
@@ -69,6 +80,36 @@ def parse_args():
         action="store_true",
         help="Display proposed changes, but don't implement",
     )
+    parser.add_argument(
+        "--no-cache",
+        default=False,
+        action="store_true",
+        help="Read every VM from the Admin API instead of the on-disk fleet snapshot",
+    )
+    parser.add_argument(
+        "--no-daemon",
+        default=False,
+        action="store_true",
+        help="Run in this process even if a 'hexagon serve' daemon is listening",
+    )
+    parser.add_argument(
+        "--profile",
+        default=False,
+        action="store_true",
+        help="Time every Admin API call and print a summary, plus a JSON dump, to stderr",
+    )
+    parser.add_argument(
+        "--profile-json",
+        metavar="FILE",
+        help="With --profile, write the JSON dump to FILE instead",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=("threads", "asyncio"),
+        default="threads",
+        help="How to run VM operations: a thread per VM, or asyncio with event-driven "
+        "waits [default: %(default)s]",
+    )
 
     # Python 3.5 (dom0) doesn't support required=True
     # subparsers = parser.add_subparsers(dest='command', required=True)
@@ -77,7 +118,53 @@ def parse_args():
     # Shared by all VM-targeting subcommands: select VMs by tag, instead of
     # (or in addition to) naming them explicitly.
     tags_parser = argparse.ArgumentParser(add_help=False)
-    tags_parser.add_argument("--tags", default="", action="store", help="select VMs by tag")
+    tags_parser.add_argument(
+        "--tags",
+        default="",
+        action="store",
+        help="select VMs by tag expression, e.g. 'hexagon,!sys-*' or '(work|dev)&hexagon'",
+    )
+
+    # Shared by the subcommands that operate on VMs in parallel: how many
+    # failures to tolerate before cancelling the operations still queued.
+    batch_parser = argparse.ArgumentParser(add_help=False)
+    failures = batch_parser.add_mutually_exclusive_group()
+    failures.add_argument(
+        "--fail-fast",
+        dest="max_failures",
+        action="store_const",
+        const=0,
+        help="Cancel queued operations after the first failure (--max-failures 0)",
+    )
+    failures.add_argument(
+        "--max-failures",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Cancel queued operations once more than N VMs have failed; each wave then runs "
+        "at most {} VMs at once unless --max-concurrency is given [default: never]".format(
+            FAILURE_BUDGET_CONCURRENCY
+        ),
+    )
+
+    # Shared by the subcommands that start VMs: wait until they can be used.
+    ready_parser = argparse.ArgumentParser(add_help=False)
+    ready_parser.add_argument(
+        "--wait-ready",
+        default=False,
+        action="store_true",
+        help="After starting each VM, wait for its qrexec agent and user session "
+        "(qubes.WaitForSession), and report how long each took",
+    )
+    ready_parser.add_argument(
+        "--ready-timeout",
+        action="store",
+        default=120,
+        type=float,
+        metavar="SECONDS",
+        help="With --wait-ready, fail VMs not ready this long after their start "
+        "[default: %(default)s]",
+    )
 
     ls_parser = subparsers.add_parser(
         "ls", parents=[tags_parser], help="ls VMs, by features or prefs"
@@ -105,7 +192,9 @@ def parse_args():
         help="Filter by VM attribute, property, e.g. vcpus=2",
     )
     ls_parser.add_argument("vms", nargs=argparse.ZERO_OR_MORE, action="store", help="VMs to list")
-    reboot_parser = subparsers.add_parser("reboot", parents=[tags_parser], help="reboot VMs")
+    reboot_parser = subparsers.add_parser(
+        "reboot", parents=[tags_parser, batch_parser, ready_parser], help="reboot VMs"
+    )
     reboot_parser.add_argument(
         "vms", nargs=argparse.ZERO_OR_MORE, action="store", help="VMs to reboot"
     )
@@ -115,6 +204,48 @@ def parse_args():
         action="store_true",
         help="Reboot only VMs whose TemplateVMs have been recently updated",
     )
+    reboot_parser.add_argument(
+        "--max-concurrency",
+        action="store",
+        default=None,
+        type=int,
+        help="How many VMs to operate on at once within each wave "
+        "[default: all, or {} with --max-failures]".format(FAILURE_BUDGET_CONCURRENCY),
+    )
+    reboot_parser.add_argument(
+        "--batch-size",
+        action="store",
+        default=None,
+        type=int,
+        metavar="N",
+        help="Rolling reboot: reboot N VMs at a time, each batch only once the previous "
+        "one is running again [default: everything at once]",
+    )
+    reboot_parser.add_argument(
+        "--max-unavailable",
+        action="store",
+        default=None,
+        type=int,
+        metavar="N",
+        help="Rolling reboot: at most N VMs down at once [default: --batch-size]",
+    )
+    reboot_parser.add_argument(
+        "--pause",
+        action="store",
+        default=0,
+        type=float,
+        metavar="SECONDS",
+        help="Rolling reboot: wait this long between batches [default: %(default)s]",
+    )
+    reboot_parser.add_argument(
+        "--memory-budget",
+        action="store",
+        default=None,
+        type=int,
+        metavar="MIB",
+        help="Memory available for starting VMs; starts beyond it are queued "
+        "[default: estimated from 'xl info' and 'xl list' in dom0, else unlimited]",
+    )
     update_parser = subparsers.add_parser(
         "update", parents=[tags_parser], help="update packages inside VM"
     )
@@ -141,7 +272,7 @@ def parse_args():
         help="How many VMs to update in parallel",
     )
     reconcile_parser = subparsers.add_parser(
-        "reconcile", parents=[tags_parser], help="apply all VM config options"
+        "reconcile", parents=[tags_parser, batch_parser], help="apply all VM config options"
     )
 
     reconcile_parser.add_argument(
@@ -164,21 +295,66 @@ def parse_args():
         type=lambda x: x.split("="),
         help="VM attribute to set, e.g. 'vcpus=1'",
     )
+    reconcile_parser.add_argument(
+        "--config",
+        metavar="FILE",
+        help="Reconcile every VM declared in this YAML fleet file, skipping VMs whose "
+        "declaration is unchanged since they were last reconciled from it",
+    )
+    reconcile_parser.add_argument(
+        "--force",
+        default=False,
+        action="store_true",
+        help="With --config, reconcile every declared VM even if it looks unchanged",
+    )
+    reconcile_parser.add_argument(
+        "--plan",
+        metavar="FILE",
+        help="With --dry-run, save the plan to FILE; otherwise apply the plan in FILE, "
+        "re-diffing only if the fleet changed since it was saved",
+    )
 
     shutdown_parser = subparsers.add_parser(
         "shutdown",
-        parents=[tags_parser],
+        parents=[tags_parser, batch_parser],
         help="Ensures specified VMs are halted (even if clients are connected)",
     )
     shutdown_parser.add_argument(
         "vms", nargs=argparse.ZERO_OR_MORE, action="store", help="VMs to shutdown"
     )
+    shutdown_parser.add_argument(
+        "--max-concurrency",
+        action="store",
+        default=None,
+        type=int,
+        help="How many VMs to halt at once within each wave "
+        "[default: all, or {} with --max-failures]".format(FAILURE_BUDGET_CONCURRENCY),
+    )
     start_parser = subparsers.add_parser(
-        "start", parents=[tags_parser], help="Ensures specified VMs are running"
+        "start",
+        parents=[tags_parser, batch_parser, ready_parser],
+        help="Ensures specified VMs are running",
     )
     start_parser.add_argument(
         "vms", nargs=argparse.ZERO_OR_MORE, action="store", help="VMs to start"
     )
+    start_parser.add_argument(
+        "--max-concurrency",
+        action="store",
+        default=None,
+        type=int,
+        help="How many VMs to start at once within each wave "
+        "[default: all, or {} with --max-failures]".format(FAILURE_BUDGET_CONCURRENCY),
+    )
+    start_parser.add_argument(
+        "--memory-budget",
+        action="store",
+        default=None,
+        type=int,
+        metavar="MIB",
+        help="Memory available for starting VMs; starts beyond it are queued "
+        "[default: estimated from 'xl info' and 'xl list' in dom0, else unlimited]",
+    )
 
     policy_parser = subparsers.add_parser(
         "policy",
@@ -201,7 +377,7 @@ def parse_args():
         default=[],
         metavar="QUBE",
         help="Admin qube name whose disp-mgmt VMs get created-by grants; "
-        "repeatable [default: {}]".format(" ".join(policy_mod.DEFAULT_ADMIN_QUBES)),
+        "repeatable [default: this qube's hostname]",
     )
     policy_parser.add_argument(
         "--sys-vm",
@@ -218,23 +394,53 @@ def parse_args():
         default=policy_mod.DEFAULT_MGMT_DISPVM,
         help="Management DispVM template qubes_proxy derives targets from [default: %(default)s]",
     )
+    policy_parser.add_argument(
+        "--optimize",
+        action="store_true",
+        help="Drop unreachable rules and order the rest by expected hit frequency, "
+        "after proving every decision unchanged",
+    )
 
-    args = parser.parse_args()
+    serve_parser = subparsers.add_parser(
+        "serve",
+        help="Keep a warm Admin API session; other invocations forward commands to it",
+    )
+    serve_parser.add_argument(
+        "--socket",
+        default=None,
+        help="Unix socket to listen on [default: $HEXAGON_SOCKET, else "
+        "$XDG_RUNTIME_DIR/hexagon.sock]",
+    )
+
+    args = parser.parse_args(argv)
 
     # Python 3.5 compatibility requires explicit check for subcommand;
     # later versions of argparse permit use of required=True.
     if not args.command:
         msg = (
             "subcommand required, choose one of "
-            "{ls, reboot, start, shutdown, update, reconcile, policy}"
+            "{ls, reboot, start, shutdown, update, reconcile, policy, serve}"
         )
         print(msg)
         sys.exit(1)
 
+    if args.command == "reboot":
+        for option in ("batch_size", "max_unavailable"):
+            if getattr(args, option) is not None and getattr(args, option) < 1:
+                parser.error("--{} must be at least 1".format(option.replace("_", "-")))
+        if args.pause and not _rolling(args):
+            parser.error("--pause needs --batch-size or --max-unavailable")
+
     return args
 
 
+def _rolling(args):
+    return args.batch_size is not None or args.max_unavailable is not None
+
+
 def load_config(config_filepath):
+    import yaml
+
     cfg = {}
     if os.path.exists(config_filepath):
         with open(config_filepath, "r") as f:
@@ -242,38 +448,311 @@ def load_config(config_filepath):
     return cfg
 
 
-def reconcile_vm(args, vm_name):
+def _reconcile_config(args):
     custom_config = {}
     for p in args.property:
         custom_config[p[0]] = p[1]
+    return custom_config
+
+
+def reconcile_vm(args, vm_name, session=None, plan=None):
+    if plan is not None:
+        # Already diffed against the fleet snapshot; see plan.py.
+        vm_plan = plan[vm_name]
+        cq = HexagonQube(vm_name, session=session, **vm_plan.desired)
+        # The batch halts and starts VMs around this (PowerPlan); the config
+        # hash is stored once that's done (_record_config_hashes).
+        cq.reconcile(plan=vm_plan, manage_power=False)
+        return
     # logging.debug("Reconciling custom config: {}".format(custom_config))
-    cq = HexagonQube(vm_name, **custom_config)
+    cq = HexagonQube(vm_name, session=session, **_reconcile_config(args))
     cq.reconcile()
 
 
-def reboot_vm(args, vm_name):
-    cq = HexagonQube(vm_name)
-    cq.reboot()
+def _record_config_hashes(session, plan, results):
+    """Store the fleet-file config hash of each VM every phase succeeded for.
+
+    Only then is the VM up to date: one whose start failed or was cancelled
+    must not look unchanged to the next ``reconcile --config``.
+
+    :returns: ``[("record", name, exception)]`` for hashes that couldn't be
+        stored.
+    """
+    from .fleet import FEATURE
+
+    failed = {vm for _phase, vm, e in results if e is not None}
+    reconciled = {vm for phase, vm, e in results if phase == "reconcile" and e is None}
+    errors = []
+    for vm_plan in plan.vms:
+        name = vm_plan.name
+        if vm_plan.config_hash is None or name not in reconciled or name in failed:
+            continue
+        try:
+            HexagonQube(name, session=session).vm.features[FEATURE] = vm_plan.config_hash
+        except Exception as e:
+            logging.error("Could not store the config hash of {}: {}".format(name, repr(e)))
+            errors.append(("record", name, e))
+    return errors
+
+
+def halt_vm(args, vm_name, session=None, history=None, clients=None):
+    qube = HexagonQube(vm_name, session=session)
+    if clients is not None:
+        clients = clients.get(vm_name)
+    if history is None:
+        qube.ensure_halted(clients=clients)
+        return
+    from .history import SHUTDOWN
+
+    start = time.monotonic()
+    # A kill only says how long the timeout was; recording it would stretch
+    # the next one.
+    if qube.ensure_halted(timeout=history.timeout(vm_name), clients=clients) and not qube.killed:
+        history.record(vm_name, SHUTDOWN, time.monotonic() - start)
+
+
+def reboot_vm(args, vm_name, session=None, history=None, readiness=None, clients=None):
+    # HexagonQube.reboot, with each half timed.
+    halt_vm(args, vm_name, session=session, history=history, clients=clients)
+    start_vm(args, vm_name, session=session, history=history, readiness=readiness)
 
 
-def main():
-    args = parse_args()
+def start_vm(args, vm_name, session=None, budget=None, history=None, readiness=None):
+    qube = HexagonQube(vm_name, session=session)
+    # Subscribed before the start, so a fast one can't slip by.
+    waiter = readiness.expect(qube) if readiness is not None else None
+    try:
+        if budget is None:
+            start = time.monotonic()
+            qube.vm.start()
+        else:
+            with budget.admit(vm_name):
+                start = time.monotonic()
+                qube.vm.start()
+    except BaseException:
+        if waiter is not None:
+            waiter.cancel()
+        raise
+    started = time.monotonic()
+    if history is not None:
+        from .history import START
+
+        history.record(vm_name, START, started - start)
+    logging.debug("VM has started: {}".format(vm_name))
+    if readiness is not None:
+        # Outside the memory admission: the VM already has what it booted with.
+        readiness.wait(qube, waiter, start, started)
+
+
+def _max_concurrency(args):
+    concurrency = getattr(args, "max_concurrency", None)
+    if concurrency is None and args.max_failures is not None:
+        return FAILURE_BUDGET_CONCURRENCY
+    return concurrency
+
+
+def _scheduler(args, snapshot, vms):
+    from .scheduler import WaveScheduler, netvm_graph
+
+    return WaveScheduler(netvm_graph(snapshot, vms), max_concurrency=_max_concurrency(args))
+
+
+def _rolling_scheduler(args, snapshot, vms):
+    """A scheduler for a rolling reboot: ``--batch-size`` VMs per wave, at
+    most ``--max-unavailable`` of them down at once, ``--pause`` between."""
+    from .scheduler import WaveScheduler, netvm_graph
+
+    batch_size = args.batch_size or args.max_unavailable
+    return WaveScheduler(
+        netvm_graph(snapshot, vms),
+        max_concurrency=min(batch_size, args.max_unavailable or batch_size),
+        pause=args.pause,
+    )
+
+
+def _memory_budget(args, snapshot, vms, halting=False):
+    """MemoryBudget for starting ``vms``, or None if the host budget is unknown.
+
+    With ``halting``, the targets are halted before they're started again
+    (reboot), so whatever they use now counts as available.
+    """
+    from .admission import MemoryBudget, host_budget, vm_memory
+
+    if args.memory_budget is not None:
+        available = args.memory_budget
+    else:
+        available = host_budget(snapshot)
+        if available is None:
+            logging.debug("Host memory unknown, starting without admission control")
+            return None
+        if halting:
+            available += sum(vm_memory(snapshot[n]) for n in vms if snapshot[n].is_running())
+    snapshot.load([snapshot[n] for n in vms], properties=True)
+    demands = {n: vm_memory(snapshot[n]) for n in vms}
+    logging.debug(
+        "Memory budget: {} MiB available for {} MiB of starts".format(
+            available, sum(demands.values())
+        )
+    )
+    return MemoryBudget(available, demands)
+
+
+def _save_snapshot(cache, snapshot):
+    if cache is None or snapshot is None:
+        return
+    try:
+        cache.save(snapshot)
+    except OSError as e:
+        logging.debug("Could not save fleet snapshot: {}".format(repr(e)))
+
+
+def _reconcile_plan(args, session, cache, snapshot, vms):
+    """The ReconcilePlan to apply: the saved one from ``--plan`` while the
+    fleet hasn't moved since, else freshly diffed against ``snapshot``."""
+    from .cache import MAX_AGE
+    from .plan import ReconcilePlan, plan_reconcile
+
+    # Only the on-disk cache's generation is comparable across invocations.
+    generation = snapshot.generation if cache is not None else None
+    if args.plan and not args.dry_run:
+        try:
+            saved = ReconcilePlan.load(args.plan)
+        except (OSError, ValueError) as e:
+            logging.error("Could not read plan {}: {}".format(args.plan, e))
+            sys.exit(1)
+        if saved.is_current(generation, MAX_AGE if cache is not None else 0):
+            logging.debug("Applying saved plan for generation {}".format(generation))
+            return saved
+        logging.info(
+            "Fleet changed since the plan was saved ({} -> {}), re-planning".format(
+                saved.generation, generation
+            )
+        )
+        configs = saved.desired()
+        hashes = {p.name: p.config_hash for p in saved.vms}
+    elif args.config:
+        configs, hashes = _fleet_file_configs(args, snapshot, vms)
+    elif not vms:
+        logging.error("No VMs were declared")
+        msg = "Reconcile must target specific VMs"
+        raise NotImplementedError(msg)
+    else:
+        config = _reconcile_config(args)
+        configs = {v: config for v in vms}
+        hashes = None
+    return plan_reconcile(
+        snapshot,
+        configs,
+        outdated=_outdated_check(session, snapshot),
+        generation=generation,
+        hashes=hashes,
+    )
+
+
+def _fleet_file_configs(args, snapshot, vms):
+    """Desired configs and their hashes for the VMs in ``--config`` that need
+    reconciling: those named (or tagged) on the command line, if any, minus
+    those unchanged since their last reconcile."""
+    from . import fleet
+
+    if not os.path.exists(args.config):
+        logging.error("Fleet file not found: {}".format(args.config))
+        sys.exit(1)
+    try:
+        configs = fleet.fleet_configs(load_config(args.config), source=args.config)
+    except ValueError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    if vms:
+        undeclared = [v for v in vms if v not in configs]
+        if undeclared:
+            logging.error("VMs not declared in {}: {}".format(args.config, undeclared))
+            sys.exit(1)
+        configs = {v: configs[v] for v in vms}
+    # Command-line properties override every declaration.
+    overrides = _reconcile_config(args)
+    configs = {name: {**config, **overrides} for name, config in configs.items()}
+    if not args.force:
+        skipped = fleet.unchanged(snapshot, configs)
+        if skipped:
+            logging.info(
+                "Skipping {} of {} VMs unchanged since their last reconcile".format(
+                    len(skipped), len(configs)
+                )
+            )
+        configs = {n: c for n, c in configs.items() if n not in skipped}
+    return configs, {name: fleet.config_hash(config) for name, config in configs.items()}
+
+
+def _outdated_check(session, snapshot):
+    """An outdated check for ``snapshot``'s records that walks the volumes of
+    only a few children per template (see outdated.py)."""
+    from .outdated import OutdatedIndex
+
+    return OutdatedIndex(snapshot, lambda name: HexagonQube(name, session=session).is_outdated())
+
+
+def _optimize_policy(text):
+    """Optimize rendered policy ``text``, refusing (exit 1) unless the result
+    provably decides every call the same way."""
+    from . import qrexec
+
+    rules = qrexec.parse_policy(text)
+    kept, dropped = qrexec.optimize(rules)
+    differences = qrexec.find_differences(rules, kept)
+    if differences:
+        for service, arg, source, target, before, after in differences:
+            logging.error(
+                "Optimized policy differs: {}{} {} -> {}: {} became {}".format(
+                    service, arg, source.name, target.name, before, after
+                )
+            )
+        sys.exit(1)
+    optimized = qrexec.format_optimized(text, kept, dropped)
+    logging.info(
+        "Optimized policy: {} of {} rules removed, {} -> {} lines".format(
+            len(dropped), len(rules), len(text.splitlines()), len(optimized.splitlines())
+        )
+    )
+    return optimized
+
+
+def main(argv=None, session=None):
+    """Run one hexagon command.
+
+    :param argv: arguments [default: ``sys.argv[1:]``].
+    :param session: the Session to use; ``hexagon serve`` passes its warm one.
+        Without one, Admin API commands go to a running daemon if there is
+        one, else a fresh Session is created.
+    """
+    args = parse_args(argv)
+    logging.basicConfig(format=logfmt, level=logging.DEBUG, datefmt=logdatefmt)
 
     # `policy` is pure text generation -- no Admin API needed, so it runs in any
     # AppVM (or dom0) without qrexec grants. Emit and exit before touching Qubes.
     if args.command == "policy":
-        sys.stdout.write(
-            policy_mod.render_policy(
-                admin_tag=args.admin_tag,
-                target_tag=args.target_tag,
-                admin_qubes=args.admin_qubes or None,
-                sys_vms=args.sys_vms or None,
-                mgmt_dispvm=args.mgmt_dispvm,
-            )
+        text = policy_mod.render_policy(
+            admin_tag=args.admin_tag,
+            target_tag=args.target_tag,
+            admin_qubes=args.admin_qubes or None,
+            sys_vms=args.sys_vms or None,
+            mgmt_dispvm=args.mgmt_dispvm,
         )
+        if args.optimize:
+            text = _optimize_policy(text)
+        sys.stdout.write(text)
         sys.exit(0)
 
-    if not _HAS_QUBESADMIN:
+    # A forwarded command's calls happen in the daemon, out of reach of --profile.
+    forward = not args.no_daemon and not args.profile
+    if session is None and forward and args.command in daemon_mod.FORWARDED:
+        code = daemon_mod.forward(sys.argv[1:] if argv is None else argv)
+        if code is not None:
+            sys.exit(code)
+
+    try:
+        import qubesadmin  # noqa: F401
+    except ImportError:
         print(
             "ERROR: qubesadmin is required but not installed. "
             "Install it with: dnf install qubes-core-admin-client",
@@ -281,70 +760,146 @@ def main():
         )
         sys.exit(1)
 
-    q = qubesadmin.Qubes()
+    if args.command == "serve":
+        daemon_mod.Daemon(Session(), path=args.socket).serve_forever()
+        sys.exit(0)
+
+    # One Admin API session for the whole run, shared by every HexagonQube and
+    # executor worker below, so the domain list is fetched once.
+    if session is None:
+        session = Session()
+    if not args.profile:
+        _run(args, session)
+        return
+    from .profiler import Profiler
+
+    profiler = Profiler().install(session.app)
+    try:
+        _run(args, session)
+    finally:
+        profiler.uninstall()
+        profiler.report(json_path=args.profile_json)
+
+
+def _run(args, session):
+    """Run an Admin API command (everything but ``policy`` and ``serve``)."""
+    from .cache import FleetCache
+    from .filters import compile_filters
+    from .history import SHUTDOWN, START, DurationHistory
+    from .scheduler import NetvmClients, WaveScheduler
+    from .snapshot import FleetSnapshot
+
     vms = args.vms
-    # Tag selection: no names given -> target all tagged VMs; names given ->
-    # narrow them to the tagged subset. `ls` applies the same filter itself.
-    # TODO: support csv tags
-    if args.tags and args.command != "ls":
-        tagged = [x.name for x in q.domains if args.tags in x.tags]
-        vms = [v for v in vms if v in tagged] if vms else tagged
-        if not vms:
-            logging.error("No VMs matched tag: {}".format(args.tags))
+    # Selection and `ls` answer from one fleet snapshot: the on-disk one where
+    # it's still valid (see cache.py), else fresh from admin.vm.List. Filters
+    # load whatever per-VM data they need on top. Saved tags and properties
+    # are only trusted while events mark changed VMs dirty, i.e. in the daemon.
+    cache = None
+    if not args.no_cache:
+        cache = FleetCache() if session.following else FleetCache(max_age=0)
+    snapshot = None
+    if args.command != "update" or args.tags:
+        if cache is not None:
+            snapshot = cache.snapshot(session)
+        else:
+            snapshot = FleetSnapshot.fetch(session, properties=False, tags=False)
+    # Tag selection, the same for every subcommand: no names given -> target
+    # every VM the expression selects; names given -> narrow them to those.
+    if args.tags:
+        from .tags import select
+
+        try:
+            vms = select(snapshot, args.tags, names=vms or None)
+        except ValueError as e:
+            logging.error("Invalid --tags: {}".format(e))
             sys.exit(1)
-    n_proc = len(vms) or 4
+        if not vms and args.command != "ls":
+            logging.error("No VMs matched tags: {}".format(args.tags))
+            sys.exit(1)
+    # Past halt and start durations set each VM's kill timeout and put the
+    # longest jobs first in every wave (see history.py).
+    history = (
+        DurationHistory() if args.command in ("reboot", "shutdown", "start", "reconcile") else None
+    )
+    # Who's behind each netvm, read once for every halt in the run.
+    clients = NetvmClients(snapshot) if snapshot is not None else None
+    halt = functools.partial(halt_vm, history=history, clients=clients)
+    readiness = None
+    if getattr(args, "wait_ready", False):
+        from .readiness import Readiness
+
+        readiness = Readiness(timeout=args.ready_timeout)
     if args.command == "reconcile":
         # Handle helper args, maybe belongs in parse_args
         for property_alias in ("template", "netvm", "label"):
             alias_value = getattr(args, property_alias)
             if alias_value:
                 args.property.append([property_alias, alias_value])
-        if not vms:
-            logging.error("No VMs were declared")
-            msg = "Reconcile must target specific VMs"
-            raise NotImplementedError(msg)
-        func = reconcile_vm
+        plan = _reconcile_plan(args, session, cache, snapshot, vms)
+        vms = plan.names()
+        power = plan.power()
+        logging.info("Reconcile: {}".format(power.summary()))
+        if args.dry_run:
+            sys.stdout.write(plan.format() + power.format())
+            if args.plan:
+                plan.save(args.plan)
+        # Halt everything that must reboot once, clients first; apply every
+        # VM's changes at once; then start once, netvms first.
+        scheduler = WaveScheduler({v: None for v in vms}, max_concurrency=_max_concurrency(args))
+        phases = [
+            ("shutdown", history.longest_first(power.shutdown_waves(), SHUTDOWN), halt),
+            ("reconcile", scheduler.start_waves(), functools.partial(reconcile_vm, plan=plan)),
+            (
+                "start",
+                history.longest_first(power.start_waves(), START),
+                functools.partial(start_vm, history=history),
+            ),
+        ]
 
     elif args.command == "ls":
         logging.debug("Listing VMs...")
-        if vms:
-            vms = [HexagonQube(x.name) for x in q.domains if x.name in vms]
-        else:
-            vms = [HexagonQube(x.name) for x in q.domains]
-        n_proc = len(vms) or 5
-        if args.tags:
-            # TODO: support csv tags
-            vms = [x for x in vms if args.tags in x.vm.tags]
-        if args.template:
-            vms = [x for x in vms if getattr(x.vm, "template", "") == args.template]
-        if args.updatable:
-            vms = [x for x in vms if x.vm.features.get("updates-available", "0") == "1"]
-        if args.outdated:
-            vms = [x for x in vms if x.is_outdated()]
-        if args.property:
-            for p in args.property:
-                k, v = p[0], p[1]
-                vms = [x for x in vms if hasattr(x.vm, k)]
-                if v.startswith("!"):
-                    v = v[1:]
-                    vms = [x for x in vms if str(getattr(x.vm, k, "")) != v]
-                else:
-                    vms = [x for x in vms if str(getattr(x.vm, k, "")) == v]
-
-        for vm in vms:
-            print(vm.name)
+        # Each filter stage loads what it needs (properties, ...) only for the
+        # VMs still in the running; --tags has already narrowed ``vms``.
+        pipeline = compile_filters(
+            names=vms if args.vms or args.tags else None,
+            template=args.template,
+            properties=args.property,
+            updatable=args.updatable,
+            outdated=_outdated_check(session, snapshot) if args.outdated else None,
+        )
+        for record in pipeline.run(snapshot):
+            print(record.name)
+        _save_snapshot(cache, snapshot)
         sys.exit(0)
 
     elif args.command == "reboot":
-        if vms:
-            vms = [HexagonQube(x.name) for x in q.domains if x.name in vms]
-        if args.outdated and vms:
-            vms = [x for x in vms if x.is_outdated()]
-        elif args.outdated and not vms:
-            vms = [HexagonQube(x.name) for x in q.domains]
-            vms = [x for x in vms if x.is_outdated()]
-        vms = [x.name for x in vms]
-        func = reboot_vm
+        if vms or args.outdated:
+            pipeline = compile_filters(
+                names=vms or None,
+                outdated=_outdated_check(session, snapshot) if args.outdated else None,
+            )
+            vms = [x.name for x in pipeline.run(snapshot)]
+        if _rolling(args):
+            # A batch at a time, each VM halted and started again before the
+            # next batch goes down; netvms' batches come first.
+            scheduler = _rolling_scheduler(args, snapshot, vms)
+            waves = scheduler.rolling_waves(
+                args.batch_size or args.max_unavailable, cost=history.cost(SHUTDOWN, START)
+            )
+            reboot = functools.partial(
+                reboot_vm, history=history, readiness=readiness, clients=clients
+            )
+            phases = [("reboot", waves, reboot)]
+        else:
+            # Halt everything clients-first, then start netvms-first, so no
+            # client is ever up while its (targeted) netvm is down.
+            scheduler = _scheduler(args, snapshot, vms)
+            budget = _memory_budget(args, snapshot, vms, halting=True) if vms else None
+            start = functools.partial(start_vm, budget=budget, history=history, readiness=readiness)
+            phases = [
+                ("shutdown", history.longest_first(scheduler.shutdown_waves(), SHUTDOWN), halt),
+                ("start", history.longest_first(scheduler.start_waves(), START), start),
+            ]
 
     elif args.command == "update":
         # Delegates entirely to the upstream updaters: qubes-dom0-update for
@@ -369,67 +924,103 @@ def main():
                 logging.error("Update command failed: {}".format(repr(e)))
         sys.exit(1 if errors else 0)
 
-    elif args.command == "shutdown":
+    elif args.command in ("shutdown", "start"):
         requested_vms = len(vms)
         if requested_vms > 0:
-            vms = [HexagonQube(x.name) for x in q.domains if x.name in vms]
+            vms = [x for x in vms if x in session]
             if len(vms) != requested_vms:
                 msg = "Some VMs could not be found"
                 raise Exception(msg)
         else:
             logging.error("No VMs were declared")
             # TODO: It'd be grand to read from a config file
-            msg = "Shutdown must target specific VMs"
+            msg = "{} must target specific VMs".format(args.command.capitalize())
             raise NotImplementedError(msg)
 
-        def f(args, x):
-            x.ensure_halted()
-
-        func = f
-
-    elif args.command == "start":
-        requested_vms = len(vms)
-        if requested_vms > 0:
-            vms = [HexagonQube(x.name) for x in q.domains if x.name in vms]
-            if len(vms) != requested_vms:
-                msg = "Some VMs could not be found"
-                raise Exception(msg)
+        scheduler = _scheduler(args, snapshot, vms)
+        if args.command == "shutdown":
+            phases = [
+                ("shutdown", history.longest_first(scheduler.shutdown_waves(), SHUTDOWN), halt)
+            ]
         else:
-            logging.error("No VMs were declared")
-            # TODO: It'd be grand to read from a config file
-            msg = "Start must target specific VMs"
-            raise NotImplementedError(msg)
-
-        def f(args, x):
-            x.vm.start()
-
-        func = f
+            budget = _memory_budget(args, snapshot, vms)
+            start = functools.partial(start_vm, budget=budget, history=history, readiness=readiness)
+            phases = [("start", history.longest_first(scheduler.start_waves(), START), start)]
     else:
         msg = "Action not supported: {}".format(args.command)
         raise NotImplementedError(msg)
 
+    _save_snapshot(cache, snapshot)
     if args.dry_run:
         logging.debug("Would {} VMs: {}".format(args.command, vms))
+        for phase, waves, _func in phases:
+            logging.debug("Would {} in {} waves: {}".format(phase, len(waves), waves))
         sys.exit(0)
 
-    logging.debug("Performing {} of VMs: {}".format(args.command, vms))
-    with concurrent.futures.ThreadPoolExecutor(max_workers=n_proc) as executor:
-        results = list(map(lambda x: executor.submit(func, args, x), vms))
+    from .progress import Progress
 
-    errors = 0
-    for i, r in enumerate(results):
-        vm = vms[i]
-        try:
-            r.result()
-            logging.debug("VM operation {} completed: {}".format(args.command, vm))
-        except Exception as e:
-            errors += 1
-            logging.debug("VM operation {} failed: {}, error: {}".format(args.command, vm, repr(e)))
+    logging.debug("Performing {} of VMs: {}".format(args.command, vms))
+    # Each VM's result is logged as it completes (progress.py); the summary
+    # below is the whole run, per VM.
+    progress = Progress(max_failures=args.max_failures)
+    if args.engine == "asyncio":
+        results = _run_async(
+            args, session, scheduler, phases, progress, history, readiness, clients
+        )
+    else:
+        results = _run_threads(args, session, scheduler, phases, progress)
+    if args.command == "reconcile":
+        results += _record_config_hashes(session, plan, results)
+        if cache is not None:
+            # Reconcile rewrote these VMs' properties; don't serve them stale.
+            cache.invalidate(vms)
+    history.save()
 
+    errors = sum(1 for _phase, _vm, e in results if e is not None)
+    sys.stderr.write(progress.format())
+    if readiness is not None:
+        sys.stderr.write(readiness.format())
     logging.debug("All VM {} operations finished, with {} errors".format(args.command, errors))
     if errors:
         sys.exit(1)
 
 
+def _run_threads(args, session, scheduler, phases, progress):
+    # VMs that fail a phase (e.g. reboot's halt) are skipped by later phases.
+    failed = set()
+    results = []
+    for phase, waves, func in phases:
+        op = progress.track(phase, waves, functools.partial(func, args, session=session))
+        for vm, e in scheduler.run(waves, op, skip=failed):
+            if e is not None:
+                failed.add(vm)
+            results.append((phase, vm, e))
+    return results
+
+
+def _run_async(args, session, scheduler, phases, progress, history, readiness, clients=None):
+    from .aio import AsyncEngine
+
+    engine = AsyncEngine(
+        session,
+        concurrency=scheduler.max_concurrency,
+        pause=scheduler.pause,
+        history=history,
+        readiness=readiness,
+        clients=clients,
+    )
+    async_phases = []
+    for phase, waves, func in phases:
+        if getattr(func, "func", func) is halt_vm:
+            # Halts are where the time goes; the engine waits on events natively.
+            op = engine.halt
+        elif getattr(func, "func", func) is reboot_vm:
+            op = engine.reboot
+        else:
+            op = functools.partial(engine.call, functools.partial(func, args, session=session))
+        async_phases.append((phase, waves, progress.track_async(phase, waves, op)))
+    return engine.run(async_phases)
+
+
 def qvm_reboot_main():
-    os.execvp("hexagon", ["hexagon", "reboot"] + sys.argv[1:])
+    main(["reboot"] + sys.argv[1:])
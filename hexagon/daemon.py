@@ -0,0 +1,304 @@
+"""``hexagon serve``: a warm daemon the CLI forwards commands to.
+
+Short commands like ``hexagon ls --tags foo`` spend most of their time
+starting Python, importing qubesadmin and re-reading ``admin.vm.List``.
+``hexagon serve`` pays for that once: it holds a Session that ``follow()``s
+the ``admin.Events`` stream, so the domain list stays cached until an event
+says it changed, and it marks the on-disk fleet snapshot (cache.py) dirty as
+VMs are modified.
+
+The CLI forwards the Admin API subcommands (``FORWARDED``) to the daemon when
+its socket answers and runs them in-process otherwise, so the daemon is purely
+an accelerator. ``update`` and ``policy`` always run locally: the former
+drives upstream tools that write to the terminal, the latter never touches
+the Admin API.
+
+Protocol: the client sends one JSON line, ``{"argv": [...], "cwd": ...}``;
+the daemon answers with JSON lines ``{"out": text}`` and ``{"err": text}``
+as the command prints and logs, ending with ``{"exit": code}``. Commands that
+change VMs run one at a time; read-only ones (``READ_ONLY``) skip that lock,
+so ``ls`` answers while a ``reboot`` is in progress. ``cli.main`` writes to the
+process-wide stdout, stderr and logging, so while commands run those are
+replaced by ``_Route``s that send each write to the client whose command
+owns the writing thread.
+
+The socket lives in the user's runtime dir, or ``/tmp/hexagon-<uid>`` without
+one; anyone could create that first, so the client only connects to a socket
+and directory owned by its own user.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+FORWARDED = frozenset(("ls", "reboot", "start", "shutdown", "reconcile"))
+# Forwarded commands that never change a VM, so may run alongside the others.
+READ_ONLY = frozenset(("ls",))
+
+
+def default_socket_path():
+    """``$HEXAGON_SOCKET``, else ``hexagon.sock`` in the user's runtime dir."""
+    path = os.environ.get("HEXAGON_SOCKET")
+    if path:
+        return path
+    runtime = os.environ.get("XDG_RUNTIME_DIR") or "/tmp/hexagon-{}".format(os.getuid())
+    return os.path.join(runtime, "hexagon.sock")
+
+
+def forward(argv, path=None):
+    """Run ``argv`` in the daemon, relaying its output to stdout/stderr.
+
+    :returns: the command's exit code, or None if no daemon is listening
+        (the caller then runs the command itself).
+    """
+    path = path or default_socket_path()
+    stdout, stderr = sys.stdout, sys.stderr
+    try:
+        owners = {os.stat(p).st_uid for p in (path, os.path.dirname(path) or ".")}
+    except OSError:
+        return None
+    if owners != {os.getuid()}:
+        # Someone else's socket would see our argv and decide our output.
+        logging.warning("Ignoring daemon socket not owned by this user: {}".format(path))
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        # No socket, or a stale one left by a daemon that died.
+        sock.close()
+        return None
+    with sock, sock.makefile("rwb") as f:
+        request = {"argv": list(argv), "cwd": os.getcwd()}
+        f.write(json.dumps(request).encode() + b"\n")
+        f.flush()
+        for line in f:
+            msg = json.loads(line)
+            if "exit" in msg:
+                return msg["exit"]
+            stream = stdout if "out" in msg else stderr
+            stream.write(msg.get("out", msg.get("err")))
+            stream.flush()
+    stderr.write("hexagon: daemon closed the connection before the command finished\n")
+    return 1
+
+
+class _Writer(object):
+    """File-like object relaying each write to the client as a JSON line."""
+
+    def __init__(self, wfile, key, lock):
+        self.wfile = wfile
+        self.key = key
+        self.lock = lock
+
+    def write(self, text):
+        if text:
+            _send(self.wfile, self.lock, {self.key: text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class _Route(object):
+    """File-like object sending each write to its thread's command's stream.
+
+    A command's handler thread writes to the stream it set with ``use()``.
+    Threads that never called it -- the workers commands start -- write to
+    the mutating command's stream, the one ``use()``d with ``default``, or to
+    ``fallback`` while none runs. Read-only commands print from their handler
+    thread; at most a debug log line from one of their workers goes astray.
+    """
+
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self.default = None
+        self._local = threading.local()
+
+    def _target(self):
+        return getattr(self._local, "stream", None) or self.default or self.fallback
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    @contextlib.contextmanager
+    def use(self, stream, default=False):
+        self._local.stream = stream
+        if default:
+            self.default = stream
+        try:
+            yield
+        finally:
+            self._local.stream = None
+            if default:
+                self.default = None
+
+
+def _send(wfile, lock, msg):
+    with lock:
+        try:
+            wfile.write(json.dumps(msg).encode() + b"\n")
+            wfile.flush()
+        except OSError:
+            # The client went away (e.g. ^C); let the command finish anyway.
+            pass
+
+
+def _exit_code(code, err):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    err.write("{}\n".format(code))
+    return 1
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            argv = [str(a) for a in request["argv"]]
+        except (ValueError, KeyError, TypeError):
+            logging.debug("Ignoring malformed request")
+            return
+        lock = threading.Lock()
+        out = _Writer(self.wfile, "out", lock)
+        err = _Writer(self.wfile, "err", lock)
+        code = self.server.daemon.run(argv, request.get("cwd"), out, err)
+        _send(self.wfile, lock, {"exit": code})
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon(object):
+    """Serve forwarded CLI commands from one warm Session.
+
+    :param session: the Session every command shares.
+    :param path: socket path [default: ``default_socket_path()``].
+    """
+
+    def __init__(self, session, path=None):
+        self.session = session
+        self.path = path or default_socket_path()
+        self._lock = threading.Lock()
+        self._server = None
+        # Guards installing and removing the _Routes below.
+        self._routes_lock = threading.Lock()
+        self._routed = 0
+        self._routes = None
+        self._saved = None
+
+    def __repr__(self):
+        return "<Daemon: {}>".format(self.path)
+
+    @contextlib.contextmanager
+    def _route(self, out, err, default):
+        """Send this thread's stdout, stderr and logging to ``out``/``err``
+        (and every unclaimed thread's too, with ``default``)."""
+        from . import cli
+
+        root = logging.getLogger()
+        with self._routes_lock:
+            if not self._routed:
+                self._saved = (sys.stdout, sys.stderr, root.handlers[:])
+                self._routes = (_Route(sys.stdout), _Route(sys.stderr))
+                handler = logging.StreamHandler(self._routes[1])
+                handler.setFormatter(logging.Formatter(cli.logfmt, datefmt=cli.logdatefmt))
+                sys.stdout, sys.stderr = self._routes
+                root.handlers = [handler]
+            self._routed += 1
+            stdout, stderr = self._routes
+        try:
+            with stdout.use(out, default), stderr.use(err, default):
+                yield
+        finally:
+            with self._routes_lock:
+                self._routed -= 1
+                if not self._routed:
+                    sys.stdout, sys.stderr, root.handlers = self._saved
+
+    def run(self, argv, cwd, out, err):
+        """Run one command with its output sent to ``out``/``err``; returns
+        the exit code.
+
+        Commands that may change VMs hold the run lock, and run in ``cwd``;
+        read-only ones take no paths, so they leave the (process-wide)
+        working directory alone and run alongside.
+        """
+        from . import cli
+
+        command = next((a for a in argv if a in FORWARDED), None)
+        mutating = command not in READ_ONLY
+        with contextlib.ExitStack() as stack:
+            if mutating:
+                stack.enter_context(self._lock)
+            if not self.session.following:
+                # Without events nothing tells us the domain list moved.
+                self.session.invalidate()
+            stack.enter_context(self._route(out, err, default=mutating))
+            if cwd and mutating:
+                stack.callback(os.chdir, os.getcwd())
+                os.chdir(cwd)
+            try:
+                cli.main(argv, session=self.session)
+                code = 0
+            except SystemExit as e:
+                code = _exit_code(e.code, err)
+            except Exception:
+                traceback.print_exc(file=err)
+                code = 1
+        return code
+
+    def bind(self):
+        """Create the listening socket, replacing a stale one."""
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        if os.stat(directory).st_uid != os.getuid():
+            raise RuntimeError("socket directory not owned by this user: {}".format(directory))
+        if os.path.exists(self.path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(self.path)
+                except OSError:
+                    os.unlink(self.path)
+                else:
+                    raise RuntimeError("hexagon daemon already running: {}".format(self.path))
+        # Only our own user may connect: commands run with our Admin API grants.
+        umask = os.umask(0o177)
+        try:
+            self._server = _Server(self.path, _Handler)
+        finally:
+            os.umask(umask)
+        self._server.daemon = self
+
+    def serve_forever(self):
+        from .cache import FleetCache
+
+        if self._server is None:
+            self.bind()
+        source = self.session.follow()
+        if source is not None:
+            FleetCache().watch(source)
+        else:
+            logging.warning("Admin API events unavailable; re-listing domains per command")
+        logging.debug("Serving on {}".format(self.path))
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.path)
+
+    def shutdown(self):
+        self._server.shutdown()
@@ -0,0 +1,154 @@
+"""Admin API event subscription, for waiting on VM state changes without polling.
+
+qubesd streams every domain event over ``admin.Events``. ``QubesEventSource``
+runs qubesadmin's ``EventsDispatcher`` in a background thread (it's asyncio,
+while the rest of hexagon is synchronous) and fans each event out to plain
+callbacks. ``EventWatcher`` turns that stream into per-VM waiters: register
+interest *before* triggering the state change, then block until the matching
+event arrives.
+
+Events are an accelerator, never the only signal: if the stream can't be
+opened (qubesadmin too old, qrexec policy denies ``admin.Events``) or an event
+is missed, callers still poll power state, just less often.
+"""
+
+import logging
+import threading
+
+# Fired by qubesd once a domain is fully stopped. ``domain-stopped`` arrives
+# first (libvirt reports shutoff), ``domain-shutdown`` after cleanup.
+HALT_EVENTS = frozenset(("domain-shutdown", "domain-stopped"))
+
+
+def events_available():
+    try:
+        import qubesadmin.events  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class QubesEventSource(object):
+    """Feed ``(vm name, event name)`` to subscribers from ``admin.Events``.
+
+    The dispatcher thread starts on the first ``subscribe`` and runs until the
+    process exits (it's a daemon thread); it reconnects on its own if qubesd
+    restarts.
+
+    :param app: the qubesadmin app the dispatcher reads through [default: a
+        new one, made in the dispatcher thread]. The dispatcher resolves
+        event subjects through ``app.domains`` while the worker threads use
+        the Session's app, so it must not be that one; it only needs names.
+    """
+
+    def __init__(self, app=None):
+        self.app = app
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._callbacks.append(callback)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="hexagon-events", daemon=True
+                )
+                self._thread.start()
+
+    def unsubscribe(self, callback):
+        """Stop calling ``callback``; the stream stays open for the others."""
+        with self._lock:
+            self._callbacks.remove(callback)
+
+    def _run(self):
+        import asyncio
+
+        import qubesadmin.events
+
+        if self.app is None:
+            from .session import _new_app
+
+            self.app = _new_app()
+        loop = asyncio.new_event_loop()
+        dispatcher = qubesadmin.events.EventsDispatcher(self.app)
+        dispatcher.add_handler("*", self._dispatch)
+        try:
+            loop.run_until_complete(dispatcher.listen_for_events())
+        except Exception as e:
+            logging.debug("Admin API event stream closed: {}".format(repr(e)))
+        finally:
+            loop.close()
+
+    def _dispatch(self, subject, event, **kwargs):
+        # subject is a VM object for domain events, None for app-level ones.
+        name = getattr(subject, "name", subject)
+        for callback in list(self._callbacks):
+            callback(name, event)
+
+
+class Waiter(object):
+    """Signalled when one of ``events`` fires for VM ``name``.
+
+    Use as a context manager so the watcher forgets it afterwards.
+    """
+
+    def __init__(self, watcher, name, events):
+        self.watcher = watcher
+        self.name = name
+        self.events = frozenset(events)
+        self.event = None
+        self._flag = threading.Event()
+
+    def __repr__(self):
+        return "<Waiter: {} {}>".format(self.name, sorted(self.events))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cancel()
+
+    def set(self, event):
+        self.event = event
+        self._flag.set()
+
+    def is_set(self):
+        return self._flag.is_set()
+
+    def wait(self, timeout=None):
+        return self._flag.wait(timeout)
+
+    def cancel(self):
+        self.watcher._forget(self)
+
+
+class EventWatcher(object):
+    """Match events from a source against registered Waiters."""
+
+    def __init__(self, source):
+        self._waiters = {}
+        self._lock = threading.Lock()
+        source.subscribe(self._on_event)
+
+    def expect(self, name, events):
+        """Register interest in ``events`` for VM ``name``; returns a Waiter."""
+        waiter = Waiter(self, name, events)
+        with self._lock:
+            self._waiters.setdefault(name, []).append(waiter)
+        return waiter
+
+    def _forget(self, waiter):
+        with self._lock:
+            waiters = self._waiters.get(waiter.name, [])
+            if waiter in waiters:
+                waiters.remove(waiter)
+            if not waiters:
+                self._waiters.pop(waiter.name, None)
+
+    def _on_event(self, name, event):
+        with self._lock:
+            waiters = list(self._waiters.get(name, ()))
+        for waiter in waiters:
+            if event in waiter.events:
+                waiter.set(event)
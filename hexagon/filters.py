@@ -0,0 +1,182 @@
+"""Compile VM selection filters into one cost-ordered predicate chain.
+
+Filters used to run one after another in the order ``cli.main`` happened to
+list them, each rebuilding the VM list, so the volume walk behind ``--outdated``
+could run for every VM before a cheap ``--tags`` check threw most of them away.
+A ``FilterPipeline`` instead orders its stages by what they cost to evaluate:
+
+  ========== ==== ==================================================
+  stage      cost data it needs
+  ========== ==== ==================================================
+  name       0    nothing (admin.vm.List already has it)
+  tags       1    one ``admin.vm.tag.List`` per VM
+  properties 2    one ``admin.vm.property.GetAll`` per VM
+  features   3    ``admin.vm.feature.List`` + ``Get`` per VM
+  volumes    4    one ``admin.vm.volume.Info`` per volume per VM
+  ========== ==== ==================================================
+
+(``--outdated`` checks volumes of only a few children per template; see
+outdated.py.)
+
+Each stage only loads its data for the VMs that survived every cheaper stage,
+so a VM discarded by its tags never has its properties or volumes read. The
+pipeline records how many VMs each stage discarded.
+"""
+
+import logging
+
+from .tags import TagExpression
+
+NAME = 0
+TAGS = 1
+PROPERTIES = 2
+FEATURES = 3
+VOLUMES = 4
+
+
+class Stage(object):
+    """One filter: a predicate over ``VMRecord``s, plus what it costs.
+
+    :param load: keyword arguments for ``FleetSnapshot.load`` naming the data
+        the predicate reads, fetched for survivors just before it runs.
+    :param prepare: optionally, a callable given all survivors before the
+        predicate runs, for predicates that decide VMs more cheaply together.
+    """
+
+    def __init__(self, name, cost, predicate, load=None, prepare=None):
+        self.name = name
+        self.cost = cost
+        self.predicate = predicate
+        self.load = load or {}
+        self.prepare = prepare
+
+    def __repr__(self):
+        return "<Stage: {} cost={}>".format(self.name, self.cost)
+
+
+class FilterPipeline(object):
+    """An ordered chain of Stages, run cheapest-first against a FleetSnapshot."""
+
+    def __init__(self, stages=()):
+        self.stages = []
+        self.discarded = []
+        for stage in stages:
+            self.add(stage)
+
+    def __repr__(self):
+        return "<FilterPipeline: {}>".format(", ".join(s.name for s in self.stages))
+
+    def add(self, stage):
+        self.stages.append(stage)
+        # Stable sort: stages of equal cost keep the order they were added in.
+        self.stages.sort(key=lambda s: s.cost)
+
+    def run(self, snapshot):
+        """Return the records of ``snapshot`` that pass every stage, in name order.
+
+        Populates ``discarded`` with ``(stage name, count)`` pairs.
+        """
+        survivors = list(snapshot)
+        self.discarded = []
+        for stage in self.stages:
+            if not survivors:
+                break
+            if stage.load:
+                snapshot.load(survivors, **stage.load)
+            if stage.prepare is not None:
+                stage.prepare(survivors)
+            kept = [r for r in survivors if stage.predicate(r)]
+            self.discarded.append((stage.name, len(survivors) - len(kept)))
+            logging.debug(
+                "Filter stage '{}' discarded {} of {} VMs".format(
+                    stage.name, len(survivors) - len(kept), len(survivors)
+                )
+            )
+            survivors = kept
+        return survivors
+
+
+def _property_predicate(properties):
+    # All --property filters compile into one short-circuiting predicate, so a
+    # VM failing the first comparison skips the rest.
+    checks = []
+    for k, v in properties:
+        if v.startswith("!"):
+            checks.append((k, v[1:], False))
+        else:
+            checks.append((k, v, True))
+
+    def predicate(record):
+        for k, v, equal in checks:
+            if k not in record.properties:
+                return False
+            if (record.properties[k] == v) != equal:
+                return False
+        return True
+
+    return predicate
+
+
+def compile_filters(
+    names=None,
+    tags="",
+    template="",
+    properties=(),
+    updatable=False,
+    outdated=None,
+):
+    """Build the FilterPipeline for a VM selection.
+
+    :param names: keep only these VM names (``None`` keeps all).
+    :param tags: keep only VMs this tag expression selects (see tags.py).
+    :param template: keep only VMs based on this TemplateVM.
+    :param properties: ``(key, value)`` pairs; a value prefixed with ``!``
+        negates the comparison.
+    :param updatable: keep only VMs with ``updates-available`` set.
+    :param outdated: if given, a callable ``record -> bool`` reporting whether
+        the VM's volumes are outdated; it only runs on running AppVMs/DispVMs
+        that passed every other stage. If it has a ``prepare`` method (as
+        ``OutdatedIndex`` does), that gets those VMs all at once first.
+    """
+    stages = []
+    if names is not None:
+        wanted = set(names)
+        stages.append(Stage("name", NAME, lambda r: r.name in wanted))
+    if tags:
+        expression = TagExpression(tags)
+        stages.append(
+            Stage("tags", TAGS, lambda r: expression.matches(r.tags), load={"tags": True})
+        )
+    property_checks = list(properties)
+    if template:
+        property_checks.insert(0, ("template", template))
+    if property_checks:
+        stages.append(
+            Stage(
+                "properties",
+                PROPERTIES,
+                _property_predicate(property_checks),
+                load={"properties": True},
+            )
+        )
+    if updatable:
+        stages.append(
+            Stage(
+                "features",
+                FEATURES,
+                lambda r: r.features.get("updates-available", "0") == "1",
+                load={"features": ("updates-available",)},
+            )
+        )
+    if outdated is not None:
+        # Class and power state come free with admin.vm.List, so only running
+        # AppVMs/DispVMs ever reach the volume walk.
+        stages.append(
+            Stage(
+                "volumes",
+                VOLUMES,
+                lambda r: r.klass in ("AppVM", "DispVM") and r.is_running() and outdated(r),
+                prepare=getattr(outdated, "prepare", None),
+            )
+        )
+    return FilterPipeline(stages)
@@ -0,0 +1,63 @@
+"""Declarative fleet files for ``hexagon reconcile --config``.
+
+A fleet file declares every VM hexagon manages and its desired config, in the
+same keys ``reconcile --property`` takes::
+
+    defaults:            # optional, merged under every VM
+      template: fedora-43
+    vms:
+      sys-net:
+        provides_network: true
+      work:
+        netvm: sys-firewall
+        label: blue
+
+After a VM reconciles cleanly -- its changes applied and, if it had to
+reboot, started again -- hexagon stores a hash of the config it applied in
+the VM's ``hexagon-config-hash`` feature. The next run compares that with
+the hash of the VM's current declaration and skips the VM outright when they
+match -- one feature read, rather than a full property diff, for each VM
+nobody touched. Changes made outside hexagon (``qvm-prefs`` in dom0) aren't
+noticed for such VMs; ``reconcile --force`` diffs them all anyway.
+"""
+
+import hashlib
+import json
+
+FEATURE = "hexagon-config-hash"
+
+
+def fleet_configs(cfg, source="fleet file"):
+    """``{name: desired config}`` from a loaded fleet file.
+
+    :raises ValueError: if ``cfg`` isn't shaped like a fleet file.
+    """
+    if not isinstance(cfg, dict) or not isinstance(cfg.get("vms"), dict):
+        raise ValueError("{}: expected a 'vms' mapping of VM name to config".format(source))
+    defaults = cfg.get("defaults") or {}
+    if not isinstance(defaults, dict):
+        raise ValueError("{}: 'defaults' must be a mapping".format(source))
+    configs = {}
+    for name, config in cfg["vms"].items():
+        config = config or {}
+        if not isinstance(config, dict):
+            raise ValueError("{}: config for '{}' must be a mapping".format(source, name))
+        configs[str(name)] = {**defaults, **config}
+    return configs
+
+
+def config_hash(config):
+    """Content hash of a desired config. Values are compared as strings when
+    reconciling, so ``vcpus: 2`` and ``vcpus: "2"`` hash alike."""
+    canonical = json.dumps({str(k): str(v) for k, v in config.items()}, sort_keys=True)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def unchanged(snapshot, configs):
+    """Names in ``configs`` whose stored hash matches their declaration.
+
+    Reads only the ``FEATURE`` feature of each existing VM, via the snapshot.
+    """
+    records = [snapshot[n] for n in configs if n in snapshot]
+    snapshot.load_feature(records, FEATURE)
+    return [r.name for r in records if r.features.get(FEATURE) == config_hash(configs[r.name])]
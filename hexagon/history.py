@@ -0,0 +1,147 @@
+"""Per-VM shutdown and start durations, learned from past runs.
+
+A fixed kill timeout is wrong both ways: a DispVM that halts in two seconds
+waits out the full timeout when it hangs, and a StandaloneVM that takes
+forty gets killed mid-shutdown. ``DurationHistory`` keeps the last few
+measured durations of each VM's operations and derives from them:
+
+  * ``timeout``: twice the slowest recent halt plus a margin, clamped to
+    [``MIN_TIMEOUT``, ``MAX_TIMEOUT``]; VMs with no history keep the old
+    fixed default. A halt that ended in a kill is recorded at the timeout it
+    hit, so a VM that keeps overrunning gets more time, up to the cap.
+  * ``estimate``: the median recent duration, for ``longest_first``, which
+    orders each wave so the longest jobs start first. With a concurrency cap
+    (or rolling batches) that's the classic longest-processing-time rule: a
+    long job can't end up starting last and stretching the whole run.
+
+The history is ``$XDG_CACHE_HOME/hexagon/durations.json``, written atomically
+at the end of a run and merged with whatever other runs wrote meanwhile.
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+
+FORMAT_VERSION = 1
+
+SHUTDOWN = "shutdown"
+START = "start"
+
+# Recent samples kept per VM and operation.
+SAMPLES = 10
+
+DEFAULT_TIMEOUT = 30
+MIN_TIMEOUT = 10
+MAX_TIMEOUT = 180
+
+
+def _median(samples):
+    ordered = sorted(samples)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2
+
+
+class DurationHistory(object):
+    """Recent operation durations per VM.
+
+    :param path: directory holding ``durations.json`` [default: the cache dir].
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            from .cache import default_cache_dir
+
+            path = default_cache_dir()
+        self.path = path
+        self._lock = threading.Lock()
+        self._recorded = {}
+        self._samples = self._read()
+
+    def __repr__(self):
+        return "<DurationHistory: {} VMs>".format(len(self._samples))
+
+    @property
+    def history_file(self):
+        return os.path.join(self.path, "durations.json")
+
+    def _read(self):
+        try:
+            with open(self.history_file) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get("version") != FORMAT_VERSION:
+            return {}
+        return data["vms"]
+
+    def samples(self, name, op):
+        """Recorded durations of ``op`` on ``name``, oldest first."""
+        with self._lock:
+            return list(self._samples.get(name, {}).get(op, ()))
+
+    def record(self, name, op, seconds):
+        with self._lock:
+            for samples in (self._samples, self._recorded):
+                durations = samples.setdefault(name, {}).setdefault(op, [])
+                durations.append(round(seconds, 1))
+                del durations[:-SAMPLES]
+
+    def estimate(self, name, op):
+        """Median recent duration of ``op`` on ``name``, or None if unknown."""
+        samples = self.samples(name, op)
+        return _median(samples) if samples else None
+
+    def timeout(self, name, default=DEFAULT_TIMEOUT):
+        """Seconds to wait for ``name`` to halt before killing it."""
+        samples = self.samples(name, SHUTDOWN)
+        if not samples:
+            return default
+        return min(MAX_TIMEOUT, max(MIN_TIMEOUT, 2 * max(samples) + 5))
+
+    def cost(self, *ops):
+        """``name -> seconds``: the summed estimates of ``ops``. VMs with no
+        history count as longest."""
+
+        def cost(name):
+            estimates = [self.estimate(name, op) for op in ops]
+            if None in estimates:
+                return float("inf")
+            return sum(estimates)
+
+        return cost
+
+    def longest_first(self, waves, *ops):
+        """``waves`` with each wave ordered by ``cost(*ops)``, longest first;
+        ties keep their order."""
+        cost = self.cost(*ops)
+        return [sorted(wave, key=cost, reverse=True) for wave in waves]
+
+    def save(self):
+        """Merge this run's samples into the file, if there are any."""
+        with self._lock:
+            recorded, self._recorded = self._recorded, {}
+        if not recorded:
+            return
+        merged = self._read()
+        for name, ops in recorded.items():
+            for op, durations in ops.items():
+                saved = merged.setdefault(name, {}).setdefault(op, [])
+                saved.extend(durations)
+                del saved[:-SAMPLES]
+        data = {"version": FORMAT_VERSION, "vms": merged}
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".durations-")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(data, f, separators=(",", ":"))
+                os.replace(tmp, self.history_file)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+        except OSError as e:
+            logging.debug("Could not save operation durations: {}".format(repr(e)))
@@ -0,0 +1,121 @@
+"""Template-keyed detection of VMs that need a reboot to pick up updates.
+
+``HexagonQube.is_outdated`` walks every volume of a running AppVM/DispVM --
+``admin.vm.volume.List`` plus an ``admin.vm.volume.Info`` per volume -- so
+``ls --outdated`` and ``reboot --outdated`` cost O(VMs x volumes) calls. Yet a
+VM's volumes can only go stale one way: its ``snap_on_start`` volumes were
+snapshotted from its template when it started, and the template has committed
+a new revision since. So among the running children of one template, a child
+is outdated exactly when it started before that template's last commit, and
+sorting the children by ``start_time`` puts every outdated one first.
+
+``OutdatedIndex`` groups the VMs it's asked about by template, and finds each
+group's boundary with a binary search, checking volumes of O(log n) children
+per template instead of all of them. Boundaries are remembered per template,
+so later questions about the same template's children are answered by
+comparing start times. VMs without a readable ``template`` or ``start_time``
+fall back to the full per-volume check.
+"""
+
+import logging
+
+
+def _start_time(record):
+    try:
+        return float(record.properties.get("start_time"))
+    except (TypeError, ValueError):
+        return None
+
+
+class OutdatedIndex(object):
+    """A ``record -> bool`` outdated check, memoized per template.
+
+    :param snapshot: the ``FleetSnapshot`` the records come from; the index
+        loads their properties from it as needed.
+    :param check: ``name -> bool``, the per-volume check for one VM.
+    """
+
+    def __init__(self, snapshot, check):
+        self.snapshot = snapshot
+        self.check = check
+        self.checked = 0
+        # template -> [latest start time known outdated, earliest known fresh]
+        self._bounds = {}
+        self._known = {}
+
+    def __repr__(self):
+        return "<OutdatedIndex: {} templates, {} volume checks>".format(
+            len(self._bounds), self.checked
+        )
+
+    def __call__(self, record):
+        if record.name not in self._known:
+            self.prepare([record])
+        return self._known[record.name]
+
+    def _check(self, name):
+        self.checked += 1
+        self._known[name] = self.check(name)
+        return self._known[name]
+
+    def prepare(self, records, reload=True):
+        """Decide every running AppVM/DispVM among ``records`` at once, so the
+        children of one template share the volume checks.
+
+        :param reload: re-read the candidates' properties first. A cached
+            snapshot keeps properties across restarts, and a stale
+            ``start_time`` would misplace a VM in its template's order.
+        """
+        candidates = [
+            r
+            for r in records
+            if r.name not in self._known and r.klass in ("AppVM", "DispVM") and r.is_running()
+        ]
+        pending = {r.name for r in candidates}
+        for r in records:
+            if r.name not in self._known and r.name not in pending:
+                self._known[r.name] = False
+        if reload:
+            for r in candidates:
+                r.properties = None
+        self.snapshot.load(candidates, properties=True)
+        children = {}
+        for r in candidates:
+            template = r.properties.get("template")
+            start = _start_time(r)
+            if template in (None, "", "None") or start is None:
+                self._check(r.name)
+            else:
+                children.setdefault(template, []).append((start, r.name))
+        for template, group in children.items():
+            self._resolve(template, sorted(group))
+
+    def _resolve(self, template, group):
+        bounds = self._bounds.setdefault(template, [None, None])
+        # What earlier searches already settled costs nothing.
+        unknown = []
+        for start, name in group:
+            if bounds[0] is not None and start <= bounds[0]:
+                self._known[name] = True
+            elif bounds[1] is not None and start >= bounds[1]:
+                self._known[name] = False
+            else:
+                unknown.append((start, name))
+        # Outdated children form a prefix of ``unknown``: find its length.
+        lo, hi = 0, len(unknown)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, name = unknown[mid]
+            if self._check(name):
+                bounds[0] = start if bounds[0] is None else max(bounds[0], start)
+                lo = mid + 1
+            else:
+                bounds[1] = start if bounds[1] is None else min(bounds[1], start)
+                hi = mid
+        for i, (_start, name) in enumerate(unknown):
+            self._known.setdefault(name, i < lo)
+        logging.debug(
+            "Template '{}': {} of {} running children outdated".format(
+                template, sum(self._known[n] for _s, n in group), len(group)
+            )
+        )
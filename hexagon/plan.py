@@ -0,0 +1,381 @@
+"""Plan a ``reconcile`` from one bulk snapshot, and keep the plan for later.
+
+``HexagonQube.changes_required`` compares each desired key with
+``str(getattr(vm, key))`` -- a qrexec round trip per key per VM -- and
+``reconcile`` then reads power state and volumes again, so diffing dominates a
+fleet-wide reconcile. ``plan_reconcile`` diffs every target against one
+``FleetSnapshot`` instead (one ``property.GetAll`` per VM, read in parallel)
+and records, per VM, the changes to apply and whether a reboot or rebuild is
+needed.
+
+A ``ReconcilePlan`` round-trips through JSON: ``hexagon --dry-run reconcile
+--plan FILE ...`` prints and saves one, ``hexagon reconcile --plan FILE``
+applies it. The plan is stamped with the snapshot ``generation`` it was
+computed from; applying skips the diff only while the fleet is still at that
+generation (and the plan is no older than the cache trusts its own data),
+otherwise it re-plans from the same desired configs.
+
+Reconciling VMs one by one power-cycles each on its own schedule: a client
+can be cycled while its netvm is still up, then lose network again when the
+netvm goes down (or bring the netvm back up early, mid-reconcile). A
+``PowerPlan`` instead treats the batch as a whole: every VM that must reboot
+is halted once, clients before their netvms, changes are applied while
+everything is down, and each VM is started once, netvms first -- one
+power-cycle per netvm subtree, with each client's outage folded into its own
+cycle.
+"""
+
+import json
+import os
+import tempfile
+import time
+
+from .qmgr import CONFIG_DEFAULTS, VMConfigChange
+
+FORMAT_VERSION = 2
+
+
+class VMPlan(object):
+    """What reconciling one VM will do.
+
+    :param name: VM name.
+    :param desired: the desired config, as ``HexagonQube`` takes it.
+    :param exists: whether the VM exists (else it's created).
+    :param changes: ``(attribute, old value, new value, reboot required)``
+        tuples; values are strings as qubesd serializes them, old is None for
+        a VM that doesn't exist yet.
+    :param reboot: whether the VM must be halted before applying changes.
+    :param rebuild: whether the VM must be removed and recreated.
+    :param config_hash: for VMs declared in a fleet file, the hash to store
+        once the VM is reconciled (see fleet.py).
+    :param running: whether the VM was running when planned.
+    :param autostart: whether the VM should run once reconciled, whatever
+        its power state (its desired ``autostart``).
+    :param netvm: the VM's netvm when planned, or None.
+    """
+
+    def __init__(
+        self,
+        name,
+        desired,
+        exists=True,
+        changes=(),
+        reboot=False,
+        rebuild=False,
+        config_hash=None,
+        running=False,
+        autostart=False,
+        netvm=None,
+    ):
+        self.name = name
+        self.desired = dict(desired)
+        self.exists = exists
+        self.changes = [tuple(c) for c in changes]
+        self.reboot = reboot
+        self.rebuild = rebuild
+        self.config_hash = config_hash
+        self.running = running
+        self.autostart = autostart
+        self.netvm = netvm
+
+    def __repr__(self):
+        return "<VMPlan: {} changes={} reboot={}>".format(self.name, len(self.changes), self.reboot)
+
+    @property
+    def cycle(self):
+        """Whether the VM must be halted and started again."""
+        return self.exists and self.running and (self.reboot or self.rebuild)
+
+    @property
+    def start(self):
+        """Whether the VM must be started once its changes are applied."""
+        return self.cycle or (self.autostart and not self.running)
+
+    def netvm_after(self):
+        """The VM's netvm once its changes are applied."""
+        for attribute, _old, new, _reboot in self.changes:
+            if attribute == "netvm":
+                return new or None
+        return self.netvm
+
+    def config_changes(self):
+        """The changes as ``VMConfigChange``s, ready to ``apply``."""
+        return [VMConfigChange(a, old, new, reboot_required=r) for a, old, new, r in self.changes]
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "desired": self.desired,
+            "exists": self.exists,
+            "changes": [list(c) for c in self.changes],
+            "reboot": self.reboot,
+            "rebuild": self.rebuild,
+            "config_hash": self.config_hash,
+            "running": self.running,
+            "autostart": self.autostart,
+            "netvm": self.netvm,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+class ReconcilePlan(object):
+    """Per-VM reconcile plans computed from one snapshot.
+
+    :param vms: ``VMPlan``s, in the order they were requested.
+    :param generation: the snapshot generation the plan was computed from, or
+        None if it can't be compared across invocations (``--no-cache``).
+    :param created: Unix time the plan was computed.
+    """
+
+    def __init__(self, vms, generation=None, created=None):
+        self.vms = list(vms)
+        self.generation = generation
+        self.created = time.time() if created is None else created
+        self._by_name = {p.name: p for p in self.vms}
+
+    def __repr__(self):
+        return "<ReconcilePlan: {} VMs, generation={}>".format(len(self.vms), self.generation)
+
+    def __getitem__(self, name):
+        return self._by_name[name]
+
+    def names(self):
+        return [p.name for p in self.vms]
+
+    def desired(self):
+        """``{name: desired config}``, to re-plan from."""
+        return {p.name: p.desired for p in self.vms}
+
+    def power(self):
+        """The batch's PowerPlan."""
+        return PowerPlan(self.vms)
+
+    def is_current(self, generation, max_age):
+        """Whether the plan still describes a fleet at ``generation``."""
+        return (
+            self.generation is not None
+            and self.generation == generation
+            and time.time() - self.created < max_age
+        )
+
+    def format(self):
+        """Human-readable summary, one line per VM."""
+        lines = ["Reconcile plan ({} VMs, generation {}):".format(len(self.vms), self.generation)]
+        for p in self.vms:
+            steps = [] if p.exists else ["create {}".format(p.desired.get("klass", "AppVM"))]
+            if p.rebuild:
+                steps.append("rebuild")
+            if p.reboot:
+                steps.append("reboot")
+            steps += [
+                "{}: {} -> {}".format(attribute, old, new) for attribute, old, new, _r in p.changes
+            ]
+            lines.append("  {}: {}".format(p.name, "; ".join(steps) or "no changes"))
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self):
+        return {
+            "version": FORMAT_VERSION,
+            "generation": self.generation,
+            "created": self.created,
+            "vms": [p.to_dict() for p in self.vms],
+        }
+
+    def save(self, path):
+        """Atomically write the plan to ``path`` as JSON."""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".plan-")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+                f.write("\n")
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """Read a plan written by ``save``.
+
+        :raises OSError: if the file can't be read.
+        :raises ValueError: if the file isn't a plan this version understands.
+        """
+        with open(path) as f:
+            data = json.load(f)
+        if not isinstance(data, dict) or data.get("version") != FORMAT_VERSION:
+            raise ValueError(
+                "not a hexagon reconcile plan (version {}): {}".format(FORMAT_VERSION, path)
+            )
+        try:
+            return cls(
+                [VMPlan.from_dict(v) for v in data["vms"]],
+                generation=data["generation"],
+                created=data["created"],
+            )
+        except (KeyError, TypeError) as e:
+            raise ValueError("malformed reconcile plan {}: {}".format(path, repr(e))) from None
+
+
+def _changes(changes):
+    return [(c.attribute, c.old_value, c.new_value, c.reboot_required) for c in changes]
+
+
+def _vm_value(value):
+    # Unset VM-typed properties serialize as "None" (see snapshot.py).
+    return None if value in (None, "", "None") else str(value)
+
+
+def _outdated(record, outdated):
+    return record.klass in ("AppVM", "DispVM") and record.is_running() and outdated(record)
+
+
+def plan_vm(name, record, config, outdated=None):
+    """Diff one VM's snapshot ``record`` (None if it doesn't exist yet)
+    against ``config``, as ``HexagonQube.changes_required`` does against the
+    live VM."""
+    if record is None:
+        desired = {**CONFIG_DEFAULTS, **config}
+        # "klass" is handled by creating the VM.
+        changes = [VMConfigChange(k, None, v) for k, v in desired.items() if k != "klass"]
+        return VMPlan(
+            name,
+            desired,
+            exists=False,
+            changes=_changes(changes),
+            autostart=str(desired.get("autostart")) == "True",
+        )
+    changes = []
+    for k, v in config.items():
+        actual = record.properties.get(k)
+        if actual != str(v):
+            changes.append(VMConfigChange(k, actual, v))
+    reboot = any(c.reboot_required for c in changes)
+    if not reboot and outdated is not None:
+        reboot = _outdated(record, outdated)
+    return VMPlan(
+        name,
+        config,
+        changes=_changes(changes),
+        reboot=reboot,
+        running=record.is_running(),
+        autostart=str(config.get("autostart", record.properties.get("autostart"))) == "True",
+        netvm=_vm_value(record.properties.get("netvm")),
+    )
+
+
+def plan_reconcile(snapshot, configs, outdated=None, generation=None, hashes=None):
+    """Plan reconciling ``configs`` (``{name: desired config}``) against
+    ``snapshot``, re-reading every target's properties in one parallel pass.
+
+    :param outdated: ``record -> bool``, whether a running AppVM/DispVM needs
+        a reboot to pick up its template's updates (``HexagonQube.is_outdated``,
+        or an ``OutdatedIndex``, prepared with all the targets it must decide).
+    :param generation: stamped on the plan; see ``ReconcilePlan.is_current``.
+    :param hashes: ``{name: config hash}`` to store on each VM once applied.
+    :raises Exception: if a desired template doesn't exist, as
+        ``HexagonQube`` would.
+    """
+    targets = [snapshot[n] for n in configs if n in snapshot]
+    # Re-read what we diff against, even from a warm cache: a change made
+    # while nothing was listening must not make a needed write look done.
+    for record in targets:
+        record.properties = None
+    snapshot.load(targets, properties=True)
+    plans = []
+    for name, config in configs.items():
+        record = snapshot[name] if name in snapshot else None
+        plan = plan_vm(name, record, config)
+        plan.config_hash = (hashes or {}).get(name)
+        template = plan.desired.get("template")
+        if template and template not in snapshot:
+            raise Exception("Target TemplateVM does not exist: {}".format(template))
+        plans.append(plan)
+    if outdated is not None:
+        # Only VMs no change reboots anyway need their volumes checked.
+        pending = [p for p in plans if p.exists and not p.reboot]
+        records = [snapshot[p.name] for p in pending]
+        if hasattr(outdated, "prepare"):
+            outdated.prepare(records, reload=False)
+        for p, record in zip(pending, records):
+            p.reboot = _outdated(record, outdated)
+    return ReconcilePlan(plans, generation=generation)
+
+
+class PowerPlan(object):
+    """Power operations for a reconcile batch: who halts and starts, in what
+    order, and how many power-cycles that saves over per-VM reconciles.
+
+    :param vms: the batch's ``VMPlan``s.
+    """
+
+    def __init__(self, vms):
+        self.vms = {p.name: p for p in vms}
+        self.halt = [p.name for p in vms if p.cycle]
+        self.start = [p.name for p in vms if p.start]
+        # Only edges between VMs in the batch constrain the order.
+        self.before = {p.name: p.netvm if p.netvm in self.vms else None for p in vms}
+        self.after = {p.name: p.netvm_after() if p.netvm_after() in self.vms else None for p in vms}
+        self.subtrees = {}
+        cycled = set(self.halt)
+        above = {name: self._above(name) for name in self.halt}
+        for name in self.halt:
+            roots = [netvm for netvm in above[name] if netvm in cycled]
+            self.subtrees.setdefault(roots[-1] if roots else name, []).append(name)
+        # Reconciled one at a time in batch order, each VM cycles itself, and
+        # every cycled VM below it that came back up earlier has its network
+        # cut and must cycle again. The batch halts and starts each VM once.
+        self.per_vm_halts = len(self.halt)
+        for i, name in enumerate(self.halt):
+            self.per_vm_halts += sum(1 for done in self.halt[:i] if name in above[done])
+        self.per_vm_starts = self.per_vm_halts + len(self.start) - len(self.halt)
+        self.avoided = self.per_vm_halts - len(self.halt)
+
+    def _above(self, name):
+        """The batch netvms ``name``'s network goes through now, nearest first."""
+        chain, netvm = [], self.before[name]
+        while netvm is not None and netvm != name and netvm not in chain:
+            chain.append(netvm)
+            netvm = self.before[netvm]
+        return chain
+
+    def __repr__(self):
+        return "<PowerPlan: {} halts, {} starts, {} avoided>".format(
+            len(self.halt), len(self.start), self.avoided
+        )
+
+    @staticmethod
+    def _only(waves, names):
+        names = set(names)
+        waves = [[n for n in wave if n in names] for wave in waves]
+        return [wave for wave in waves if wave]
+
+    def shutdown_waves(self):
+        """Halts, clients before their netvms."""
+        from .scheduler import WaveScheduler
+
+        return self._only(WaveScheduler(self.before).shutdown_waves(), self.halt)
+
+    def start_waves(self):
+        """Starts, netvms (as they'll be configured) before their clients."""
+        from .scheduler import WaveScheduler
+
+        return self._only(WaveScheduler(self.after).start_waves(), self.start)
+
+    def summary(self):
+        return "{} power-cycle(s) in {} netvm subtree(s), {} avoided by coalescing".format(
+            len(self.halt), len(self.subtrees), self.avoided
+        )
+
+    def format(self):
+        """Human-readable summary of the power operations."""
+        lines = ["Power: {}".format(self.summary())]
+        for root, names in sorted(self.subtrees.items()):
+            lines.append("  {}: {}".format(root, ", ".join(sorted(names))))
+        started = sorted(set(self.start) - set(self.halt))
+        if started:
+            lines.append("  start only: {}".format(", ".join(started)))
+        return "\n".join(lines) + "\n"
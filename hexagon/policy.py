@@ -10,7 +10,9 @@ stays with hexagon proper; Ansible only enforces config *inside* qubes.
 The policy body lives in a single Jinja2 template (``POLICY_TEMPLATE``) so the
 whole grant set is readable top-to-bottom; rendering is pure -- no Qubes, no
 I/O -- so it works anywhere and is unit-tested offline. The ``hexagon policy``
-subcommand prints the result for review before it's applied in dom0.
+subcommand prints the result for review before it's applied in dom0. The
+template is rendered through a plain-Python module compiled from it at build
+time (see policy_compiler.py), falling back to Jinja2 itself.
 
 Security model -- **tag-based**, so VMs opt in/out without touching the policy:
 
@@ -29,7 +31,8 @@ Security model -- **tag-based**, so VMs opt in/out without touching the policy:
     name per entry in ``admin_qubes`` (default: the local host).
 """
 
-import socket
+import functools
+import logging
 
 # Tag defaults. Overridable from the CLI.
 DEFAULT_ADMIN_TAG = "hexagon-admin"
@@ -37,15 +40,27 @@ DEFAULT_TARGET_TAG = "hexagon"
 DEFAULT_MGMT_DISPVM = "default-mgmt-dvm"
 DEFAULT_SYS_VMS = ["sys-net", "sys-firewall", "sys-usb"]
 
-# The admin qube(s) whose disp-mgmt VMs need created-by grants. Defaults to the
-# local host -- the common single-MgmtVM case. Multi-admin fleets pass more.
-DEFAULT_ADMIN_QUBES = [socket.gethostname()]
+
+def default_admin_qubes():
+    """The admin qube(s) whose disp-mgmt VMs need created-by grants: the local
+    host -- the common single-MgmtVM case. Multi-admin fleets pass more.
+
+    Resolved on use rather than at import, so importing the CLI stays cheap.
+    """
+    import socket
+
+    return [socket.gethostname()]
+
 
 # Column width for the service name in a rendered rule; the widest service we
 # emit is ``ansible.CreateManagementPolicies`` (32). The ``rule`` macro pads to
 # this so the columns line up regardless of service length.
 _SVC_W = 32
 
+# Environment options for POLICY_TEMPLATE, shared by the Jinja2 path and the
+# compiled renderer so both produce the same bytes.
+JINJA_OPTIONS = {"trim_blocks": True, "lstrip_blocks": True, "keep_trailing_newline": True}
+
 # One editable source of truth for the whole policy. The ``rule`` macro renders
 # a single qrexec line (SERVICE ARG SOURCE TARGET ACTION), padding SERVICE/ARG
 # so columns align. ``admin`` is @tag:hexagon-admin (source); ``target`` is
@@ -67,18 +82,28 @@ POLICY_TEMPLATE = """\
 #
 # Columns:  SERVICE  ARGUMENT  SOURCE  TARGET  ACTION [params]
 
-# --- Visibility: list + read managed qubes. admin.vm.List needs TWO rules: the
-#     call is directed at dom0 (@adminvm), and qubesd then filters the returned
-#     list PER-VM, so a rule matching each managed VM is also required or
+# --- Visibility: list + read managed qubes. property.GetAll is hexagon's bulk
+#     read (one call per VM); volume.List/Info tell `--outdated` which VMs run
+#     on a stale template. admin.vm.List needs TWO rules: the call is directed
+#     at dom0 (@adminvm), and qubesd then filters the returned list PER-VM, so
+#     a rule matching each managed VM is also required or
 #     `app.domains.get(<host>)` returns None ("Host not found").
 {{ rule('admin.vm.List', admin, '@adminvm', 'allow target=dom0') -}}
 {{ rule('admin.vm.List', admin, target, 'allow target=dom0') -}}
 {{ rule('admin.vm.CurrentState', admin, target, 'allow target=dom0') -}}
 {{ rule('admin.vm.property.Get', admin, target, 'allow target=dom0') -}}
+{{ rule('admin.vm.property.GetAll', admin, target, 'allow target=dom0') -}}
 {{ rule('admin.vm.property.List', admin, target, 'allow target=dom0') -}}
 {{ rule('admin.vm.feature.Get', admin, target, 'allow target=dom0') -}}
 {{ rule('admin.vm.tag.Get', admin, target, 'allow target=dom0') -}}
-{{ rule('admin.vm.tag.List', admin, target, 'allow target=dom0') }}
+{{ rule('admin.vm.tag.List', admin, target, 'allow target=dom0') -}}
+{{ rule('admin.vm.volume.List', admin, target, 'allow target=dom0') -}}
+{{ rule('admin.vm.volume.Info', admin, target, 'allow target=dom0') }}
+# --- Event stream: hexagon waits for halts and starts on admin.Events instead
+#     of polling. Like admin.vm.List, the call is directed at dom0 and qubesd
+#     filters the events PER-VM, so it needs both rules too. ---
+{{ rule('admin.Events', admin, '@adminvm', 'allow target=dom0') -}}
+{{ rule('admin.Events', admin, target, 'allow target=dom0') }}
 # --- Qube lifecycle: create any, manage only @tag:{{ target_tag }} VMs ---
 {{ rule('admin.vm.Create.AppVM', admin, 'dom0', 'allow') -}}
 {{ rule('admin.vm.Create.StandaloneVM', admin, 'dom0', 'allow') -}}
@@ -91,6 +116,9 @@ POLICY_TEMPLATE = """\
 {{ rule('admin.vm.feature.Set', admin, target, 'allow target=dom0') -}}
 {{ rule('admin.vm.tag.Set', admin, target, 'allow target=dom0') -}}
 {{ rule('admin.vm.tag.Remove', admin, target, 'allow target=dom0') }}
+# --- `start --wait-ready`: qubes.WaitForSession returns once the VM's user
+#     session is up. A regular qrexec call into the managed VM (no target=). ---
+{{ rule('qubes.WaitForSession', admin, target, 'allow') }}
 # --- Clone base templates: tag any TemplateVM @tag:{{ target_tag }} to permit
 #     cloning it (StandaloneVM / new TemplateVM creation). No name list -- the
 #     managed tag doubles as the "cloneable source" tag. Reads on these are
@@ -159,21 +187,9 @@ def render_policy(
         each target's disposable from.
     :returns: the policy file body, ready to write to dom0.
     """
-    admin_qubes = list(admin_qubes) if admin_qubes is not None else list(DEFAULT_ADMIN_QUBES)
+    admin_qubes = list(admin_qubes) if admin_qubes is not None else default_admin_qubes()
     sys_vms = list(sys_vms) if sys_vms is not None else list(DEFAULT_SYS_VMS)
-
-    try:
-        import jinja2
-    except ImportError as exc:
-        raise RuntimeError(
-            "jinja2 is required for the 'hexagon policy' command. "
-            "Install it with: dnf install python3-jinja2"
-        ) from exc
-
-    template = jinja2.Template(
-        POLICY_TEMPLATE, trim_blocks=True, lstrip_blocks=True, keep_trailing_newline=True
-    )
-    return template.render(
+    context = dict(
         admin_tag=admin_tag,
         target_tag=target_tag,
         admin="@tag:{}".format(admin_tag),
@@ -183,3 +199,43 @@ def render_policy(
         mgmt_dispvm=mgmt_dispvm,
         svc_w=_SVC_W,
     )
+    render = compiled_renderer()
+    if render is not None:
+        return render(**context)
+    return _render_jinja(context)
+
+
+def _render_jinja(context):
+    try:
+        import jinja2
+    except ImportError as exc:
+        raise RuntimeError(
+            "jinja2 is required for the 'hexagon policy' command. "
+            "Install it with: dnf install python3-jinja2"
+        ) from exc
+
+    template = jinja2.Template(POLICY_TEMPLATE, **JINJA_OPTIONS)
+    return template.render(**context)
+
+
+@functools.cache
+def compiled_renderer():
+    """The ahead-of-time compiled renderer for POLICY_TEMPLATE, or None.
+
+    Only the module generated at build time (``hexagon/_policy_compiled.py``)
+    is used, and only if it was compiled from the current template. Nothing is
+    compiled or loaded from a user-writable location at run time: the output is
+    a dom0 security policy. Without a current build-time module, None, and
+    ``render_policy`` uses Jinja2.
+    """
+    try:
+        from . import _policy_compiled
+    except ImportError:
+        return None
+    from . import policy_compiler
+
+    expected = policy_compiler.source_hash(POLICY_TEMPLATE, JINJA_OPTIONS)
+    if _policy_compiled.SOURCE_HASH != expected:
+        logging.debug("Compiled policy renderer is stale; rendering with Jinja2")
+        return None
+    return _policy_compiled.render
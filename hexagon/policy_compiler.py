@@ -0,0 +1,310 @@
+"""Compile ``policy.POLICY_TEMPLATE`` ahead of time into a plain-Python renderer.
+
+``jinja2.Template(...)`` lexes, parses and compiles the template on every
+``render_policy`` call, and importing jinja2 alone costs more than rendering
+does. This module walks the template's Jinja2 AST once and emits a module with
+a single ``render(**context)`` function: string appends, ``%`` formatting,
+plain ``for`` loops and nested functions for macros -- no jinja2 at runtime.
+
+The Jinja2 template stays the source of truth. The generated module records
+a hash of the template, the environment options and this compiler
+(``SOURCE_HASH``); ``policy.render_policy`` only uses a renderer whose hash
+matches, so editing the template can never serve stale output. The renderer
+is generated at build time only (flake.nix), into ``hexagon/_policy_compiled.py``
+inside the package; it is never compiled or loaded from a user-writable cache,
+since its output is a dom0 policy. Without it, ``render_policy`` uses Jinja2.
+
+Only the constructs the template uses are supported: output, macros, ``for``,
+``if``, ``set``, ``~``, the ``format`` filter, calls, comparisons and boolean
+operators. Anything else raises ``CompileError`` and ``render_policy`` falls
+back to Jinja2; ``tests/test_policy_compiler.py`` proves the two byte-identical.
+
+Usage (build time)::
+
+    python3 -m hexagon.policy_compiler hexagon/_policy_compiled.py
+"""
+
+import hashlib
+import os
+import sys
+
+# Bump when the generated code changes for the same template.
+COMPILER_VERSION = 1
+
+_BINOPS = {"Add": "+", "Sub": "-", "Mul": "*", "Div": "/", "FloorDiv": "//", "Mod": "%"}
+_CMPOPS = {
+    "eq": "==",
+    "ne": "!=",
+    "lt": "<",
+    "lteq": "<=",
+    "gt": ">",
+    "gteq": ">=",
+    "in": "in",
+    "notin": "not in",
+}
+
+
+class CompileError(Exception):
+    """The template uses a construct this compiler doesn't handle."""
+
+
+def source_hash(source, options):
+    """Identify a template + environment options + compiler version."""
+    h = hashlib.sha256()
+    h.update(source.encode())
+    h.update(repr(sorted(options.items())).encode())
+    h.update(str(COMPILER_VERSION).encode())
+    return h.hexdigest()
+
+
+class _Compiler(object):
+    def __init__(self):
+        self.lines = []
+        self.indent = 0
+        # Stack of {template name: python identifier}; innermost last.
+        self.scopes = []
+        self.counter = 0
+
+    def emit(self, line):
+        self.lines.append("    " * self.indent + line)
+
+    def lookup(self, name):
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name]
+        raise CompileError("unresolved name: {}".format(name))
+
+    def bind(self, name, param=False):
+        """A Python identifier for template name ``name`` in the innermost
+        scope. Macro parameters keep their name, so callers can pass them by
+        keyword; everything else is numbered, so a loop-local ``set`` can't
+        clobber a same-named variable outside the loop."""
+        if param:
+            ident = "l_" + name
+        else:
+            self.counter += 1
+            ident = "l_{}_{}".format(name, self.counter)
+        self.scopes[-1][name] = ident
+        return ident
+
+    # --- statements ---------------------------------------------------------
+
+    def template(self, ast):
+        import jinja2.meta
+        import jinja2.nodes as nodes
+
+        self.emit("def render(**_ctx):")
+        self.indent += 1
+        self.emit("_out = []")
+        self.emit("_w = _out.append")
+        self.scopes.append({})
+        # Free variables come from the render context; undefined ones render
+        # as "", like Jinja's default Undefined.
+        for name in sorted(jinja2.meta.find_undeclared_variables(ast)):
+            self.emit("{} = _ctx.get({!r}, '')".format(self.bind(name), name))
+        # Macros are callable from anywhere in the template, so bind them all
+        # before emitting any output.
+        for node in ast.body:
+            if isinstance(node, nodes.Macro):
+                self.bind(node.name)
+        self.statements(ast.body)
+        self.emit("return ''.join(_out)")
+        self.scopes.pop()
+        self.indent -= 1
+
+    def statements(self, body):
+        if not body:
+            self.emit("pass")
+        for node in body:
+            method = getattr(self, "stmt_" + type(node).__name__, None)
+            if method is None:
+                raise CompileError("unsupported statement: {}".format(type(node).__name__))
+            method(node)
+
+    def stmt_Output(self, node):
+        import jinja2.nodes as nodes
+
+        for child in node.nodes:
+            if isinstance(child, nodes.TemplateData):
+                self.emit("_w({!r})".format(child.data))
+            else:
+                self.emit("_w(str({}))".format(self.expr(child)))
+
+    def stmt_Macro(self, node):
+        if node.name == "caller" or _references(node, ("varargs", "kwargs", "caller")):
+            raise CompileError("macro uses caller/varargs/kwargs: {}".format(node.name))
+        ident = self.scopes[-1].get(node.name) or self.bind(node.name)
+        # Defaults are evaluated in the enclosing scope, like Jinja does.
+        defaults = [self.expr(d) for d in node.defaults]
+        self.scopes.append({})
+        params = [self.bind(a.name, param=True) for a in node.args]
+        offset = len(params) - len(defaults)
+        signature = [
+            p if i < offset else "{}={}".format(p, defaults[i - offset])
+            for i, p in enumerate(params)
+        ]
+        self.emit("def {}({}):".format(ident, ", ".join(signature)))
+        self.indent += 1
+        self.emit("_out = []")
+        self.emit("_w = _out.append")
+        self.statements(node.body)
+        self.emit("return ''.join(_out)")
+        self.indent -= 1
+        self.scopes.pop()
+
+    def stmt_For(self, node):
+        import jinja2.nodes as nodes
+
+        if node.else_ or node.test is not None or node.recursive:
+            raise CompileError("for-else, loop filters and recursive loops are unsupported")
+        if _references(node, ("loop",)):
+            raise CompileError("the loop variable is unsupported")
+        iterable = self.expr(node.iter)
+        # Loop bodies get their own scope: a `set` inside doesn't leak out.
+        self.scopes.append({})
+        if isinstance(node.target, nodes.Name):
+            target = self.bind(node.target.name)
+        elif isinstance(node.target, nodes.Tuple):
+            target = ", ".join(self.bind(n.name) for n in node.target.items)
+        else:
+            raise CompileError("unsupported loop target")
+        self.emit("for {} in {}:".format(target, iterable))
+        self.indent += 1
+        self.statements(node.body)
+        self.indent -= 1
+        self.scopes.pop()
+
+    def stmt_If(self, node):
+        self.emit("if {}:".format(self.expr(node.test)))
+        self.branch(node.body)
+        for elif_ in node.elif_:
+            self.emit("elif {}:".format(self.expr(elif_.test)))
+            self.branch(elif_.body)
+        if node.else_:
+            self.emit("else:")
+            self.branch(node.else_)
+
+    def branch(self, body):
+        self.indent += 1
+        self.statements(body)
+        self.indent -= 1
+
+    def stmt_Assign(self, node):
+        import jinja2.nodes as nodes
+
+        if not isinstance(node.target, nodes.Name):
+            raise CompileError("unsupported assignment target")
+        value = self.expr(node.node)
+        scope = self.scopes[-1]
+        ident = scope.get(node.target.name) or self.bind(node.target.name)
+        self.emit("{} = {}".format(ident, value))
+
+    # --- expressions --------------------------------------------------------
+
+    def expr(self, node):
+        kind = type(node).__name__
+        if kind in _BINOPS:
+            return "({} {} {})".format(self.expr(node.left), _BINOPS[kind], self.expr(node.right))
+        method = getattr(self, "expr_" + kind, None)
+        if method is None:
+            raise CompileError("unsupported expression: {}".format(kind))
+        return method(node)
+
+    def expr_Const(self, node):
+        return repr(node.value)
+
+    def expr_Name(self, node):
+        return self.lookup(node.name)
+
+    def expr_Concat(self, node):
+        return "''.join(({},))".format(
+            ", ".join("str({})".format(self.expr(n)) for n in node.nodes)
+        )
+
+    def expr_Filter(self, node):
+        if node.name != "format" or node.kwargs or node.dyn_args or node.dyn_kwargs:
+            raise CompileError("unsupported filter: {}".format(node.name))
+        args = "".join("{}, ".format(self.expr(a)) for a in node.args)
+        return "(str({}) % ({}))".format(self.expr(node.node), args)
+
+    def expr_Call(self, node):
+        if node.dyn_args or node.dyn_kwargs:
+            raise CompileError("*args/**kwargs calls are unsupported")
+        args = [self.expr(a) for a in node.args]
+        # Keyword arguments name macro parameters, which keep an ``l_`` prefix.
+        args += ["l_{}={}".format(k.key, self.expr(k.value)) for k in node.kwargs]
+        return "{}({})".format(self.expr(node.node), ", ".join(args))
+
+    def expr_Not(self, node):
+        return "(not {})".format(self.expr(node.node))
+
+    def expr_And(self, node):
+        return "({} and {})".format(self.expr(node.left), self.expr(node.right))
+
+    def expr_Or(self, node):
+        return "({} or {})".format(self.expr(node.left), self.expr(node.right))
+
+    def expr_Compare(self, node):
+        parts = [self.expr(node.expr)]
+        for op in node.ops:
+            if op.op not in _CMPOPS:
+                raise CompileError("unsupported comparison: {}".format(op.op))
+            parts += [_CMPOPS[op.op], self.expr(op.expr)]
+        return "({})".format(" ".join(parts))
+
+    def expr_Tuple(self, node):
+        return "({},)".format(", ".join(self.expr(n) for n in node.items))
+
+    def expr_List(self, node):
+        return "[{}]".format(", ".join(self.expr(n) for n in node.items))
+
+
+def _references(node, names):
+    import jinja2.nodes as nodes
+
+    return any(n.name in names for n in node.find_all(nodes.Name) if n.ctx == "load")
+
+
+def compile_template(source, options):
+    """Python source for a module rendering ``source`` like
+    ``jinja2.Environment(**options)`` would.
+
+    :raises CompileError: for constructs the compiler doesn't support.
+    """
+    import jinja2
+
+    ast = jinja2.Environment(**options).parse(source)
+    compiler = _Compiler()
+    compiler.template(ast)
+    header = [
+        "# Generated by hexagon.policy_compiler from policy.POLICY_TEMPLATE -- do not edit.",
+        "# Regenerate with: python3 -m hexagon.policy_compiler <output.py>",
+        "",
+        "SOURCE_HASH = {!r}".format(source_hash(source, options)),
+        "",
+        "",
+    ]
+    return "\n".join(header + compiler.lines) + "\n"
+
+
+def compile_policy():
+    """Python source of the renderer for ``policy.POLICY_TEMPLATE``."""
+    from . import policy
+
+    return compile_template(policy.POLICY_TEMPLATE, policy.JINJA_OPTIONS)
+
+
+def write_module(path, source):
+    """Atomically write renderer ``source`` to ``path``."""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp = "{}.tmp{}".format(path, os.getpid())
+    with open(tmp, "w") as f:
+        f.write(source)
+    os.replace(tmp, path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit("usage: python3 -m hexagon.policy_compiler OUTPUT.py")
+    write_module(sys.argv[1], compile_policy())
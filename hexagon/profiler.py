@@ -0,0 +1,168 @@
+"""Count and time every Admin API call a hexagon command makes (``--profile``).
+
+From a management qube each Admin API call is a qrexec round trip, so the
+number and cost of those calls decides how long a command takes. qubesadmin
+funnels every call -- domain listing, property reads, volume walks, power
+operations -- through ``app.qubesd_call``; ``Profiler.install`` wraps that one
+method on the session's app, so ``cli.main``, ``HexagonQube`` and the
+snapshot readers are all measured without changes of their own.
+
+Each call is recorded with its method, destination, argument, latency and
+the hexagon function that made it (the nearest caller outside qubesadmin).
+``report`` prints a per-method summary; ``to_dict`` is the same data, plus
+every call, for ``--profile-json``. Both are sorted by total time.
+"""
+
+import json
+import sys
+import threading
+import time
+
+
+class CallRecord(object):
+    __slots__ = ("method", "dest", "arg", "latency", "caller", "error")
+
+    def __init__(self, method, dest, arg, latency, caller, error=None):
+        self.method = method
+        self.dest = dest
+        self.arg = arg
+        self.latency = latency
+        self.caller = caller
+        self.error = error
+
+    def __repr__(self):
+        return "<CallRecord: {} {} {:.1f}ms>".format(self.method, self.dest, self.latency * 1e3)
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+
+def _caller(skip):
+    # The first frame that isn't the transport itself: qubesadmin's wrappers,
+    # or this module.
+    frame = sys._getframe(skip)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module != __name__ and module.split(".")[0] != "qubesadmin":
+            return "{}.{}".format(module, frame.f_code.co_name)
+        frame = frame.f_back
+    return "?"
+
+
+class Profiler(object):
+    """Records the Admin API calls made through one qubesadmin app."""
+
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.calls = []
+        self._lock = threading.Lock()
+        self._app = None
+        self._call = None
+        self._shadowed = False
+
+    def __repr__(self):
+        return "<Profiler: {} calls>".format(len(self.calls))
+
+    def install(self, app):
+        """Wrap ``app.qubesd_call`` until ``uninstall``."""
+        self._app = app
+        self._call = app.qubesd_call
+        self._shadowed = "qubesd_call" in vars(app)
+
+        def qubesd_call(dest, method, arg=None, payload=None, *args, **kwargs):
+            caller = _caller(2)
+            start = self.clock()
+            error = None
+            try:
+                return self._call(dest, method, arg, payload, *args, **kwargs)
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                latency = self.clock() - start
+                with self._lock:
+                    self.calls.append(CallRecord(method, dest, arg, latency, caller, error))
+
+        app.qubesd_call = qubesd_call
+        return self
+
+    def uninstall(self):
+        """Restore the app's own ``qubesd_call``."""
+        if self._app is not None:
+            if self._shadowed:
+                self._app.qubesd_call = self._call
+            else:
+                del self._app.qubesd_call
+            self._app = None
+
+    def summary(self):
+        """Per-method ``(method, calls, total, mean, max, {caller: calls})``
+        tuples, by descending total time."""
+        methods = {}
+        for c in self.calls:
+            methods.setdefault(c.method, []).append(c)
+        rows = []
+        for method, calls in methods.items():
+            latencies = [c.latency for c in calls]
+            callers = {}
+            for c in calls:
+                callers[c.caller] = callers.get(c.caller, 0) + 1
+            total = sum(latencies)
+            rows.append((method, len(calls), total, total / len(calls), max(latencies), callers))
+        rows.sort(key=lambda row: (-row[2], row[0]))
+        return rows
+
+    def to_dict(self):
+        return {
+            "calls": len(self.calls),
+            "total": sum(c.latency for c in self.calls),
+            "methods": [
+                {
+                    "method": method,
+                    "calls": n,
+                    "total": total,
+                    "mean": mean,
+                    "max": longest,
+                    "callers": callers,
+                }
+                for method, n, total, mean, longest, callers in self.summary()
+            ],
+            "records": [
+                c.to_dict() for c in sorted(self.calls, key=lambda c: c.latency, reverse=True)
+            ],
+        }
+
+    def format(self):
+        """Human-readable summary, one line per method."""
+        data = self.to_dict()
+        lines = [
+            "Admin API calls: {} in {:.1f}ms".format(data["calls"], data["total"] * 1e3),
+            "  {:<32} {:>6} {:>10} {:>9} {:>9}  top caller".format(
+                "method", "calls", "total ms", "mean ms", "max ms"
+            ),
+        ]
+        for row in data["methods"]:
+            caller = max(row["callers"].items(), key=lambda kv: (kv[1], kv[0]))[0]
+            lines.append(
+                "  {:<32} {:>6} {:>10.1f} {:>9.2f} {:>9.2f}  {}".format(
+                    row["method"],
+                    row["calls"],
+                    row["total"] * 1e3,
+                    row["mean"] * 1e3,
+                    row["max"] * 1e3,
+                    caller,
+                )
+            )
+        return "\n".join(lines) + "\n"
+
+    def report(self, stream=None, json_path=None):
+        """Print the summary, and the JSON dump to ``json_path`` (or after
+        the summary, if none)."""
+        stream = sys.stderr if stream is None else stream
+        stream.write(self.format())
+        dump = json.dumps(self.to_dict(), indent=2, sort_keys=True)
+        if json_path is None:
+            stream.write(dump + "\n")
+        else:
+            with open(json_path, "w") as f:
+                f.write(dump + "\n")
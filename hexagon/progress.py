@@ -0,0 +1,223 @@
+"""Stream fleet operation results as they complete, within a failure budget.
+
+The engines (``WaveScheduler.run``, ``AsyncEngine``) only hand results back
+once a wave is over, and a command used to report nothing until every VM was
+done. ``Progress.track`` wraps each phase's operation instead, so every VM is
+logged the moment it finishes, with a running count, throughput and ETA --
+whichever engine runs it.
+
+The same wrapper enforces ``--max-failures`` (``--fail-fast`` is
+``--max-failures 0``): once more VMs than that have failed, operations that
+haven't started yet raise ``Cancelled`` instead of running, and later phases
+cancel every VM. Operations already in flight finish; a half-done halt is
+worse than a slow one. ``format`` is the per-VM summary printed at the end.
+"""
+
+import logging
+import threading
+import time
+
+OK = "ok"
+FAILED = "failed"
+CANCELLED = "cancelled"
+SKIPPED = "skipped"
+
+
+class Cancelled(Exception):
+    """The failure budget ran out before this VM's operation started."""
+
+
+class Outcome(object):
+    __slots__ = ("phase", "name", "status", "duration", "error")
+
+    def __init__(self, phase, name, status, duration=0.0, error=None):
+        self.phase = phase
+        self.name = name
+        self.status = status
+        self.duration = duration
+        self.error = error
+
+    def __repr__(self):
+        return "<Outcome: {} {} {} {:.1f}s>".format(
+            self.phase, self.name, self.status, self.duration
+        )
+
+
+class Progress(object):
+    """Per-VM outcomes and timings of one command's phases.
+
+    :param max_failures: failures tolerated before queued work is cancelled;
+        ``None`` never cancels.
+    """
+
+    def __init__(self, max_failures=None, clock=time.monotonic):
+        self.max_failures = max_failures
+        self.clock = clock
+        self.phases = []
+        self.outcomes = {}
+        self._waves = {}
+        self._totals = {}
+        self._started = {}
+        self._done = {}
+        self._failed = set()
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Progress: {} outcomes, {} failed>".format(len(self.outcomes), self._failures)
+
+    @property
+    def stopped(self):
+        """Whether the failure budget is spent."""
+        return self.max_failures is not None and self._failures > self.max_failures
+
+    def track(self, phase, waves, func):
+        """Wrap ``func(name)``, an operation run over ``waves``."""
+        self._register(phase, waves)
+
+        def tracked(name, *args, **kwargs):
+            start = self._begin(phase, name)
+            try:
+                result = func(name, *args, **kwargs)
+            except Exception as e:
+                self._finish(phase, name, start, e)
+                raise
+            self._finish(phase, name, start, None)
+            return result
+
+        return tracked
+
+    def track_async(self, phase, waves, func):
+        """``track`` for a coroutine function."""
+        self._register(phase, waves)
+
+        async def tracked(name, *args, **kwargs):
+            start = self._begin(phase, name)
+            try:
+                result = await func(name, *args, **kwargs)
+            except Exception as e:
+                self._finish(phase, name, start, e)
+                raise
+            self._finish(phase, name, start, None)
+            return result
+
+        return tracked
+
+    def _register(self, phase, waves):
+        self.phases.append(phase)
+        self._waves[phase] = [n for wave in waves for n in wave]
+
+    def _begin(self, phase, name):
+        with self._lock:
+            if phase not in self._totals:
+                # VMs that failed an earlier phase never reach this one.
+                self._started[phase] = self.clock()
+                self._totals[phase] = sum(1 for n in self._waves[phase] if n not in self._failed)
+                self._done[phase] = {OK: 0, FAILED: 0, CANCELLED: 0}
+            if self.stopped:
+                self._record(Outcome(phase, name, CANCELLED), None)
+                raise Cancelled(name)
+        return self.clock()
+
+    def _finish(self, phase, name, start, error):
+        with self._lock:
+            status = OK if error is None else FAILED
+            self._record(Outcome(phase, name, status, self.clock() - start, error), error)
+            if error is not None:
+                self._failures += 1
+                if self.stopped:
+                    logging.error(
+                        "More than {} failures, cancelling queued operations".format(
+                            self.max_failures
+                        )
+                    )
+
+    def _record(self, outcome, error):
+        # Called with the lock held.
+        phase = outcome.phase
+        self.outcomes[(phase, outcome.name)] = outcome
+        if outcome.status != OK:
+            self._failed.add(outcome.name)
+        done = self._done[phase]
+        done[outcome.status] += 1
+        finished = done[OK] + done[FAILED]
+        elapsed = self.clock() - self._started[phase]
+        rate = finished / elapsed if elapsed > 0 else 0.0
+        remaining = self._totals[phase] - finished - done[CANCELLED]
+        line = "{} {}/{}: {} {} in {:.1f}s ({} failed, {:.2f} VMs/s".format(
+            phase,
+            finished + done[CANCELLED],
+            self._totals[phase],
+            outcome.name,
+            outcome.status,
+            outcome.duration,
+            done[FAILED],
+            rate,
+        )
+        if rate and remaining > 0 and not self.stopped:
+            line += ", ~{:.0f}s left".format(remaining / rate)
+        line += ")"
+        if error is not None:
+            line += ": {}".format(repr(error))
+        (logging.info if outcome.status == OK else logging.warning)(line)
+
+    def counts(self, phase):
+        """``{status: VMs}`` for ``phase``, including those it skipped."""
+        counts = {}
+        for name in self._waves.get(phase, ()):
+            status = self._status(phase, name)
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    def _status(self, phase, name):
+        outcome = self.outcomes.get((phase, name))
+        return SKIPPED if outcome is None else outcome.status
+
+    def format(self):
+        """Per-VM outcome and duration of every phase, slowest VMs first."""
+        members = {phase: set(self._waves[phase]) for phase in self.phases}
+        names = list(dict.fromkeys(n for phase in self.phases for n in self._waves[phase]))
+
+        totals = dict.fromkeys(names, 0.0)
+        for (_phase, name), outcome in self.outcomes.items():
+            totals[name] += outcome.duration
+
+        width = max([len(n) for n in names] + [2])
+        lines = [
+            "  ".join(
+                ["{:<{}}".format("VM", width)]
+                + ["{:<16}".format(p) for p in self.phases]
+                + ["{:>8}".format("total")]
+            )
+        ]
+        for name in sorted(names, key=lambda n: (-totals[n], n)):
+            cells = []
+            for phase in self.phases:
+                if name not in members[phase]:
+                    cells.append("{:<16}".format(""))
+                    continue
+                outcome = self.outcomes.get((phase, name))
+                if outcome is None or outcome.status not in (OK, FAILED):
+                    cells.append("{:<16}".format(self._status(phase, name)))
+                else:
+                    cell = "{} {:.1f}s".format(outcome.status, outcome.duration)
+                    cells.append("{:<16}".format(cell))
+            lines.append(
+                "  ".join(
+                    ["{:<{}}".format(name, width)] + cells + ["{:>7.1f}s".format(totals[name])]
+                )
+            )
+        for phase in self.phases:
+            counts = self.counts(phase)
+            lines.append(
+                "{}: {}".format(
+                    phase,
+                    ", ".join(
+                        "{} {}".format(counts[s], s)
+                        for s in (OK, FAILED, CANCELLED, SKIPPED)
+                        if counts.get(s)
+                    )
+                    or "nothing to do",
+                )
+            )
+        return "\n".join(lines) + "\n"
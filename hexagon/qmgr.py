@@ -2,28 +2,8 @@ import logging
 import subprocess
 import time
 
-
-try:
-    import qubesadmin
-
-    _HAS_QUBESADMIN = True
-    _QUBESADMIN_ERR = None
-except ImportError as exc:
-    _HAS_QUBESADMIN = False
-    _QUBESADMIN_ERR = exc
-
-
-def _qubes():
-    if not _HAS_QUBESADMIN:
-        raise RuntimeError(
-            "qubesadmin is required but not installed. "
-            "Install it with: dnf install qubes-core-admin-client"
-        ) from _QUBESADMIN_ERR
-    return qubesadmin.Qubes()
-
-
-logfmt = "%(asctime)s %(levelname)-8s %(funcName)s() %(message)s"
-logging.basicConfig(format=logfmt, level=logging.DEBUG, datefmt="%Y-%m-%d %H:%M:%S")
+from .events import HALT_EVENTS
+from .session import default_session
 
 
 # Single source of truth for the default TemplateVM. The test suite re-imports
@@ -60,24 +40,25 @@ def vm_update_cmd(targets=(), max_concurrency=2, force=False):
 
 
 class HexagonQube(object):
-    # FUTURE: __init__ calls qubesadmin.Qubes() directly, so unit tests must
-    # monkeypatch it (see tests/conftest.py::fake_qubes). A cleaner design would
-    # inject the app, e.g. `def __init__(self, name, *, app=None, **kwargs)` with
-    # `app = app or qubesadmin.Qubes()`, letting tests pass a fake without
-    # patching. Deferred to keep this change scoped to the test harness.
-    def __init__(self, name, *args, **kwargs):
+    # All Admin API access goes through one shared Session (see session.py), so
+    # constructing many HexagonQubes costs one admin.vm.List, not one per call.
+    # cli.main injects its session; standalone callers get the process default.
+    def __init__(self, name, *args, session=None, **kwargs):
         self.name = name
+        self.session = session or default_session()
         # Don't clobber existing VM config unless explicitly requested
         if self.exists():
-            self.vm = _qubes().domains[self.name]
+            self.vm = self.session.get(self.name)
             self.desired_config = {**kwargs}
         else:
             self.desired_config = {**CONFIG_DEFAULTS, **kwargs}
         self.pending_changes = []
+        # Whether the last ensure_halted had to kill the VM.
+        self.killed = False
         self.reboot_required = False
         self.rebuild_required = False
         new_template = self.desired_config.get("template", "")
-        if new_template and new_template not in _qubes().domains:
+        if new_template and new_template not in self.session:
             msg = "Target TemplateVM does not exist: {}".format(new_template)
             raise Exception(msg)
 
@@ -86,13 +67,14 @@ class HexagonQube(object):
         return s
 
     def exists(self):
-        return self.name in _qubes().domains
+        return self.name in self.session
 
     def create(self):
         if not self.exists():
-            self.vm = _qubes().add_new_vm(
+            self.vm = self.session.app.add_new_vm(
                 self.desired_config["klass"], self.name, self.desired_config["label"]
             )
+            self.session.invalidate()
 
     def uptime(self):
         if self.exists():
@@ -107,55 +89,92 @@ class HexagonQube(object):
             self.ensure_halted()
             cmd = ["qvm-remove", "-f", self.name]
             subprocess.check_call(cmd)
+            self.session.invalidate()
             time.sleep(1)
         self.create()
 
-    def ensure_halted(self, wait=True, poll_interval=5):
+    def ensure_halted(self, wait=True, poll_interval=5, timeout=30, clients=None):
         """
-        Override shutdown method to block
+        Override shutdown method to block. Returns as soon as the Admin API
+        reports the VM halted; power state is polled every ``poll_interval``
+        seconds only as a fallback for a missed or unavailable event. Kills the
+        VM if it's still running after ``timeout`` seconds. Returns whether
+        the VM was running, i.e. whether there was anything to halt, and sets
+        ``killed`` if it had to kill it. ``clients`` is passed on to
+        ``request_halt``.
         """
-        if self.vm.is_running():
-            connected_vms = [x for x in self.vm.connected_vms if x.is_running()]
-            if connected_vms:
-                logging.warning(
-                    "Halting VM via poweroff (connected clients will be interrupted): {}".format(
-                        self.vm.name
-                    )
-                )
-                try:
-                    # Ideally we'd use:
-                    # self.vm.run("poweroff", user="root")
-                    # but that only works in dom0, in an Admin API domU it raises:
-                    # ValueError: non-default user not possible for calls from VM
-                    # so instead we'll just prefix it with sudo.
-                    self.vm.run("sudo poweroff")
-                # There's a good chance a successful poweroff will return non-zero
-                # Don't take that as a failure, since we'll poll for VM being stopped
-                # later and kill it if necessary
-                except subprocess.CalledProcessError:
-                    pass
-            else:
-                logging.debug("Halting VM via shutdown: {}".format(self.vm.name))
-                self.vm.shutdown()
-            if wait:
-                timeout = 30
-                waited = 0
-                while waited < timeout:
-                    power_state = self.vm.get_power_state()
-                    msg_f = "VM '{}' has power state {}"
-                    # DispVMs will have power state "NA" after shutdown, since they don't exist anymore.
-                    if power_state in ("Halted", "NA"):
-                        msg = msg_f.format(self.name, power_state)
-                        logging.debug(msg)
-                        break
-                    else:
-                        msg = msg_f.format(self.name, power_state)
-                        logging.debug(msg)
-                    time.sleep(poll_interval)
-                    waited += poll_interval
-        if self.vm.is_running():
+        self.killed = False
+        was_running = self.vm.is_running()
+        if was_running:
+            watcher = self.session.watcher() if wait else None
+            # Subscribe before asking for the shutdown, so a fast halt can't
+            # slip by between the request and the wait.
+            halted = watcher.expect(self.name, HALT_EVENTS) if watcher else None
+            try:
+                self.request_halt(clients=clients)
+                if wait:
+                    self._wait_halted(halted, poll_interval, timeout)
+            finally:
+                if halted is not None:
+                    halted.cancel()
+        if was_running and self.vm.is_running():
             logging.warning("Halting VM via kill: {}".format(self.vm.name))
             self.vm.kill()
+            self.killed = True
+        return was_running
+
+    def request_halt(self, clients=None):
+        """Ask the VM to halt, without waiting for it.
+
+        :param clients: names of the domains behind this VM, if already known
+            (``scheduler.NetvmClients``); else read from ``vm.connected_vms``,
+            which costs a call per domain in the fleet.
+        """
+        if clients is None:
+            connected = self.vm.connected_vms
+        else:
+            connected = [self.session.get(n) for n in clients if n in self.session]
+        connected_vms = [x for x in connected if x.is_running()]
+        if connected_vms:
+            logging.warning(
+                "Halting VM via poweroff (connected clients will be interrupted): {}".format(
+                    self.vm.name
+                )
+            )
+            try:
+                # Ideally we'd use:
+                # self.vm.run("poweroff", user="root")
+                # but that only works in dom0, in an Admin API domU it raises:
+                # ValueError: non-default user not possible for calls from VM
+                # so instead we'll just prefix it with sudo.
+                self.vm.run("sudo poweroff")
+            # There's a good chance a successful poweroff will return non-zero
+            # Don't take that as a failure, since we'll poll for VM being stopped
+            # later and kill it if necessary
+            except subprocess.CalledProcessError:
+                pass
+        else:
+            logging.debug("Halting VM via shutdown: {}".format(self.vm.name))
+            self.vm.shutdown()
+
+    def _wait_halted(self, halted, poll_interval, timeout):
+        deadline = time.monotonic() + timeout
+        msg_f = "VM '{}' has power state {}"
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if halted is not None:
+                if halted.wait(min(poll_interval, remaining)):
+                    logging.debug("VM '{}' reported {}".format(self.name, halted.event))
+                    break
+            else:
+                time.sleep(min(poll_interval, remaining))
+            power_state = self.vm.get_power_state()
+            logging.debug(msg_f.format(self.name, power_state))
+            # DispVMs will have power state "NA" after shutdown, since they don't exist anymore.
+            if power_state in ("Halted", "NA"):
+                break
 
     def is_outdated(self):
         """
@@ -173,15 +192,25 @@ class HexagonQube(object):
                     is_outdated = True
         return is_outdated
 
-    def reconcile(self):
+    def reconcile(self, plan=None, manage_power=True):
         """
         Apply all outstanding config changes to VM. If VM does not exist,
         it will be created. Handles VM roughly, including rebooting despite
         attached network clients if a netvm.
+
+        :param plan: a ``plan.VMPlan`` already diffed from a fleet snapshot;
+            its changes are applied as-is instead of re-reading the VM.
+        :param manage_power: restore the VM's power state (or start it for
+            autostart) when done. A batch reconcile passes False and does the
+            halts and starts for the whole batch itself (``plan.PowerPlan``).
         """
+        if plan is not None:
+            self.pending_changes = plan.config_changes()
+            self.rebuild_required = plan.rebuild
+            logging.debug("{} planned changes: {}".format(self, self.pending_changes))
         # Logging is not mandatory, but calling changes_required is,
         # since it populates the pending_changes attribute.
-        if not self.changes_required():
+        elif not self.changes_required():
             logging.debug("{} requires no changes".format(self))
         else:
             logging.debug("{} requires changes: {}".format(self, self.pending_changes))
@@ -193,7 +222,9 @@ class HexagonQube(object):
         was_running = self.vm.is_running()
 
         reboot_required = False
-        if self.is_outdated():
+        if plan is not None:
+            reboot_required = plan.reboot
+        elif self.is_outdated():
             reboot_required = True
 
         if any([c.reboot_required for c in self.pending_changes]):
@@ -210,7 +241,9 @@ class HexagonQube(object):
             # logging.debug("Applying config change for {}: {}".format(self, c))
             c.apply(self.vm)
 
-        if self.vm.autostart or was_running:
+        if not manage_power:
+            pass
+        elif self.vm.autostart or was_running:
             if not self.vm.is_running():
                 self.vm.start()
         else:
@@ -218,7 +251,7 @@ class HexagonQube(object):
                 self.ensure_halted()
 
         # Finally, update the vm attribute was latest info
-        self.vm = _qubes().domains[self.name]
+        self.vm = self.session.get(self.name)
 
     def changes_required(self):
         for k, v in self.desired_config.items():
@@ -0,0 +1,630 @@
+"""Offline model of qrexec policy evaluation, and an optimizer built on it.
+
+dom0 decides every qrexec call -- every Admin API call hexagon or Ansible
+makes -- by scanning the policy files top to bottom and taking the first
+rule whose SERVICE, ARGUMENT, SOURCE and TARGET all match. This module parses
+rendered policy text into ``Rule``s and mirrors that first-match evaluation,
+so policy changes can be checked (and costed) without a Qubes host.
+
+Token semantics follow qrexec's policy format v5, restricted to what hexagon
+emits: ``*`` for any service or argument, literal qube names, ``@adminvm``
+(``dom0``), ``@anyvm`` (any qube but dom0), ``@tag:`` and ``@type:``. Other
+``@`` keywords only match themselves. Tags and types never match dom0.
+
+``optimize`` rewrites a rule list for cheaper evaluation without changing a
+single decision: it drops rules no query can reach (an earlier rule matches
+everything they do) and moves frequently hit services towards the top, but
+never past a rule that could match the same query with a different action.
+``find_differences`` is the independent proof: it evaluates both lists over
+every class of query that could tell them apart.
+
+``PolicyEvaluator`` answers calls between named qubes given their tags and
+counts the rules each lookup scans; ``replay`` drives it with the Admin API
+calls a hexagon subcommand makes (``CALL_MIX``). To compare policies::
+
+    python3 -m hexagon.qrexec [--vms N] [--mgmt-qube NAME] [POLICY_FILE...]
+"""
+
+import argparse
+import collections
+import heapq
+import itertools
+import os
+import time
+
+ADMINVM = "@adminvm"
+ANYVM = "@anyvm"
+
+# Admin API calls per hexagon subcommand, as (service, argument, target):
+# "dom0" calls go to dom0, "vm" calls to each selected VM. qubesd filters
+# admin.vm.List and admin.Events per VM against the policy, so those are
+# evaluated against each VM as well. Reads follow snapshot.py (one GetAll and
+# one tag.List per VM); reboot and shutdown check power state and netvm, and
+# watch admin.Events for the halt (qmgr.HexagonQube.ensure_halted); --outdated
+# and reconcile list and inspect each running VM's volumes (outdated.py).
+CALL_MIX = {
+    "ls": (
+        [("admin.vm.List", "", "dom0")],
+        [
+            ("admin.vm.List", "", "vm"),
+            ("admin.vm.tag.List", "", "vm"),
+            ("admin.vm.property.GetAll", "", "vm"),
+        ],
+    ),
+    "start": (
+        [("admin.vm.List", "", "dom0")],
+        [
+            ("admin.vm.List", "", "vm"),
+            ("admin.vm.tag.List", "", "vm"),
+            ("admin.vm.property.GetAll", "", "vm"),
+            ("admin.vm.Start", "", "vm"),
+        ],
+    ),
+    # Plus, per VM, the readiness wait: the domain-start event, then
+    # qubes.WaitForSession into the guest (readiness.py).
+    "start --wait-ready": (
+        [("admin.vm.List", "", "dom0"), ("admin.Events", "", "dom0")],
+        [
+            ("admin.vm.List", "", "vm"),
+            ("admin.vm.tag.List", "", "vm"),
+            ("admin.vm.property.GetAll", "", "vm"),
+            ("admin.Events", "", "vm"),
+            ("admin.vm.Start", "", "vm"),
+            ("qubes.WaitForSession", "", "vm"),
+        ],
+    ),
+    "shutdown": (
+        [("admin.vm.List", "", "dom0"), ("admin.Events", "", "dom0")],
+        [
+            ("admin.vm.List", "", "vm"),
+            ("admin.vm.tag.List", "", "vm"),
+            ("admin.vm.property.GetAll", "", "vm"),
+            ("admin.Events", "", "vm"),
+            ("admin.vm.property.Get", "+netvm", "vm"),
+            ("admin.vm.CurrentState", "", "vm"),
+            ("admin.vm.Shutdown", "", "vm"),
+        ],
+    ),
+    "reboot": (
+        [("admin.vm.List", "", "dom0"), ("admin.Events", "", "dom0")],
+        [
+            ("admin.vm.List", "", "vm"),
+            ("admin.vm.tag.List", "", "vm"),
+            ("admin.vm.property.GetAll", "", "vm"),
+            ("admin.Events", "", "vm"),
+            ("admin.vm.property.Get", "+netvm", "vm"),
+            ("admin.vm.Shutdown", "", "vm"),
+            ("admin.vm.CurrentState", "", "vm"),
+            ("admin.vm.Start", "", "vm"),
+        ],
+    ),
+    "reboot --outdated": (
+        [("admin.vm.List", "", "dom0"), ("admin.Events", "", "dom0")],
+        [
+            ("admin.vm.List", "", "vm"),
+            ("admin.vm.tag.List", "", "vm"),
+            ("admin.vm.property.GetAll", "", "vm"),
+            ("admin.vm.CurrentState", "", "vm"),
+            ("admin.vm.volume.List", "", "vm"),
+            ("admin.vm.volume.Info", "+root", "vm"),
+            ("admin.Events", "", "vm"),
+            ("admin.vm.property.Get", "+netvm", "vm"),
+            ("admin.vm.Shutdown", "", "vm"),
+            ("admin.vm.Start", "", "vm"),
+        ],
+    ),
+    "reconcile": (
+        [("admin.vm.List", "", "dom0")],
+        [
+            ("admin.vm.List", "", "vm"),
+            ("admin.vm.property.GetAll", "", "vm"),
+            ("admin.vm.property.Set", "+memory", "vm"),
+            ("admin.vm.CurrentState", "", "vm"),
+            ("admin.vm.volume.List", "", "vm"),
+            ("admin.vm.volume.Info", "+root", "vm"),
+            ("admin.vm.property.Get", "+netvm", "vm"),
+            ("admin.vm.Shutdown", "", "vm"),
+            ("admin.vm.Start", "", "vm"),
+        ],
+    ),
+    # Per declared VM: the config-hash read (fleet.py); only changed VMs go on
+    # to the reconcile calls above, then get their new hash stored.
+    "reconcile --config": (
+        [("admin.vm.List", "", "dom0")],
+        [
+            ("admin.vm.List", "", "vm"),
+            ("admin.vm.feature.Get", "+hexagon-config-hash", "vm"),
+        ],
+    ),
+}
+
+
+def _mix_weights(base, mix):
+    """``base`` plus, per service, 100 per per-VM call and 1 per per-run call
+    in ``mix``: hexagon's own calls come first, scaled by how many VMs they
+    hit."""
+    weights = dict(base)
+    for per_run, per_vm in mix.values():
+        for calls, weight in ((per_run, 1), (per_vm, 100)):
+            for service, _arg, _target in calls:
+                weights[service] = weights.get(service, 1) + weight
+    return weights
+
+
+# How often a management workload hits each service, relatively: hexagon's
+# CALL_MIX, then (for Ansible) per-VM reads, listing and events, lifecycle
+# writes, then one-off creation. Only used to order rules, never to decide
+# one.
+HIT_WEIGHTS = _mix_weights(
+    {
+        "admin.vm.property.Get": 100,
+        "admin.vm.property.GetAll": 90,
+        "admin.vm.CurrentState": 80,
+        "admin.vm.tag.List": 70,
+        "admin.vm.feature.Get": 60,
+        "admin.vm.feature.List": 50,
+        "admin.vm.List": 40,
+        "admin.vm.tag.Get": 30,
+        "admin.vm.property.List": 30,
+        "admin.Events": 20,
+        "admin.vm.Start": 15,
+        "admin.vm.Shutdown": 15,
+        "admin.vm.property.Set": 10,
+        "admin.vm.Kill": 5,
+        "qubes.VMShell": 5,
+        "qubes.WaitForSession": 5,
+        "qubes.Filecopy": 5,
+        "qubes.AnsibleVM": 5,
+    },
+    CALL_MIX,
+)
+
+
+def _norm(token):
+    return ADMINVM if token == "dom0" else token
+
+
+class Rule(object):
+    """One policy line: SERVICE ARGUMENT SOURCE TARGET ACTION [PARAMS...]."""
+
+    __slots__ = ("service", "argument", "source", "target", "action", "params", "line", "lineno")
+
+    def __init__(self, service, argument, source, target, action, params=(), line=None, lineno=0):
+        self.service = service
+        self.argument = argument
+        self.source = _norm(source)
+        self.target = _norm(target)
+        self.action = action
+        self.params = tuple(params)
+        self.line = line
+        self.lineno = lineno
+
+    def __repr__(self):
+        return "<Rule {}: {} {} {} {} {}>".format(
+            self.lineno, self.service, self.argument, self.source, self.target, self.decision
+        )
+
+    @property
+    def decision(self):
+        """What the rule decides: its action and parameters."""
+        return " ".join((self.action,) + self.params)
+
+    def matches(self, service, argument, source, target):
+        """Whether this rule applies to a call; ``source``/``target`` are
+        ``Domain``s, ``argument`` is ``"+arg"`` or ``""``."""
+        return (
+            (self.service == "*" or self.service == service)
+            and (self.argument == "*" or self.argument == argument)
+            and token_matches(self.source, source)
+            and token_matches(self.target, target)
+        )
+
+    def covers(self, other):
+        """Whether every call ``other`` matches, this rule matches too."""
+        return (
+            self.service in ("*", other.service)
+            and self.argument in ("*", other.argument)
+            and token_covers(self.source, other.source)
+            and token_covers(self.target, other.target)
+        )
+
+    def disjoint(self, other):
+        """Whether no call can match both rules."""
+        return (
+            "*" not in (self.service, other.service)
+            and self.service != other.service
+            or "*" not in (self.argument, other.argument)
+            and self.argument != other.argument
+            or tokens_disjoint(self.source, other.source)
+            or tokens_disjoint(self.target, other.target)
+        )
+
+
+class Domain(object):
+    """A qube as policy evaluation sees it: name, tags and class."""
+
+    __slots__ = ("name", "tags", "klass")
+
+    def __init__(self, name, tags=(), klass=None):
+        self.name = _norm(name)
+        self.tags = frozenset(tags)
+        self.klass = klass
+
+    def __repr__(self):
+        return "<Domain: {} tags={} class={}>".format(self.name, sorted(self.tags), self.klass)
+
+
+def parse_policy(text):
+    """Parse policy file text into Rules, in file order.
+
+    :raises ValueError: on malformed lines and on ``!`` directives
+        (``!include`` and friends), which hexagon never emits.
+    """
+    rules = []
+    for lineno, line in enumerate(text.splitlines(), 1):
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#"):
+            continue
+        if stripped.startswith("!"):
+            raise ValueError("line {}: unsupported directive: {}".format(lineno, stripped))
+        fields = stripped.split()
+        if len(fields) < 5:
+            raise ValueError("line {}: expected at least 5 fields: {}".format(lineno, stripped))
+        rules.append(Rule(*fields[:5], params=fields[5:], line=line, lineno=lineno))
+    return rules
+
+
+def token_matches(token, domain):
+    name = domain.name
+    if token == ANYVM:
+        return name != ADMINVM
+    if name == ADMINVM:
+        return token == ADMINVM
+    if token.startswith("@tag:"):
+        return token[5:] in domain.tags
+    if token.startswith("@type:"):
+        return token[6:] == domain.klass
+    return token == name
+
+
+def token_covers(a, b):
+    """Whether token ``a`` matches every domain token ``b`` matches."""
+    if a == b:
+        return True
+    return a == ANYVM and b != ADMINVM and not _is_other_keyword(b)
+
+
+def tokens_disjoint(a, b):
+    """Whether no domain can match both tokens."""
+    if a == b or _is_other_keyword(a) or _is_other_keyword(b):
+        return False
+    if ADMINVM in (a, b):
+        return True
+    if ANYVM in (a, b):
+        return False
+    if a.startswith("@type:") and b.startswith("@type:"):
+        return True
+    # Two literal names; a tag or type may be carried by any named qube.
+    return not a.startswith("@") and not b.startswith("@")
+
+
+def _is_other_keyword(token):
+    return token.startswith("@") and not (
+        token in (ADMINVM, ANYVM) or token.startswith(("@tag:", "@type:"))
+    )
+
+
+def evaluate(rules, service, argument, source, target):
+    """First-match evaluation, as dom0 does it.
+
+    :returns: ``(rule or None, rules scanned)``; no matching rule means deny.
+    """
+    for scanned, rule in enumerate(rules, 1):
+        if rule.matches(service, argument, source, target):
+            return rule, scanned
+    return None, len(rules)
+
+
+def decide(rules, service, argument, source, target):
+    """The decision string for a call; ``"deny"`` if no rule matches."""
+    rule, _scanned = evaluate(rules, service, argument, source, target)
+    return rule.decision if rule is not None else "deny"
+
+
+def load_policy(path, mgmt_qube=None):
+    """Parse a policy file. ``mgmt_qube`` replaces the ``MGMT_QUBE``
+    placeholder, as installing ``qubes/policy.d/30-hexagon-test.policy``
+    requires."""
+    with open(path) as f:
+        text = f.read()
+    if mgmt_qube is not None:
+        text = text.replace("MGMT_QUBE", mgmt_qube)
+    return parse_policy(text)
+
+
+class PolicyEvaluator(object):
+    """Evaluate calls between named qubes, counting the rules scanned.
+
+    :param rules: Rules in policy order.
+    :param tags: ``{qube name: iterable of tags}``; unlisted qubes have none.
+    :param types: ``{qube name: class}``, for ``@type:`` rules.
+    """
+
+    def __init__(self, rules, tags=None, types=None):
+        self.rules = list(rules)
+        self.tags = tags or {}
+        self.types = types or {}
+        self.lookups = 0
+        self.scanned = 0
+        self.max_scanned = 0
+
+    def __repr__(self):
+        return "<PolicyEvaluator: {} rules, {} lookups>".format(len(self.rules), self.lookups)
+
+    def domain(self, name):
+        return Domain(name, self.tags.get(name, ()), self.types.get(name))
+
+    def query(self, service, arg, source, target):
+        """The decision for ``source`` calling ``service+arg`` on ``target``:
+        the matching rule's action and parameters, or ``"deny"``."""
+        argument = "+" + arg if arg else ""
+        rule, scanned = evaluate(
+            self.rules, service, argument, self.domain(source), self.domain(target)
+        )
+        self.lookups += 1
+        self.scanned += scanned
+        self.max_scanned = max(self.max_scanned, scanned)
+        return rule.decision if rule is not None else "deny"
+
+    def allowed(self, service, arg, source, target):
+        return self.query(service, arg, source, target).split()[0] != "deny"
+
+    @property
+    def mean_scanned(self):
+        return self.scanned / self.lookups if self.lookups else 0.0
+
+
+def replay(evaluator, command, source, vms):
+    """Evaluate every call ``command`` makes from ``source`` on ``vms``.
+
+    :returns: ``Counter`` of denied ``(service, target)`` calls, with
+        ``target`` ``"dom0"`` or ``"vm"``.
+    """
+    per_run, per_vm = CALL_MIX[command]
+    denied = collections.Counter()
+    for service, arg, _target in per_run:
+        if not evaluator.allowed(service, arg, source, "dom0"):
+            denied[(service, "dom0")] += 1
+    for vm in vms:
+        for service, arg, _target in per_vm:
+            if not evaluator.allowed(service, arg, source, vm):
+                denied[(service, "vm")] += 1
+    return denied
+
+
+def benchmark(rules, tags, source, vms, repeat=3):
+    """Replay each ``CALL_MIX`` subcommand against ``rules``.
+
+    :returns: ``{command: (lookups, mean rules scanned, max rules scanned,
+        best seconds per lookup, denied Counter)}``.
+    """
+    results = {}
+    for command in CALL_MIX:
+        best = None
+        for _ in range(repeat):
+            evaluator = PolicyEvaluator(rules, tags)
+            start = time.perf_counter()
+            denied = replay(evaluator, command, source, vms)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[command] = (
+            evaluator.lookups,
+            evaluator.mean_scanned,
+            evaluator.max_scanned,
+            best / evaluator.lookups,
+            denied,
+        )
+    return results
+
+
+# --- optimizer --------------------------------------------------------------
+
+
+def optimize(rules, weights=None):
+    """Reorder and prune ``rules`` without changing any decision.
+
+    A rule is dropped when an earlier rule covers it: dom0 would never reach
+    it. The rest are ordered by ``weights[service]`` (default ``HIT_WEIGHTS``;
+    unlisted services weigh 1), divided by the rule's rank among the kept
+    rules for its service, heaviest first -- except that a rule never moves
+    above an earlier one it overlaps with a different decision.
+
+    :returns: ``(kept rules, dropped rules)``.
+    """
+    weights = HIT_WEIGHTS if weights is None else weights
+    kept, dropped = [], []
+    for rule in rules:
+        if any(k.covers(rule) for k in kept):
+            dropped.append(rule)
+        else:
+            kept.append(rule)
+
+    # Topological sort over "must stay before" edges, heaviest first, with
+    # file order breaking ties so equal-weight rules keep their order.
+    before = {i: set() for i in range(len(kept))}
+    blocks = {i: [] for i in range(len(kept))}
+    for i, j in itertools.combinations(range(len(kept)), 2):
+        a, b = kept[i], kept[j]
+        if a.decision != b.decision and not a.disjoint(b):
+            before[j].add(i)
+            blocks[i].append(j)
+    # A service's calls mostly stop at its first rule (the managed-tag grant);
+    # each later rule for the same service is only reached by the rest.
+    weight, seen = [], collections.Counter()
+    for rule in kept:
+        seen[rule.service] += 1
+        weight.append(weights.get(rule.service, 1) / seen[rule.service])
+    ready = [(-weight[i], i) for i in before if not before[i]]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        _weight, i = heapq.heappop(ready)
+        order.append(kept[i])
+        for j in blocks[i]:
+            before[j].discard(i)
+            if not before[j]:
+                heapq.heappush(ready, (-weight[j], j))
+    return order, dropped
+
+
+def format_optimized(text, rules, dropped):
+    """Render the optimized policy: ``text``'s leading comment block, a note
+    on what changed, then ``rules`` as they were written."""
+    header = list(itertools.takewhile(lambda line: line.startswith("#"), text.splitlines()))
+    header += [
+        "#",
+        "# Optimized by `hexagon policy --optimize`: rules ordered by expected hit",
+        "# frequency, {} unreachable rule(s) removed. Render without --optimize for the".format(
+            len(dropped)
+        ),
+        "# commented, sectioned version.",
+        "",
+    ]
+    return "\n".join(header + [r.line for r in rules]) + "\n"
+
+
+# --- equivalence checker ----------------------------------------------------
+
+
+def _domain_classes(tokens):
+    """One representative Domain per class of qube the tokens can tell apart.
+
+    Matching is monotone in a qube's tags, so when two rule lists disagree on
+    some qube, they also disagree on one carrying just the (at most two) tags
+    their two deciding rules test for. Subsets of up to two tags therefore
+    cover every distinguishable class.
+    """
+    names = {t for t in tokens if not t.startswith("@") or _is_other_keyword(t)}
+    tags = sorted({t[5:] for t in tokens if t.startswith("@tag:")})
+    types = sorted({t[6:] for t in tokens if t.startswith("@type:")})
+    tag_sets = [()] + [(t,) for t in tags] + list(itertools.combinations(tags, 2))
+    yield Domain(ADMINVM)
+    for name in sorted(names) + ["@hexagon-unnamed"]:
+        for klass in types + [None]:
+            for tag_set in tag_sets:
+                yield Domain(name, tag_set, klass)
+
+
+def find_differences(original, optimized, limit=10):
+    """Calls that ``original`` and ``optimized`` decide differently.
+
+    Enumerates every service and argument either list names (plus one that
+    neither does), and every class of source and target qube from
+    ``_domain_classes``; an empty result proves the lists equivalent for all
+    calls on any fleet.
+
+    :returns: up to ``limit`` ``(service, argument, source, target, original
+        decision, optimized decision)`` tuples.
+    """
+    rules = list(original) + list(optimized)
+    services = sorted({r.service for r in rules if r.service != "*"}) + ["hexagon.Unlisted"]
+    arguments = sorted({r.argument for r in rules if r.argument != "*"} | {"", "+unlisted"})
+    sources = list(_domain_classes({r.source for r in rules}))
+    targets = list(_domain_classes({r.target for r in rules}))
+    differences = []
+    for service in services:
+        for argument in arguments:
+            # Narrow each list to what this service/argument can reach first.
+            a = [r for r in original if r.service in ("*", service)]
+            a = [r for r in a if r.argument in ("*", argument)]
+            b = [r for r in optimized if r.service in ("*", service)]
+            b = [r for r in b if r.argument in ("*", argument)]
+            for source in sources:
+                a_src = [r for r in a if token_matches(r.source, source)]
+                b_src = [r for r in b if token_matches(r.source, source)]
+                for target in targets:
+                    before = decide(a_src, service, argument, source, target)
+                    after = decide(b_src, service, argument, source, target)
+                    if before != after:
+                        differences.append((service, argument, source, target, before, after))
+                        if len(differences) >= limit:
+                            return differences
+    return differences
+
+
+# --- benchmark --------------------------------------------------------------
+
+
+def _fleet(n, tag, admin_tags, source):
+    vms = ["vm{:04d}".format(i) for i in range(n)]
+    tags = {vm: (tag,) for vm in vms}
+    tags[source] = admin_tags
+    return vms, tags
+
+
+def _report(label, results):
+    print(label)
+    print(
+        "  {:<18} {:>7} {:>11} {:>9} {:>10}  {}".format(
+            "command", "calls", "rules/call", "max", "us/call", "denied"
+        )
+    )
+    for command, (lookups, mean, worst, seconds, denied) in results.items():
+        print(
+            "  {:<18} {:>7} {:>11.1f} {:>9} {:>10.2f}  {}".format(
+                command,
+                lookups,
+                mean,
+                worst,
+                seconds * 1e6,
+                ", ".join(
+                    "{}@{} x{}".format(svc, target, n)
+                    for (svc, target), n in sorted(denied.items())
+                )
+                or "-",
+            )
+        )
+
+
+def main(argv=None):
+    from . import policy
+
+    parser = argparse.ArgumentParser(
+        prog="python3 -m hexagon.qrexec",
+        description="Replay each subcommand's Admin API calls against qrexec policies",
+    )
+    parser.add_argument("--vms", type=int, default=100, help="Fleet size [default: %(default)s]")
+    parser.add_argument(
+        "--mgmt-qube", default="mgmt", help="Calling qube's name [default: %(default)s]"
+    )
+    parser.add_argument(
+        "policies",
+        nargs="*",
+        metavar="POLICY_FILE",
+        help="Extra policy files; MGMT_QUBE is replaced and managed VMs carry the hexagon-test tag",
+    )
+    args = parser.parse_args(argv)
+    source = args.mgmt_qube
+
+    text = policy.render_policy(admin_qubes=[source])
+    rendered = parse_policy(text)
+    optimized, _dropped = optimize(rendered)
+    vms, tags = _fleet(args.vms, policy.DEFAULT_TARGET_TAG, (policy.DEFAULT_ADMIN_TAG,), source)
+    _report(
+        "hexagon policy ({} rules)".format(len(rendered)), benchmark(rendered, tags, source, vms)
+    )
+    _report(
+        "hexagon policy --optimize ({} rules)".format(len(optimized)),
+        benchmark(optimized, tags, source, vms),
+    )
+    vms, tags = _fleet(args.vms, "hexagon-test", (), source)
+    for path in args.policies:
+        rules = load_policy(path, mgmt_qube=source)
+        _report(
+            "{} ({} rules)".format(os.path.basename(path), len(rules)),
+            benchmark(rules, tags, source, vms),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""Wait for started VMs to be usable, not just running (``--wait-ready``).
+
+``admin.vm.Start`` returns once the domain is up, but a script that goes on
+to ``qvm-run`` it still has to spin until the guest answers. Here readiness
+is two steps, neither of them polling:
+
+  * the qrexec agent: qubesd fires ``domain-start`` once the VM's qrexec
+    agent has connected (``domain-start-failed`` if it never does). The
+    waiter is registered before the start is requested, so the event can't
+    slip by; without an event stream, one power-state read stands in.
+  * the user session: ``qubes.WaitForSession`` runs in the guest and returns
+    only once the session is up, so a single blocking qrexec call replaces
+    the retry loop.
+
+Each VM waits in its own worker, so a batch becomes ready in parallel.
+``Readiness`` records how long each VM took to reach each step, for the
+latency report printed at the end of the run.
+"""
+
+import logging
+import subprocess
+import threading
+import time
+
+READY_EVENTS = frozenset(("domain-start",))
+# Not the halt events: a reboot's late domain-shutdown would count against the
+# start. A VM that stops once up fails qubes.WaitForSession instead.
+FAILED_EVENTS = frozenset(("domain-start-failed",))
+
+SESSION_SERVICE = "qubes.WaitForSession"
+
+DEFAULT_TIMEOUT = 120
+
+
+class NotReady(Exception):
+    """A started VM failed to come up, or wasn't ready in time."""
+
+
+class Readiness(object):
+    """Waits for VMs to become ready, and records how long each took.
+
+    :param timeout: seconds from the start request to a ready session.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, clock=time.monotonic):
+        self.timeout = timeout
+        self.clock = clock
+        # {name: (started, agent, session)}, seconds since the start request.
+        self.latencies = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<Readiness: {} VMs ready>".format(len(self.latencies))
+
+    def expect(self, qube):
+        """Register for ``qube``'s start events; call before starting it.
+        Returns a Waiter, or None without an event stream."""
+        watcher = qube.session.watcher()
+        if watcher is None:
+            return None
+        return watcher.expect(qube.name, READY_EVENTS | FAILED_EVENTS)
+
+    def wait(self, qube, waiter, requested, started):
+        """Block until ``qube`` is ready.
+
+        :param waiter: from ``expect``; cancelled here.
+        :param requested: clock reading when the start was requested.
+        :param started: clock reading when ``admin.vm.Start`` returned.
+        :raises NotReady: on a failed start, or after ``timeout``.
+        """
+        name = qube.name
+        deadline = requested + self.timeout
+        try:
+            if waiter is None:
+                if not qube.vm.is_running():
+                    raise NotReady("{} is not running".format(name))
+            elif not waiter.wait(max(0, deadline - self.clock())):
+                raise NotReady("{}: no qrexec agent after {}s".format(name, self.timeout))
+            elif waiter.event in FAILED_EVENTS:
+                raise NotReady("{}: {} while waiting for it".format(name, waiter.event))
+        finally:
+            if waiter is not None:
+                waiter.cancel()
+        agent = self.clock()
+        logging.debug("VM '{}' qrexec agent is up".format(name))
+        self._wait_session(qube, deadline)
+        ready = self.clock()
+        logging.debug("VM '{}' is ready after {:.1f}s".format(name, ready - requested))
+        with self._lock:
+            self.latencies[name] = (started - requested, agent - requested, ready - requested)
+
+    def _wait_session(self, qube, deadline):
+        try:
+            proc = qube.vm.run_service(
+                SESSION_SERVICE,
+                autostart=False,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        except Exception as e:
+            raise NotReady("{}: {} failed: {}".format(qube.name, SESSION_SERVICE, repr(e)))
+        try:
+            proc.communicate(timeout=max(0, deadline - self.clock()))
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise NotReady("{}: no user session after {}s".format(qube.name, self.timeout))
+        if proc.returncode != 0:
+            raise NotReady("{}: {} exited {}".format(qube.name, SESSION_SERVICE, proc.returncode))
+
+    def format(self):
+        """Per-VM readiness latencies, slowest first, then percentiles."""
+        if not self.latencies:
+            return ""
+        width = max([len(n) for n in self.latencies] + [2])
+        lines = ["{:<{}}  {:>8}  {:>8}  {:>8}".format("VM", width, "started", "qrexec", "session")]
+        for name, (started, agent, ready) in sorted(
+            self.latencies.items(), key=lambda item: (-item[1][2], item[0])
+        ):
+            lines.append(
+                "{:<{}}  {:>7.1f}s  {:>7.1f}s  {:>7.1f}s".format(name, width, started, agent, ready)
+            )
+        ready = sorted(latencies[2] for latencies in self.latencies.values())
+        lines.append(
+            "ready: {} VMs, p50 {:.1f}s, p90 {:.1f}s, max {:.1f}s".format(
+                len(ready),
+                ready[(len(ready) - 1) // 2],
+                ready[int(0.9 * (len(ready) - 1))],
+                ready[-1],
+            )
+        )
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,193 @@
+"""A single, shared Admin API session for the whole process.
+
+``qubesadmin.Qubes()`` is cheap to construct but expensive to *use* fresh: each
+new app starts with an empty domain cache, so the first membership test or
+lookup re-runs ``admin.vm.List``. Building an app per lookup turns ``hexagon
+ls`` on a 300-qube host into ~900 list calls. A ``Session`` owns exactly one
+app for the life of the process; ``cli.main`` creates it and hands it to every
+HexagonQube, so the domain list is fetched once and reused until something
+writes.
+
+The session is shared across the ``ThreadPoolExecutor`` workers in ``cli.main``.
+qubesadmin's domain collection refreshes its cache lazily and isn't safe to
+refresh from two threads at once, so every collection access goes through a
+lock. Per-VM property reads don't touch the collection and stay lock-free.
+
+A long-lived process (``hexagon serve``) calls ``follow()`` instead of
+invalidating by hand: the session then subscribes to ``admin.Events`` and
+drops its cached domain list whenever a domain is added, removed, or changes
+power state.
+"""
+
+import os
+import threading
+
+from .events import EventWatcher, QubesEventSource, events_available
+
+
+# Domain events that don't change admin.vm.List (class, power state) or the
+# domain collection.
+_ATTRIBUTE_EVENTS = ("domain-feature-", "domain-tag-")
+
+
+# Points hexagon at another qubesd socket, such as the stand-in server the
+# test suite runs (tests/qubesd.py), instead of letting qubesadmin choose.
+SOCKET_ENV = "HEXAGON_QUBESD_SOCKET"
+
+
+def _new_app():
+    # Imported here, not at module level: it's the costliest import hexagon
+    # has, and `policy`, `--help` and daemon-forwarded commands never need it.
+    try:
+        import qubesadmin
+    except ImportError as exc:
+        raise RuntimeError(
+            "qubesadmin is required but not installed. "
+            "Install it with: dnf install qubes-core-admin-client"
+        ) from exc
+    socket_path = os.environ.get(SOCKET_ENV)
+    if socket_path:
+        # qubesadmin picks its transport by whether the default socket exists
+        # (at import time); talk to this one through the socket client.
+        import qubesadmin.app
+        import qubesadmin.config
+
+        qubesadmin.config.QUBESD_SOCKET = socket_path
+        return qubesadmin.app.QubesLocal()
+    return qubesadmin.Qubes()
+
+
+class Session(object):
+    """Owns one qubesadmin app, its domain collection and its connection.
+
+    The app is created lazily on first use, so constructing a Session never
+    touches the Admin API. Pass ``app`` to wrap an existing app (tests, or a
+    caller that already holds one).
+
+    The domain list is only refreshed when ``invalidate()`` is called, which
+    callers must do after any write that adds, removes or renames a domain.
+    ``generation`` counts invalidations, so holders of derived data can tell
+    whether what they cached is still current.
+
+    ``events`` is the event source behind ``watcher()``; by default that's an
+    ``admin.Events`` stream, opened on first use on an app of its own.
+    """
+
+    def __init__(self, app=None, events=None):
+        self._app = app
+        self._events = events
+        self._watcher = None
+        self._listing = None
+        self._following = False
+        self._lock = threading.RLock()
+        self.generation = 0
+
+    def __repr__(self):
+        return "<Session: generation={}>".format(self.generation)
+
+    @property
+    def app(self):
+        with self._lock:
+            if self._app is None:
+                self._app = _new_app()
+            return self._app
+
+    @property
+    def domains(self):
+        return self.app.domains
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self.app.domains
+
+    def get(self, name):
+        """Return the qubesadmin VM object for ``name`` (KeyError if absent)."""
+        with self._lock:
+            return self.app.domains[name]
+
+    def vms(self):
+        """All domains, as a list, from a single pass over the collection."""
+        with self._lock:
+            return list(self.app.domains)
+
+    def listing(self):
+        """Raw ``admin.vm.List`` output: every domain's class and power state.
+
+        Read fresh on every call, unless the session ``follow()``s events,
+        which keep a cached copy current.
+        """
+        with self._lock:
+            if self._listing is not None:
+                return self._listing
+            data = self.app.qubesd_call("dom0", "admin.vm.List")
+            if self._following:
+                self._listing = data
+            return data
+
+    @property
+    def event_source(self):
+        """The injected (or already opened) event source, if any."""
+        return self._events
+
+    def _open_events(self):
+        if self._events is None and events_available():
+            # Its own app: the dispatcher thread can't take our lock around
+            # every domain lookup it makes.
+            self._events = QubesEventSource()
+        return self._events
+
+    def watcher(self):
+        """The session's EventWatcher, or None if events aren't available."""
+        with self._lock:
+            if self._watcher is None:
+                source = self._open_events()
+                if source is not None:
+                    self._watcher = EventWatcher(source)
+            return self._watcher
+
+    @property
+    def following(self):
+        return self._following
+
+    def follow(self):
+        """Keep the domain list and listing cached, invalidated by events.
+
+        Returns the event source, or None if events aren't available; the
+        caller must then ``invalidate()`` by hand, as before.
+        """
+        with self._lock:
+            source = self._open_events()
+            if source is not None and not self._following:
+                source.subscribe(self._on_event)
+                self._following = True
+            return source
+
+    def _on_event(self, name, event):
+        # A reconnect means events may have been missed in between.
+        if event == "connection-established" or (
+            event.startswith("domain-") and not event.startswith(_ATTRIBUTE_EVENTS)
+        ):
+            self.invalidate()
+
+    def invalidate(self):
+        """Drop the cached domain list; the next lookup re-runs ``admin.vm.List``."""
+        with self._lock:
+            self._listing = None
+            if self._app is not None:
+                clear_cache = getattr(self._app.domains, "clear_cache", None)
+                if clear_cache is not None:
+                    clear_cache()
+            self.generation += 1
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_session():
+    """The process-wide Session used when a caller doesn't inject one."""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Session()
+        return _default
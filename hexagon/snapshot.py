@@ -0,0 +1,266 @@
+"""Bulk, in-memory snapshot of the fleet's properties, tags and features.
+
+Reading ``vm.template`` or ``vm.features["updates-available"]`` through
+qubesadmin is one Admin API call per VM per attribute; from a management AppVM
+each of those is a qrexec round trip. ``FleetSnapshot.fetch`` instead reads
+every domain's class and power state from a single ``admin.vm.List``, then one
+``admin.vm.property.GetAll`` and one ``admin.vm.tag.List`` per selected VM, and
+keeps the results in compact ``VMRecord``s. Filters then run against the
+in-memory table, so adding a filter costs nothing extra over the wire.
+
+Values are kept as the strings qubesd serializes them to, which match
+``str(getattr(vm, prop))`` -- the comparison ``ls --property`` has always used.
+
+Qubes releases without ``admin.vm.property.GetAll`` (4.1 and older) fall back
+to ``property.List`` plus one ``property.Get`` per property, transparently.
+"""
+
+import concurrent.futures
+import logging
+
+try:
+    from qubesadmin.exc import QubesException
+except ImportError:
+    QubesException = Exception
+
+
+class VMRecord(object):
+    """Everything the filters know about one VM, fetched in bulk.
+
+    ``properties`` maps property name to its serialized value, ``tags`` is a
+    frozenset and ``features`` holds only the features that were requested.
+    Each of the three is ``None`` until loaded, so a snapshot can be filled in
+    stages, for only the VMs that still matter.
+    """
+
+    __slots__ = (
+        "name",
+        "klass",
+        "power_state",
+        "properties",
+        "tags",
+        "features",
+        "_loaded_features",
+    )
+
+    def __init__(
+        self, name, klass=None, power_state=None, properties=None, tags=None, features=None
+    ):
+        self.name = name
+        self.klass = klass
+        self.power_state = power_state
+        self.properties = properties
+        self.tags = frozenset(tags) if tags is not None else None
+        self.features = features
+        self._loaded_features = frozenset(features or ())
+
+    def has_features(self, features):
+        """Whether ``features`` were all requested already (set or not)."""
+        return self.features is not None and set(features) <= self._loaded_features
+
+    def __repr__(self):
+        return "<VMRecord: {} {} {}>".format(self.name, self.klass, self.power_state)
+
+    def is_running(self):
+        # Matches qubesadmin's QubesVM.is_running(): anything but Halted counts.
+        return self.power_state not in (None, "Halted", "NA")
+
+
+def _unescape(value):
+    # GetAll escapes backslashes and newlines so each property fits on one line.
+    if "\\" not in value:
+        return value
+    out = []
+    chars = iter(value)
+    for c in chars:
+        if c == "\\":
+            nxt = next(chars, "")
+            out.append("\n" if nxt == "n" else nxt)
+        else:
+            out.append(c)
+    return "".join(out)
+
+
+def _parse_property_value(line):
+    """Parse a ``default=<bool> type=<type> <value>`` property response."""
+    _default, rest = line.split(" ", 1)
+    prop_type, _sep, value = rest.partition(" ")
+    value = _unescape(value)
+    # An unset VM-typed property (e.g. netvm) serializes as the empty string,
+    # whereas str(vm.netvm) is "None"; keep the latter for filter parity.
+    if prop_type == "type=vm" and not value:
+        value = "None"
+    return value
+
+
+def parse_vm_list(data):
+    """Parse ``admin.vm.List`` output into ``{name: (klass, power_state)}``."""
+    domains = {}
+    for line in data.decode().splitlines():
+        if not line:
+            continue
+        name, *fields = line.split(" ")
+        attrs = dict(f.split("=", 1) for f in fields)
+        domains[name] = (attrs.get("class"), attrs.get("state"))
+    return domains
+
+
+def parse_property_get_all(data):
+    """Parse ``admin.vm.property.GetAll`` output into ``{name: value}``."""
+    properties = {}
+    for line in data.decode().splitlines():
+        if not line:
+            continue
+        name, rest = line.split(" ", 1)
+        properties[name] = _parse_property_value(rest)
+    return properties
+
+
+def _lines(data):
+    return [x for x in data.decode().splitlines() if x]
+
+
+class _Fetcher(object):
+    """Per-VM Admin API reads for one snapshot, degrading once if GetAll is absent."""
+
+    def __init__(self, app):
+        self.app = app
+        self.get_all = True
+
+    def properties(self, name):
+        if self.get_all:
+            try:
+                return parse_property_get_all(
+                    self.app.qubesd_call(name, "admin.vm.property.GetAll")
+                )
+            except QubesException as exc:
+                logging.debug("admin.vm.property.GetAll unavailable, falling back: {}".format(exc))
+                self.get_all = False
+        properties = {}
+        for prop in _lines(self.app.qubesd_call(name, "admin.vm.property.List")):
+            data = self.app.qubesd_call(name, "admin.vm.property.Get", prop)
+            properties[prop] = _parse_property_value(data.decode())
+        return properties
+
+    def tags(self, name):
+        return _lines(self.app.qubesd_call(name, "admin.vm.tag.List"))
+
+    def features(self, name, features):
+        present = set(_lines(self.app.qubesd_call(name, "admin.vm.feature.List")))
+        return {
+            f: self.app.qubesd_call(name, "admin.vm.feature.Get", f).decode()
+            for f in features
+            if f in present
+        }
+
+    def feature(self, record, feature):
+        """Read one feature with a single ``feature.Get``; absent is unset."""
+        try:
+            value = self.app.qubesd_call(record.name, "admin.vm.feature.Get", feature).decode()
+        except (QubesException, KeyError):
+            value = None
+        features = dict(record.features or {})
+        if value is not None:
+            features[feature] = value
+        record.features = features
+        record._loaded_features = record._loaded_features | {feature}
+
+    def fill(self, record, properties, tags, features):
+        if properties and record.properties is None:
+            props = self.properties(record.name)
+            props.setdefault("name", record.name)
+            if record.klass is not None:
+                props.setdefault("klass", record.klass)
+            record.properties = props
+        if tags and record.tags is None:
+            record.tags = frozenset(self.tags(record.name))
+        if features and not record.has_features(features):
+            record.features = self.features(record.name, features)
+            record._loaded_features = frozenset(features)
+
+
+class FleetSnapshot(object):
+    """A name-ordered table of VMRecords.
+
+    Iteration yields records sorted by name, matching the order qubesadmin's
+    domain collection iterates in. ``load`` fills in properties, tags or
+    features for a subset of records after the fact.
+    """
+
+    def __init__(self, records, generation=0, app=None, max_workers=8):
+        self._records = {r.name: r for r in records}
+        self.generation = generation
+        self.max_workers = max_workers
+        self._fetcher = _Fetcher(app) if app is not None else None
+
+    def __repr__(self):
+        return "<FleetSnapshot: {} VMs, generation={}>".format(len(self), self.generation)
+
+    def __iter__(self):
+        return iter(self._records[n] for n in sorted(self._records))
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, name):
+        return name in self._records
+
+    def __getitem__(self, name):
+        return self._records[name]
+
+    def names(self):
+        return sorted(self._records)
+
+    def load(self, records=None, properties=False, tags=False, features=()):
+        """Fetch whatever of ``properties``/``tags``/``features`` the given
+        records (default: all) don't have yet. Per-VM reads run in parallel;
+        each is an independent Admin API call."""
+        records = list(self) if records is None else list(records)
+        pending = [
+            r
+            for r in records
+            if (properties and r.properties is None)
+            or (tags and r.tags is None)
+            or (features and not r.has_features(features))
+        ]
+        if not pending:
+            return
+        if self._fetcher is None:
+            raise RuntimeError("snapshot was not fetched from a session; can't load more")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(lambda r: self._fetcher.fill(r, properties, tags, features), pending))
+
+    def load_feature(self, records, feature):
+        """Like ``load(records, features=[feature])``, but with one
+        ``admin.vm.feature.Get`` per VM instead of a ``feature.List`` first:
+        cheaper when a single, usually-set feature is all that's needed."""
+        pending = [r for r in records if not r.has_features([feature])]
+        if not pending:
+            return
+        if self._fetcher is None:
+            raise RuntimeError("snapshot was not fetched from a session; can't load more")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(lambda r: self._fetcher.feature(r, feature), pending))
+
+    @classmethod
+    def fetch(cls, session, names=None, properties=True, tags=True, features=(), max_workers=8):
+        """Snapshot ``names`` (default: every domain) in bulk.
+
+        :param session: the shared ``Session`` to read through.
+        :param names: restrict per-VM reads to these domains; unknown names are
+            silently dropped, as ``ls`` has always done.
+        :param properties: fetch every property via ``admin.vm.property.GetAll``.
+        :param tags: fetch tags via ``admin.vm.tag.List``.
+        :param features: names of features to read (only those set on the VM).
+        :param max_workers: parallel per-VM reads; each is an independent call.
+        :returns: a ``FleetSnapshot`` stamped with the session's generation.
+        """
+        app = session.app
+        listing = parse_vm_list(session.listing())
+        if names is not None:
+            wanted = set(names)
+            listing = {n: v for n, v in listing.items() if n in wanted}
+        records = [VMRecord(n, klass=k, power_state=s) for n, (k, s) in listing.items()]
+        snapshot = cls(records, generation=session.generation, app=app, max_workers=max_workers)
+        snapshot.load(properties=properties, tags=tags, features=features)
+        return snapshot
@@ -42,10 +42,13 @@ BuildArch:	noarch
 # package exists in the repos, but never blocks installation where it
 # doesn't. hexagon will error clearly at runtime if the module is missing.
 Recommends:	python3-qubesadmin
-# `hexagon policy` renders its template with Jinja2. dom0 already has it (Ansible
-# and qubesadmin both pull it in), so a soft dep suffices: installed where the
-# package exists, never blocking where hexagon's other verbs are all that's used.
+# `hexagon policy` renders its template through a renderer compiled from it at
+# build time (hexagon/_policy_compiled.py); Jinja2 is only needed to recompile
+# if that's stale. dom0 already has it (Ansible and qubesadmin both pull it in),
+# so a soft dep suffices: installed where the package exists, never blocking.
 Recommends:	python3-jinja2
+# Only `hexagon reconcile --config` reads YAML; dom0 ships PyYAML already.
+Recommends:	python3-pyyaml
 
 %description
 This package contains a Python3 library and "hexagon" CLI
@@ -73,7 +76,7 @@ main()
 EOF
 chmod 0755 %{buildroot}%{_bindir}/%{srcname}
 
-# qvm-reboot is a thin wrapper that execs "hexagon reboot" for qvm-* parity.
+# qvm-reboot is a thin wrapper that runs "hexagon reboot" for qvm-* parity.
 cat > %{buildroot}%{_bindir}/qvm-reboot <<EOF
 #!/usr/bin/python3
 import sys
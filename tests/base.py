@@ -7,6 +7,7 @@ so there's exactly one place to bump it; override per-run with HEXAGON_TEST_TEMP
 
 import os
 import sys
+import threading
 
 from hexagon.qmgr import DEFAULT_TEMPLATE
 
@@ -40,3 +41,49 @@ def vm_name(n):
     """Canonical name for the nth test VM. (Not ``test_``-prefixed so pytest
     doesn't collect it as a test.)"""
     return "{}{}".format(NAME_PREFIX, n)
+
+
+class PoweredFakeVM:
+    """A unit-test VM with a power state: it halts ``halt_after`` seconds after
+    shutdown() is called (never, if None), optionally announcing it on an
+    event source such as the ``fake_events`` fixture."""
+
+    def __init__(self, name, halt_after=0.05, events=None, state="Running"):
+        self.name = name
+        self.klass = "AppVM"
+        self.tags = set()
+        self.connected_vms = []
+        self.state = state
+        self.halt_after = halt_after
+        self.events = events
+        self.killed = False
+        self.starts = 0
+
+    @property
+    def power_state(self):
+        return self.state
+
+    def is_running(self):
+        return self.state != "Halted"
+
+    def get_power_state(self):
+        return self.state
+
+    def start(self):
+        self.starts += 1
+        self.state = "Running"
+
+    def shutdown(self):
+        if self.halt_after is None:
+            return
+
+        def halt():
+            self.state = "Halted"
+            if self.events is not None:
+                self.events.emit(self.name, "domain-shutdown")
+
+        threading.Timer(self.halt_after, halt).start()
+
+    def kill(self):
+        self.killed = True
+        self.state = "Halted"
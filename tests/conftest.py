@@ -18,6 +18,11 @@ Three tiers of tests, separated by marker:
 
 Enable integration tests with ``--run-integration`` or ``HEXAGON_INTEGRATION=1``.
 See docs/testing.md for the management-qube setup and qrexec policy.
+
+``--qubesd-standin`` (or ``HEXAGON_QUBESD_STANDIN=1``) runs the integration
+tier off Qubes: it serves a fake fleet on a local socket (tests/qubesd.py)
+and points qubesadmin, and every ``hexagon`` subprocess, at it. Tests marked
+``live`` need real VMs (boot timing, qrexec into the guest) and are skipped.
 """
 
 import os
@@ -44,6 +49,7 @@ for _mod in ("qubesadmin", "yaml"):
 
 
 INTEGRATION_ENV = "HEXAGON_INTEGRATION"
+STANDIN_ENV = "HEXAGON_QUBESD_STANDIN"
 
 
 def pytest_addoption(parser):
@@ -53,10 +59,51 @@ def pytest_addoption(parser):
         default=False,
         help="run integration tests against a live Qubes Admin API",
     )
+    parser.addoption(
+        "--qubesd-standin",
+        action="store_true",
+        default=False,
+        help="run integration tests against a local fake qubesd (tests/qubesd.py)",
+    )
+
+
+def _standin_requested(config):
+    return config.getoption("--qubesd-standin") or os.environ.get(STANDIN_ENV) == "1"
+
+
+def pytest_configure(config):
+    if not _standin_requested(config):
+        return
+    import tempfile
+
+    from hexagon.qmgr import DEFAULT_TEMPLATE
+    from hexagon.session import SOCKET_ENV
+
+    from .fakequbes import FakeQubes
+    from .qubesd import QubesdServer
+
+    model = FakeQubes()
+    model.add(DEFAULT_TEMPLATE, klass="TemplateVM")
+    model.add("sys-net", running=True, provides_network=True)
+    model.add("sys-firewall", running=True, provides_network=True, netvm="sys-net")
+    path = os.path.join(tempfile.mkdtemp(prefix="hexagon-qubesd-"), "qubesd.sock")
+    config._qubesd_standin = QubesdServer(model, path).start()
+    os.environ[SOCKET_ENV] = path
+
+
+def pytest_unconfigure(config):
+    server = getattr(config, "_qubesd_standin", None)
+    if server is not None:
+        server.stop()
+        os.rmdir(os.path.dirname(server.path))
 
 
 def _integration_requested(config):
-    return config.getoption("--run-integration") or os.environ.get(INTEGRATION_ENV) == "1"
+    return (
+        config.getoption("--run-integration")
+        or os.environ.get(INTEGRATION_ENV) == "1"
+        or _standin_requested(config)
+    )
 
 
 def _admin_api_unavailable_reason():
@@ -67,9 +114,11 @@ def _admin_api_unavailable_reason():
         return "qubesadmin not importable ({})".format(exc)
     if getattr(qubesadmin, "Qubes", None) is None:
         return "qubesadmin is a test stub (Qubes not installed)"
+    from hexagon.session import _new_app
+
     try:
         # Cheapest call that proves both connectivity and admin.vm.List access.
-        list(qubesadmin.Qubes().domains)
+        list(_new_app().domains)
     except Exception as exc:  # qubesadmin.exc.QubesException, qrexec denial, etc.
         return "{}: {}".format(type(exc).__name__, exc)
     return None
@@ -87,6 +136,11 @@ def pytest_collection_modifyitems(config, items):
         skip = pytest.mark.skip(
             reason="integration tests disabled (use --run-integration or HEXAGON_INTEGRATION=1)"
         )
+    if skip is None and _standin_requested(config):
+        skip_live = pytest.mark.skip(reason="needs real VMs, not the qubesd stand-in")
+        for item in items:
+            if "live" in item.keywords:
+                item.add_marker(skip_live)
     if skip is None:
         return
     for item in items:
@@ -97,12 +151,34 @@ def pytest_collection_modifyitems(config, items):
 # --------------------------------------------------------------------------- #
 # Unit fixtures
 # --------------------------------------------------------------------------- #
+# Attributes of a fake VM that aren't Admin API properties.
+_NOT_PROPERTIES = ("name", "tags", "features", "klass", "power_state")
+
+
+def _iter_vms(domains):
+    # Tests swap in either a plain dict or a qubesadmin-like collection that
+    # iterates VM objects; normalize to VM objects.
+    return domains.values() if isinstance(domains, dict) else iter(domains)
+
+
+@pytest.fixture(autouse=True)
+def _isolated_user_state(tmp_path, monkeypatch):
+    """Keep the on-disk fleet snapshot (cache.py) per-test, out of ~/.cache,
+    and never forward to a real ``hexagon serve`` daemon (daemon.py)."""
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setenv("HEXAGON_SOCKET", str(tmp_path / "hexagon.sock"))
+
+
 @pytest.fixture
 def fake_qubes(monkeypatch):
     """Patch qubesadmin.Qubes() with an in-memory app exposing ``.domains``.
 
     Pre-populated with the default template so HexagonQube's template-existence
     check passes. Add fake VMs via ``app.domains[name] = FakeVM(name)``.
+
+    ``qubesd_call`` answers the bulk reads FleetSnapshot makes (``admin.vm.List``,
+    ``property.GetAll``, ``tag.List``, ``feature.List``/``Get``) from the fake
+    VMs' attributes, and records every call in ``app.calls``.
     """
     from hexagon.qmgr import DEFAULT_TEMPLATE
 
@@ -116,21 +192,100 @@ def fake_qubes(monkeypatch):
     class FakeApp:
         def __init__(self):
             self.domains = {DEFAULT_TEMPLATE: FakeVM(DEFAULT_TEMPLATE)}
+            self.calls = []
+
+        def _vm(self, name):
+            return next(vm for vm in _iter_vms(self.domains) if vm.name == name)
+
+        def qubesd_call(self, dest, method, arg=None, payload=None):
+            """Answer the bulk Admin API reads from the fake VMs' attributes."""
+            self.calls.append((dest, method, arg))
+            if method == "admin.vm.List":
+                lines = [
+                    "{} class={} state={}\n".format(
+                        vm.name, getattr(vm, "klass", "AppVM"), getattr(vm, "power_state", "Halted")
+                    )
+                    for vm in _iter_vms(self.domains)
+                ]
+                return "".join(lines).encode()
+            vm = self._vm(dest)
+            if method == "admin.vm.property.GetAll":
+                lines = [
+                    "{} default=False type={} {}\n".format(
+                        k, "vm" if v is None else "str", "" if v is None else v
+                    )
+                    for k, v in sorted(vars(vm).items())
+                    if k not in _NOT_PROPERTIES
+                ]
+                return "".join(lines).encode()
+            if method == "admin.vm.tag.List":
+                return "".join("{}\n".format(t) for t in sorted(vm.tags)).encode()
+            if method == "admin.vm.feature.List":
+                return "".join("{}\n".format(f) for f in getattr(vm, "features", {})).encode()
+            if method == "admin.vm.feature.Get":
+                return str(vm.features[arg]).encode()
+            raise NotImplementedError("fake qubesd: {}".format(method))
 
     app = FakeApp()
+    monkeypatch.delenv("HEXAGON_QUBESD_SOCKET", raising=False)
     monkeypatch.setattr("qubesadmin.Qubes", lambda *a, **k: app, raising=False)
+    # Don't let a process-default Session from an earlier test keep its app.
+    monkeypatch.setattr("hexagon.session._default", None)
     return app
 
 
+@pytest.fixture
+def fake_power(monkeypatch):
+    """Record the halts and starts ``cli.main`` runs, in order, instead of
+    performing them: ``[("halt" | "start", vm name)]``."""
+    ops = []
+
+    def halt(args, vm_name, session=None, history=None, clients=None):
+        ops.append(("halt", vm_name))
+
+    def start(args, vm_name, session=None, budget=None, history=None, readiness=None):
+        ops.append(("start", vm_name))
+
+    monkeypatch.setattr("hexagon.cli.halt_vm", halt)
+    monkeypatch.setattr("hexagon.cli.start_vm", start)
+    return ops
+
+
+@pytest.fixture
+def fake_events():
+    """An in-memory stand-in for the ``admin.Events`` stream.
+
+    Pass it to ``Session(events=...)``; ``emit(vm_name, event)`` delivers an
+    event to every subscriber synchronously, like qubesadmin's dispatcher.
+    """
+
+    class FakeEventSource:
+        def __init__(self):
+            self.callbacks = []
+
+        def subscribe(self, callback):
+            self.callbacks.append(callback)
+
+        def unsubscribe(self, callback):
+            self.callbacks.remove(callback)
+
+        def emit(self, name, event):
+            for callback in list(self.callbacks):
+                callback(name, event)
+
+    return FakeEventSource()
+
+
 # --------------------------------------------------------------------------- #
 # Integration fixtures
 # --------------------------------------------------------------------------- #
 @pytest.fixture(scope="session")
 def app():
-    """Live Qubes app (QubesLocal in dom0, QubesRemote via qrexec from an AppVM)."""
-    import qubesadmin
+    """Live Qubes app (QubesLocal in dom0, QubesRemote via qrexec from an AppVM,
+    or a QubesLocal on the stand-in's socket)."""
+    from hexagon.session import _new_app
 
-    return qubesadmin.Qubes()
+    return _new_app()
 
 
 def _remove_test_vms(app):
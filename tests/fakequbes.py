@@ -0,0 +1,526 @@
+"""An in-process fake Admin API, with simulated latency, for fleet-scale tests.
+
+The ``fake_qubes`` fixture answers just the bulk reads ``FleetSnapshot`` makes.
+``FakeQubes`` models enough of qubesd to run whole commands against hundreds
+of VMs: classes, power states, properties (with netvm and template links),
+tags, features, volumes that go stale when their template is updated, and
+start (starting a halted netvm first, as qubesd does) and shutdown/kill with
+``domain-shutdown`` events.
+
+Everything goes through ``FakeQubes.qubesd_call``, the same single transport
+qubesadmin uses, and the VM objects in ``app.domains`` make the same calls
+qubesadmin's do (a ``property.Get`` per attribute read, a ``volume.Info`` per
+``is_outdated()``, ...). So call counts match what a real host would see, the
+``--profile`` wrapper works unchanged, and each call can be delayed by
+``latency`` seconds (plus up to ``jitter``) to mimic a qrexec round trip from
+a management qube. Calls sleep outside the model's lock, so parallel callers
+overlap as they would against qubesd.
+"""
+
+import random
+import subprocess
+import threading
+import time
+
+# How qubesd types the properties the fake knows about (see _property_line).
+_VM_PROPERTIES = ("netvm", "template", "default_dispvm")
+_BOOL_PROPERTIES = ("autostart", "provides_network")
+_INT_PROPERTIES = ("memory", "maxmem", "vcpus")
+
+
+class FakeQubesError(KeyError):
+    """Raised for requests qubesd would refuse (an unknown VM or feature).
+
+    ``exc_type`` names the ``qubesadmin.exc`` class qubesd would report.
+    """
+
+    def __init__(self, message, exc_type="QubesException"):
+        super().__init__(message)
+        self.exc_type = exc_type
+
+
+class FakeDomainState(object):
+    """qubesd's side of one VM."""
+
+    def __init__(self, name, klass="AppVM", power_state="Halted", **properties):
+        self.name = name
+        self.klass = klass
+        self.power_state = power_state
+        self.properties = {
+            "label": "red",
+            "memory": "400",
+            "maxmem": "4000",
+            "vcpus": "2",
+            "netvm": None,
+            "autostart": "False",
+            "provides_network": "False",
+            "start_time": "",
+        }
+        if klass in ("AppVM", "DispVM"):
+            self.properties["template"] = None
+        self.properties.update({k: None if v is None else str(v) for k, v in properties.items()})
+        self.tags = set()
+        self.features = {}
+        # Time each template last committed its root volume.
+        self.updated = 0.0
+
+
+class FakeQubes(object):
+    """A qubesadmin-like app over an in-memory qubesd.
+
+    :param latency: seconds each Admin API call takes.
+    :param jitter: up to this many seconds more, drawn per call.
+    :param seed: for the jitter, so runs are repeatable.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        # Seconds a started VM's qubes.WaitForSession takes to return.
+        self.session_delay = 0.0
+        self.vms = {}
+        self.calls = []
+        # Calls inside their latency right now, and the most there have been.
+        self.in_flight = 0
+        self.peak = 0
+        self.events = FakeEventSource()
+        self.clock = time.time()
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self.domains = FakeDomainCollection(self)
+
+    def __repr__(self):
+        return "<FakeQubes: {} VMs, {} calls>".format(len(self.vms), len(self.calls))
+
+    # -- building the fleet ------------------------------------------------ #
+
+    def add(self, name, klass="AppVM", running=False, tags=(), features=None, **properties):
+        """Add a VM to the model directly (no call is recorded)."""
+        vm = FakeDomainState(name, klass=klass, **properties)
+        vm.tags.update(tags)
+        vm.features.update(features or {})
+        self.vms[name] = vm
+        if running:
+            self._start(vm)
+        return vm
+
+    def _tick(self):
+        # Wall-clock time, but strictly increasing, so order is never a tie.
+        self.clock = max(self.clock + 0.001, time.time())
+        return self.clock
+
+    def update_template(self, name):
+        """Commit a new root volume for template ``name``: every running child
+        is outdated until it restarts."""
+        self.vms[name].updated = self._tick()
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls = []
+            self.peak = self.in_flight
+
+    def count(self, method=None):
+        """Calls made so far, optionally of one ``method``."""
+        return sum(1 for _dest, m, _arg in self.calls if method is None or m == method)
+
+    # -- the transport ------------------------------------------------------ #
+
+    def qubesd_call(self, dest, method, arg=None, payload=None, *args, **kwargs):
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+        with self._lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            if delay:
+                time.sleep(delay)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        with self._lock:
+            self.calls.append((dest, method, arg))
+            handler = getattr(self, "_" + method.replace(".", "_"), None)
+            if handler is None:
+                raise NotImplementedError("fake qubesd: {}".format(method))
+            if method.startswith("admin.vm.Create."):
+                result, events = handler(dest, arg, payload), ()
+            else:
+                result, events = handler(self._vm(dest), arg, payload)
+        for event in events:
+            # (name, event) for events of another VM, e.g. an auto-started netvm.
+            name, event = event if isinstance(event, tuple) else (dest, event)
+            self.events.emit(name, event)
+        return result.encode() if isinstance(result, str) else result
+
+    def _vm(self, name):
+        if name == "dom0":
+            return None
+        try:
+            return self.vms[name]
+        except KeyError:
+            raise FakeQubesError(name, "QubesVMNotFoundError") from None
+
+    def _start(self, vm):
+        vm.power_state = "Running"
+        vm.properties["start_time"] = str(self._tick())
+
+    def _outdated(self, vm, volume):
+        if vm.power_state == "Halted" or volume != "root" or vm.klass not in ("AppVM", "DispVM"):
+            return False
+        template = self.vms.get(vm.properties.get("template"))
+        while template is not None and template.klass not in ("TemplateVM", "StandaloneVM"):
+            # A DispVM's template is its (AppVM) disposable template.
+            template = self.vms.get(template.properties.get("template"))
+        return template is not None and float(vm.properties["start_time"]) < template.updated
+
+    def _property_line(self, key, value):
+        if key in _VM_PROPERTIES:
+            return "default=False type=vm {}".format(value or "")
+        if key in _BOOL_PROPERTIES:
+            return "default=False type=bool {}".format(value)
+        if key in _INT_PROPERTIES:
+            return "default=False type=int {}".format(value)
+        if key == "label":
+            return "default=False type=label {}".format(value)
+        return "default=False type=str {}".format(value)
+
+    # -- Admin API methods, named after the call ------------------------------ #
+
+    def _admin_vm_List(self, vm, arg, payload):
+        vms = self.vms.values() if vm is None else [vm]
+        return "".join(
+            "{} class={} state={}\n".format(vm.name, vm.klass, vm.power_state) for vm in vms
+        ), ()
+
+    def _admin_vm_CurrentState(self, vm, arg, payload):
+        return "mem=0 mem_static_max=0 cputime=0 power_state={}".format(vm.power_state), ()
+
+    def _admin_vm_property_GetAll(self, vm, arg, payload):
+        lines = [
+            "{} {}\n".format(k, self._property_line(k, v).replace("\n", "\\n"))
+            for k, v in sorted(vm.properties.items())
+        ]
+        return "".join(lines), ()
+
+    def _admin_vm_property_Get(self, vm, arg, payload):
+        if arg not in vm.properties:
+            raise FakeQubesError(arg, "QubesNoSuchPropertyError")
+        return self._property_line(arg, vm.properties[arg]), ()
+
+    def _admin_vm_property_Set(self, vm, arg, payload):
+        value = payload.decode() if isinstance(payload, bytes) else payload
+        vm.properties[arg] = value or None if arg in _VM_PROPERTIES else value
+        return "", ("property-set:" + arg,)
+
+    def _admin_vm_tag_List(self, vm, arg, payload):
+        return "".join("{}\n".format(t) for t in sorted(vm.tags)), ()
+
+    def _admin_vm_tag_Get(self, vm, arg, payload):
+        return "1" if arg in vm.tags else "0", ()
+
+    def _admin_vm_tag_Set(self, vm, arg, payload):
+        vm.tags.add(arg)
+        return "", ("domain-tag-add:" + arg,)
+
+    def _admin_vm_tag_Remove(self, vm, arg, payload):
+        if arg not in vm.tags:
+            raise FakeQubesError(arg, "QubesTagNotFoundError")
+        vm.tags.discard(arg)
+        return "", ("domain-tag-delete:" + arg,)
+
+    def _admin_vm_feature_List(self, vm, arg, payload):
+        return "".join("{}\n".format(f) for f in sorted(vm.features)), ()
+
+    def _admin_vm_feature_Get(self, vm, arg, payload):
+        if arg not in vm.features:
+            raise FakeQubesError(arg, "QubesFeatureNotFoundError")
+        return str(vm.features[arg]), ()
+
+    def _admin_vm_feature_Set(self, vm, arg, payload):
+        vm.features[arg] = payload.decode() if isinstance(payload, bytes) else payload
+        return "", ("domain-feature-set:" + arg,)
+
+    def _admin_vm_volume_List(self, vm, arg, payload):
+        volumes = ["private", "volatile", "kernel"]
+        if vm.klass in ("AppVM", "DispVM", "TemplateVM"):
+            volumes.insert(0, "root")
+        return "".join("{}\n".format(v) for v in volumes), ()
+
+    def _admin_vm_volume_Info(self, vm, arg, payload):
+        snap_on_start = arg == "root" and vm.klass in ("AppVM", "DispVM")
+        return (
+            "pool=lvm\nvid=qubes_dom0/vm-{}-{}\nsnap_on_start={}\nis_outdated={}\n".format(
+                vm.name, arg, snap_on_start, self._outdated(vm, arg)
+            ),
+            (),
+        )
+
+    def _admin_vm_Start(self, vm, arg, payload):
+        if vm.power_state != "Halted":
+            raise FakeQubesError("domain is already running: {}".format(vm.name), "QubesVMError")
+        # Like qubesd, start a halted netvm (and its own) first.
+        events = []
+        netvm = self.vms.get(vm.properties.get("netvm"))
+        if netvm is not None and netvm.power_state == "Halted":
+            _result, netvm_events = self._admin_vm_Start(netvm, None, None)
+            events += [e if isinstance(e, tuple) else (netvm.name, e) for e in netvm_events]
+        self._start(vm)
+        return "", events + ["domain-start"]
+
+    def _admin_vm_Shutdown(self, vm, arg, payload):
+        vm.power_state = "Halted"
+        vm.properties["start_time"] = ""
+        return "", ("domain-stopped", "domain-shutdown")
+
+    _admin_vm_Kill = _admin_vm_Shutdown
+
+    def _create(self, klass, arg, payload):
+        fields = dict(f.split("=", 1) for f in payload.decode().split())
+        if fields["name"] in self.vms:
+            raise FakeQubesError(fields["name"], "QubesValueError")
+        self.add(fields["name"], klass=klass, label=fields.get("label", "red"), template=arg)
+        return ""
+
+    def _admin_vm_Create_AppVM(self, dest, arg, payload):
+        return self._create("AppVM", arg, payload)
+
+    def _admin_vm_Create_StandaloneVM(self, dest, arg, payload):
+        return self._create("StandaloneVM", arg, payload)
+
+    def _admin_vm_Remove(self, vm, arg, payload):
+        del self.vms[vm.name]
+        return "", ("domain-delete",)
+
+    # -- qubesadmin's client side ------------------------------------------------ #
+
+    def add_new_vm(self, klass, name, label, template=None):
+        payload = "name={} label={}".format(name, label).encode()
+        self.qubesd_call("dom0", "admin.vm.Create." + klass, template, payload)
+        self.domains.clear_cache()
+        return self.domains[name]
+
+
+class FakeEventSource(object):
+    """Delivers the model's events to subscribers synchronously."""
+
+    def __init__(self):
+        self.callbacks = []
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        self.callbacks.remove(callback)
+
+    def emit(self, name, event):
+        for callback in list(self.callbacks):
+            callback(name, event)
+
+
+class FakeDomainCollection(object):
+    """``app.domains``: lists domains once (``admin.vm.List``) until
+    ``clear_cache``, as qubesadmin's collection does."""
+
+    def __init__(self, app):
+        self.app = app
+        self._names = None
+
+    def _refresh(self):
+        if self._names is None:
+            data = self.app.qubesd_call("dom0", "admin.vm.List").decode()
+            self._names = [line.split(" ", 1)[0] for line in data.splitlines() if line]
+        return self._names
+
+    def clear_cache(self):
+        self._names = None
+
+    def __contains__(self, name):
+        return name in self._refresh()
+
+    def __getitem__(self, name):
+        if name not in self._refresh():
+            raise KeyError(name)
+        return FakeDomain(self.app, name)
+
+    def __iter__(self):
+        return iter([FakeDomain(self.app, n) for n in self._refresh()])
+
+
+class FakeVolume(object):
+    def __init__(self, app, vm_name, name):
+        self.app = app
+        self.vm_name = vm_name
+        self.name = name
+
+    def is_outdated(self):
+        info = self.app.qubesd_call(self.vm_name, "admin.vm.volume.Info", self.name).decode()
+        return "is_outdated=True" in info.splitlines()
+
+
+class FakeFeatures(object):
+    def __init__(self, app, vm_name):
+        self.app = app
+        self.vm_name = vm_name
+
+    def __getitem__(self, feature):
+        return self.app.qubesd_call(self.vm_name, "admin.vm.feature.Get", feature).decode()
+
+    def __setitem__(self, feature, value):
+        self.app.qubesd_call(self.vm_name, "admin.vm.feature.Set", feature, str(value).encode())
+
+    def get(self, feature, default=None):
+        try:
+            return self[feature]
+        except KeyError:
+            return default
+
+
+class FakeDomain(object):
+    """A qubesadmin-like VM: every attribute read or write is an Admin API call."""
+
+    def __init__(self, app, name):
+        object.__setattr__(self, "app", app)
+        object.__setattr__(self, "name", name)
+
+    def __repr__(self):
+        return self.name
+
+    def __eq__(self, other):
+        return getattr(other, "name", other) == self.name
+
+    def __hash__(self):
+        return hash(self.name)
+
+    def _call(self, method, arg=None, payload=None):
+        return self.app.qubesd_call(self.name, method, arg, payload).decode()
+
+    @property
+    def klass(self):
+        # qubesadmin keeps the class from admin.vm.List; so does this.
+        return self.app.vms[self.name].klass
+
+    def __getattr__(self, key):
+        if key.startswith("_"):
+            raise AttributeError(key)
+        try:
+            line = self._call("admin.vm.property.Get", key)
+        except FakeQubesError:
+            raise AttributeError(key) from None
+        _default, prop_type, value = (line.split(" ", 2) + [""])[:3]
+        if prop_type == "type=vm":
+            return self.app.domains[value] if value else None
+        if prop_type == "type=bool":
+            return value == "True"
+        return value
+
+    def __setattr__(self, key, value):
+        value = "" if value is None else getattr(value, "name", value)
+        self._call("admin.vm.property.Set", key, str(value).encode())
+
+    @property
+    def tags(self):
+        return set(self._call("admin.vm.tag.List").split())
+
+    @property
+    def features(self):
+        return FakeFeatures(self.app, self.name)
+
+    @property
+    def volumes(self):
+        names = self._call("admin.vm.volume.List").split()
+        return {n: FakeVolume(self.app, self.name, n) for n in names}
+
+    @property
+    def connected_vms(self):
+        # qubesadmin reads every domain's netvm: one property.Get each.
+        return [vm for vm in self.app.domains if vm.netvm == self]
+
+    def get_power_state(self):
+        line = self._call("admin.vm.CurrentState")
+        return dict(f.split("=", 1) for f in line.split())["power_state"]
+
+    def is_running(self):
+        return self.get_power_state() != "Halted"
+
+    def start(self):
+        self._call("admin.vm.Start")
+
+    def shutdown(self):
+        self._call("admin.vm.Shutdown")
+
+    def kill(self):
+        self._call("admin.vm.Kill")
+
+    def run(self, command, user=None):
+        # `sudo poweroff` over qubes.VMShell; modelled as a clean shutdown.
+        self._call("admin.vm.Shutdown")
+
+    def run_service(self, service, autostart=True, **kwargs):
+        # A qrexec call into the guest, not an Admin API one: not counted.
+        # Only qubes.WaitForSession is modelled, taking ``session_delay``.
+        if service != "qubes.WaitForSession":
+            raise NotImplementedError("fake qrexec: {}".format(service))
+        state = self.app.vms[self.name]
+        if state.power_state == "Halted":
+            return FakeProcess(1)
+        return FakeProcess(0, self.app.session_delay)
+
+
+class FakeProcess(object):
+    """Enough of ``subprocess.Popen`` for a service call that takes ``delay``."""
+
+    def __init__(self, returncode, delay=0.0):
+        self.returncode = None
+        self._returncode = returncode
+        self._delay = delay
+
+    def communicate(self, timeout=None):
+        if timeout is not None and self._delay > timeout:
+            time.sleep(timeout)
+            raise subprocess.TimeoutExpired("qrexec-client", timeout)
+        time.sleep(self._delay)
+        self.returncode = self._returncode
+        return None, None
+
+    def kill(self):
+        self._delay = 0.0
+        self._returncode = -9
+
+
+def build_fleet(n, latency=0.0, jitter=0.0, seed=0):
+    """A FakeQubes with ``n`` AppVMs behind sys-firewall/sys-net, on three
+    templates, fedora-43's updated since half its running children started.
+
+    AppVM ``i`` is running if i is even, tagged ``hexagon`` if i % 4 != 3,
+    ``work`` if i % 3 == 0, has updates available if i % 5 == 0, and is based
+    on fedora-43, debian-13 and whonix-18 in turn.
+    """
+    app = FakeQubes(latency=latency, jitter=jitter, seed=seed)
+    templates = ("fedora-43", "debian-13", "whonix-18")
+    for template in templates:
+        app.add(template, klass="TemplateVM", netvm=None)
+    app.add("sys-net", running=True, template="fedora-43", provides_network="True")
+    app.add(
+        "sys-firewall",
+        running=True,
+        template="fedora-43",
+        provides_network="True",
+        netvm="sys-net",
+    )
+    for i in range(n):
+        tags = {"hexagon"} if i % 4 != 3 else set()
+        if i % 3 == 0:
+            tags.add("work")
+        app.add(
+            "vm-{:04d}".format(i),
+            running=i % 2 == 0,
+            tags=tags,
+            features={"updates-available": "1"} if i % 5 == 0 else {},
+            template=templates[i % 3],
+            netvm="sys-firewall",
+            label="red" if i % 2 else "blue",
+        )
+        if i == n // 2:
+            app.update_template("fedora-43")
+    if n < 2:
+        app.update_template("fedora-43")
+    return app
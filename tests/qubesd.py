@@ -0,0 +1,210 @@
+"""A stand-in for qubesd's Admin API socket, backed by tests/fakequbes.py.
+
+qubesadmin talks to qubesd in dom0 over a Unix socket, one connection per
+call: the client sends ``<method>+<arg> <source> name <dest>\\0``, then the
+payload, then shuts down its write side. Older clients, and qubesadmin's
+``EventsDispatcher`` on the local socket, send the NUL-separated form
+``<source>\\0<method>\\0<dest>\\0<arg>\\0`` instead; both are accepted.
+qubesd answers ``0\\0<data>`` on success, or
+``2\\0<exception class>\\0<traceback>\\0<format>\\0<args>\\0...`` on error,
+and closes. ``admin.Events`` keeps the connection open and streams
+``1\\0<subject>\\0<event>\\0<key>\\0<value>\\0...\\0`` records instead.
+
+``QubesdServer`` speaks that protocol on a socket of your choosing, answering
+from a ``FakeQubes`` model -- so the unmodified qubesadmin client, and every
+``hexagon`` subcommand through it, runs on any Linux box, paying the real
+client's connection and parsing costs plus whatever latency the model
+injects. Point hexagon at it with ``HEXAGON_QUBESD_SOCKET`` (session.py), or
+run the integration tier against it (``--qubesd-standin``, see conftest.py).
+
+It also runs on its own, for poking at by hand::
+
+    python -m tests.qubesd --socket /tmp/qubesd.sock --vms 300 --latency 0.004
+    HEXAGON_QUBESD_SOCKET=/tmp/qubesd.sock hexagon --profile ls --outdated
+"""
+
+import argparse
+import os
+import queue
+import socketserver
+import sys
+import threading
+
+from .fakequbes import FakeQubesError, build_fleet
+
+EVENTS = "admin.Events"
+
+
+def encode_error(exc_type, message):
+    # No format arguments: the message goes through as the format string.
+    return b"\0".join([b"2", exc_type.encode(), b"", message.replace("%", "%%").encode(), b""])
+
+
+def encode_event(subject, event, **kwargs):
+    fields = [b"1", (subject or "").encode(), event.encode()]
+    for key, value in kwargs.items():
+        fields += [key.encode(), str(value).encode()]
+    return b"\0".join(fields) + b"\0\0"
+
+
+def parse_request(data):
+    """``(method, arg, dest, payload)`` from one request's bytes.
+
+    :raises ValueError: if the header is malformed.
+    """
+    header, sep, payload = data.partition(b"\0")
+    if not sep:
+        raise ValueError("request header not terminated")
+    if b" " not in header:
+        return _parse_nul_request(header, payload)
+    method_arg, _source, dest_type, dest = header.decode("ascii").split(" ", 3)
+    if (dest_type, dest) == ("keyword", "adminvm"):
+        dest_type, dest = "name", "dom0"
+    if dest_type != "name":
+        raise ValueError("unsupported destination type: {}".format(dest_type))
+    method, _plus, arg = method_arg.partition("+")
+    return method, arg or None, dest, payload or None
+
+
+def _parse_nul_request(source, rest):
+    # ``<source>\0<method>\0<dest>\0<arg>\0<payload>``: source already split off.
+    fields = rest.split(b"\0", 3)
+    if not source or len(fields) < 4:
+        raise ValueError("request header not terminated")
+    method, dest, arg, payload = fields
+    return (
+        method.decode("ascii"),
+        arg.decode("ascii") or None,
+        dest.decode("ascii"),
+        payload or None,
+    )
+
+
+def _header_complete(data):
+    # An events client may keep its write side open: stop reading once the
+    # header is in, in either form.
+    header, sep, rest = data.partition(b"\0")
+    if not sep:
+        return False
+    if b" " in header:
+        return header.startswith(EVENTS.encode())
+    return rest.startswith(EVENTS.encode() + b"\0") and rest.count(b"\0") >= 3
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        model = self.server.model
+        chunks = []
+        while True:
+            chunk = self.request.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if _header_complete(b"".join(chunks)):
+                break
+        try:
+            method, arg, dest, payload = parse_request(b"".join(chunks))
+        except ValueError as e:
+            self.wfile.write(encode_error("ProtocolError", str(e)))
+            return
+        if method == EVENTS:
+            self._stream_events(model)
+            return
+        try:
+            data = model.qubesd_call(dest, method, arg, payload)
+        except FakeQubesError as e:
+            self.wfile.write(encode_error(e.exc_type, str(e.args[0])))
+        except NotImplementedError as e:
+            self.wfile.write(encode_error("QubesException", str(e)))
+        else:
+            self.wfile.write(b"0\0" + data)
+
+    def _stream_events(self, model):
+        pending = queue.Queue()
+
+        def callback(name, event):
+            pending.put((name, event))
+
+        model.events.subscribe(callback)
+        try:
+            while not self.server.stopping.is_set():
+                try:
+                    name, event = pending.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                self.wfile.write(encode_event(name, event))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            model.events.unsubscribe(callback)
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class QubesdServer(object):
+    """Serve ``model`` on the Unix socket at ``path``, in a background thread.
+
+    :param model: a ``FakeQubes``; script it (add VMs, update templates,
+        change ``latency``) before or while clients are connected.
+    """
+
+    def __init__(self, model, path):
+        self.model = model
+        self.path = path
+        self._server = None
+        self._thread = None
+
+    def __repr__(self):
+        return "<QubesdServer: {} on {}>".format(self.model, self.path)
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = _Server(self.path, _Handler)
+        self._server.model = self.model
+        self._server.stopping = threading.Event()
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="qubesd-standin", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.stopping.set()
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a fake fleet on a qubesd-like socket")
+    parser.add_argument("--socket", required=True, help="Unix socket path to listen on")
+    parser.add_argument("--vms", type=int, default=0, help="AppVMs in the fleet (build_fleet)")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra seconds, at most")
+    args = parser.parse_args(argv)
+    model = build_fleet(args.vms, latency=args.latency, jitter=args.jitter)
+    server = QubesdServer(model, args.socket).start()
+    sys.stderr.write("Serving {} on {}\n".format(model, args.socket))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+"""Unit tests for memory-budgeted admission of VM starts."""
+
+import threading
+import time
+
+import pytest
+
+from hexagon import admission, cli
+from hexagon.session import Session
+from hexagon.snapshot import FleetSnapshot, VMRecord
+
+from .fakequbes import build_fleet
+
+pytestmark = pytest.mark.unit
+
+
+def _record(name, memory, power_state="Halted"):
+    return VMRecord(name, power_state=power_state, properties={"memory": str(memory)})
+
+
+def test_admits_while_budget_allows_and_queues_the_rest():
+    budget = admission.MemoryBudget(1000, {"a": 400, "b": 400, "c": 400})
+    peak = []
+    lock = threading.Lock()
+    active = []
+
+    def start(name):
+        with budget.admit(name):
+            with lock:
+                active.append(name)
+                peak.append(len(active))
+            time.sleep(0.05)
+            with lock:
+                active.remove(name)
+            # A failed start hands its memory back, letting the next one in.
+            raise RuntimeError("start failed")
+
+    threads = [threading.Thread(target=lambda n=n: _swallow(start, n)) for n in "abc"]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert max(peak) == 2
+    assert budget.available == 1000
+
+
+def _swallow(func, *args):
+    try:
+        func(*args)
+    except RuntimeError:
+        pass
+
+
+def test_successful_start_keeps_its_reservation():
+    budget = admission.MemoryBudget(1000, {"a": 400})
+    with budget.admit("a"):
+        pass
+    assert budget.available == 600
+    assert budget.in_flight == 0
+
+
+def test_oversized_start_runs_alone_instead_of_deadlocking():
+    budget = admission.MemoryBudget(100, {"big": 4000})
+    with budget.admit("big"):
+        assert budget.in_flight == 1
+
+
+def test_release_wakes_queued_starts():
+    budget = admission.MemoryBudget(500, {"a": 400, "b": 400})
+    admitted = threading.Event()
+    with budget.admit("a"):
+        t = threading.Thread(target=lambda: _admit_and_signal(budget, "b", admitted))
+        t.start()
+        time.sleep(0.05)
+        assert not admitted.is_set()
+        budget.release(400)
+        assert admitted.wait(1)
+    t.join()
+
+
+def _admit_and_signal(budget, name, event):
+    with budget.admit(name):
+        event.set()
+
+
+def test_host_budget_is_free_memory_plus_what_balancing_can_reclaim():
+    work = VMRecord("work", power_state="Running", properties={"memory": "400", "maxmem": "4000"})
+    # PCI passthrough: no balancing, its allocation is fixed.
+    net = VMRecord("sys-net", power_state="Running", properties={"memory": "400", "maxmem": "0"})
+    snap = FleetSnapshot([_record("dom0", 4000, "Running"), work, net, _record("x", 800)])
+    # dom0's 6000 MiB and work's stubdomain aren't free, whatever their `memory`.
+    allocations = {"Domain-0": 6000, "work": 1500, "work-dm": 144, "sys-net": 400}
+    assert admission.host_budget(snap, free_memory=2000, allocations=allocations) == 3100
+
+
+def test_host_budget_reads_xl(monkeypatch):
+    outputs = {
+        "info": "total_memory           : 32000\nfree_memory            : 1200\n",
+        "list": (
+            "Name                                        ID   Mem VCPUs\tState\tTime(s)\n"
+            "Domain-0                                     0  4096     4     r-----     1.0\n"
+            "work                                         3  1000     2     -b----     2.0\n"
+            "work-dm                                      4   144     1     -b----     0.1\n"
+        ),
+    }
+    monkeypatch.setattr(admission, "_xl", lambda command: outputs[command])
+    work = VMRecord("work", power_state="Running", properties={"memory": "400", "maxmem": "4000"})
+    assert admission.xl_allocations()["work-dm"] == 144
+    assert admission.host_budget(FleetSnapshot([work])) == 1800
+
+
+def test_host_budget_unknown_outside_dom0(monkeypatch):
+    monkeypatch.setattr(admission, "xl_free_memory", lambda: None)
+    assert admission.host_budget(FleetSnapshot([])) is None
+
+
+def test_successful_starts_fill_the_budget_and_the_next_start_fails():
+    budget = admission.MemoryBudget(1000, {"a": 400, "b": 400, "c": 400})
+    for name in "ab":
+        with budget.admit(name):
+            pass
+    # Nothing is in flight to hand memory back: waiting would never end.
+    with pytest.raises(admission.MemoryExhausted, match="c needs 400 MiB, 200 MiB"):
+        with budget.admit("c"):
+            pass
+    assert (budget.used, budget.in_flight) == (800, 0)
+
+
+def test_queued_start_waits_for_the_start_in_flight():
+    budget = admission.MemoryBudget(500, {"a": 400, "b": 400})
+    outcome = []
+    entered = threading.Event()
+
+    def queued():
+        entered.set()
+        try:
+            with budget.admit("b"):
+                outcome.append("admitted")
+        except admission.MemoryExhausted:
+            outcome.append("exhausted")
+
+    with budget.admit("a"):
+        t = threading.Thread(target=queued)
+        t.start()
+        entered.wait(1)
+        time.sleep(0.05)
+        assert outcome == []
+    # a kept its memory, so b can never fit.
+    t.join(1)
+    assert outcome == ["exhausted"]
+
+
+def test_oversized_start_waits_for_the_others_and_warns(caplog):
+    budget = admission.MemoryBudget(1000, {"a": 400, "big": 4000})
+    admitted = threading.Event()
+    with budget.admit("a"):
+        t = threading.Thread(target=lambda: _admit_and_signal(budget, "big", admitted))
+        t.start()
+        assert not admitted.wait(0.05)
+    assert admitted.wait(1)
+    t.join()
+    assert "big needs 4000 MiB, more than the whole 1000 MiB budget" in caplog.text
+
+
+def test_vm_memory_is_capped_by_maxmem():
+    assert admission.vm_memory(_record("a", 400)) == 400
+    record = VMRecord("b", properties={"memory": "4000", "maxmem": "2000"})
+    assert admission.vm_memory(record) == 2000
+    record = VMRecord("c", properties={"memory": "400", "maxmem": "0"})
+    assert admission.vm_memory(record) == 400
+
+
+def test_cli_start_fails_what_the_budget_cannot_hold(capsys):
+    fleet = build_fleet(6)
+    with pytest.raises(SystemExit) as e:
+        cli.main(
+            ["--no-cache", "start", "--memory-budget", "900", "vm-0001", "vm-0003", "vm-0005"],
+            session=Session(app=fleet),
+        )
+    assert e.value.code == 1
+    assert fleet.count("admin.vm.Start") == 2
+    assert "start: 2 ok, 1 failed" in capsys.readouterr().err
@@ -0,0 +1,95 @@
+"""Unit tests for the asyncio execution engine."""
+
+import asyncio
+import time
+
+import pytest
+
+from hexagon import cli
+from hexagon.aio import AsyncEngine
+from hexagon.session import Session
+
+from .base import PoweredFakeVM
+
+pytestmark = pytest.mark.unit
+
+
+@pytest.fixture
+def fleet(fake_qubes, fake_events):
+    for n in range(10):
+        vm = PoweredFakeVM("vm-{}".format(n), halt_after=0.05, events=fake_events)
+        fake_qubes.domains[vm.name] = vm
+    return fake_qubes
+
+
+def test_halt_returns_on_event_not_poll(fleet, fake_events):
+    engine = AsyncEngine(Session(app=fleet, events=fake_events), poll_interval=5)
+    start = time.monotonic()
+    results = engine.run([("shutdown", [list(fleet.domains)[1:]], engine.halt)])
+    assert time.monotonic() - start < 2
+    assert all(e is None for _phase, _name, e in results)
+    assert all(not vm.is_running() and not vm.killed for vm in list(fleet.domains.values())[1:])
+
+
+def test_halt_kills_after_timeout(fake_qubes, fake_events):
+    fake_qubes.domains["stuck"] = vm = PoweredFakeVM("stuck", halt_after=None)
+    session = Session(app=fake_qubes, events=fake_events)
+    engine = AsyncEngine(session, poll_interval=0.05, timeout=0.2)
+    engine.run([("shutdown", [["stuck"]], engine.halt)])
+    assert vm.killed
+
+
+def test_runs_leave_no_subscription_behind(fleet, fake_events):
+    # Under `hexagon serve` one session, and its event source, serves every run.
+    session = Session(app=fleet, events=fake_events)
+    before = len(fake_events.callbacks)
+    for _ in range(3):
+        engine = AsyncEngine(session, poll_interval=5)
+        engine.run([("shutdown", [["vm-1"]], engine.halt)])
+    assert len(fake_events.callbacks) == before
+
+
+def test_concurrency_is_capped_by_semaphore(fleet, fake_events):
+    engine = AsyncEngine(Session(app=fleet, events=fake_events), concurrency=3)
+    active = []
+    peak = []
+
+    async def op(name):
+        active.append(name)
+        peak.append(len(active))
+        await asyncio.sleep(0.01)
+        active.remove(name)
+
+    engine.run([("op", [["vm-{}".format(n) for n in range(10)]], op)])
+    assert max(peak) == 3
+
+
+def test_failed_vms_skip_later_phases(fleet, fake_events):
+    engine = AsyncEngine(Session(app=fleet, events=fake_events))
+
+    async def fail_vm1(name):
+        if name == "vm-1":
+            raise RuntimeError("boom")
+
+    results = engine.run(
+        [("first", [["vm-1", "vm-2"]], fail_vm1), ("start", [["vm-1", "vm-2"]], engine.start)]
+    )
+    assert [(p, n) for p, n, _e in results] == [
+        ("first", "vm-1"),
+        ("first", "vm-2"),
+        ("start", "vm-2"),
+    ]
+    assert fleet.domains["vm-2"].starts == 1
+    assert fleet.domains["vm-1"].starts == 0
+
+
+def test_cli_shutdown_with_asyncio_engine(fleet, fake_events, monkeypatch):
+    monkeypatch.setattr(cli, "Session", lambda: Session(app=fleet, events=fake_events))
+    argv = ["hexagon", "--engine", "asyncio", "shutdown", "vm-1", "vm-2"]
+    monkeypatch.setattr(cli.sys, "argv", argv)
+    start = time.monotonic()
+    cli.main()
+    assert time.monotonic() - start < 2
+    assert not fleet.domains["vm-1"].is_running()
+    assert not fleet.domains["vm-2"].is_running()
+    assert fleet.domains["vm-3"].is_running()
@@ -0,0 +1,116 @@
+"""Fleet-scale benchmarks against the in-process fake Admin API.
+
+Each scenario runs a real ``cli.main`` command against a ``build_fleet(n)``
+fake (see tests/fakequbes.py) and counts the Admin API calls it makes -- the
+figure that decides latency from a management qube, where every call is a
+qrexec round trip. Counts are deterministic, so each scenario has a budget
+per fleet size, ~10% over today's count: a change that adds calls fails
+here, and one that removes them should lower the budget.
+
+Wall time is reported, not asserted. Set ``HEXAGON_BENCH_LATENCY`` (and
+optionally ``HEXAGON_BENCH_JITTER``), in seconds per call, to see how the
+commands behave over a slow transport::
+
+    HEXAGON_BENCH_LATENCY=0.004 pytest -m bench -s
+"""
+
+import contextlib
+import io
+import logging
+import os
+import time
+
+import pytest
+
+from hexagon import cli
+from hexagon.session import Session
+
+from .fakequbes import build_fleet
+
+pytestmark = [pytest.mark.unit, pytest.mark.bench]
+
+LATENCY = float(os.environ.get("HEXAGON_BENCH_LATENCY", "0"))
+JITTER = float(os.environ.get("HEXAGON_BENCH_JITTER", "0"))
+
+SIZES = (10, 100, 1000)
+
+# argv, then the call budget at each of SIZES.
+SCENARIOS = {
+    "ls": (["ls"], (2, 2, 2)),
+    "ls --tags": (["ls", "--tags", "hexagon,!work"], (18, 117, 1107)),
+    "ls --template": (["ls", "--template", "fedora-43"], (18, 117, 1107)),
+    "ls --property": (["ls", "--property", "label=blue"], (18, 117, 1107)),
+    "ls --updatable": (["ls", "--updatable"], (20, 139, 1327)),
+    "ls --outdated": (["ls", "--outdated"], (43, 159, 713)),
+    "reboot --outdated": (["reboot", "--outdated"], (63, 263, 1642)),
+    "shutdown --tags": (["shutdown", "--tags", "work"], (37, 268, 2578)),
+    "reconcile": (["reconcile", "--tags", "work", "--label", "green"], (51, 381, 3681)),
+}
+
+
+def _run(app, argv):
+    session = Session(app=app, events=app.events)
+    root = logging.getLogger()
+    level = root.level
+    stdout = io.StringIO()
+    start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(stdout):
+            cli.main(["--no-cache"] + argv, session=session)
+        code = 0
+    except SystemExit as e:
+        code = e.code
+    finally:
+        # cli.main turns on debug logging; per-VM lines would dominate.
+        root.setLevel(level)
+    return code, time.perf_counter() - start, stdout.getvalue()
+
+
+@pytest.fixture(autouse=True)
+def _quiet(monkeypatch):
+    monkeypatch.setattr(logging, "basicConfig", lambda **kwargs: None)
+
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("scenario", list(SCENARIOS))
+def test_call_budget(scenario, size):
+    argv, budgets = SCENARIOS[scenario]
+    budget = budgets[SIZES.index(size)]
+    app = build_fleet(size, latency=LATENCY, jitter=JITTER)
+    code, elapsed, _out = _run(app, argv)
+    assert code in (0, None)
+    print("\n{:>5} VMs  {:<18} {:>7} calls  {:>8.3f}s".format(size, scenario, app.count(), elapsed))
+    assert app.count() <= budget, "{} at {} VMs: {} calls, budget {}".format(
+        scenario, size, app.count(), budget
+    )
+
+
+def test_fleet_commands_do_what_they_say():
+    app = build_fleet(12)
+    _code, _elapsed, out = _run(app, ["ls", "--outdated"])
+    # fedora-43 children that were running before its update: sys-net,
+    # sys-firewall, and every sixth AppVM up to the middle of the fleet.
+    assert out.split() == ["sys-firewall", "sys-net", "vm-0000", "vm-0006"]
+
+    _run(app, ["reboot", "--outdated"])
+    app.reset_calls()
+    _code, _elapsed, out = _run(app, ["ls", "--outdated"])
+    assert out.split() == []
+
+    _run(app, ["shutdown", "--tags", "work"])
+    assert [
+        n for n, vm in app.vms.items() if "work" in vm.tags and vm.power_state != "Halted"
+    ] == []
+
+    _run(app, ["reconcile", "--tags", "work", "--label", "green"])
+    assert {app.vms[n].properties["label"] for n in app.vms if "work" in app.vms[n].tags} == {
+        "green"
+    }
+
+
+def test_latency_overlaps_parallel_calls():
+    app = build_fleet(16, latency=0.01)
+    _run(app, ["ls", "--tags", "hexagon"])
+    # The listing, then 21 tag.List calls, eight at a time.
+    assert app.count() == 22
+    assert 1 < app.peak <= 8
@@ -0,0 +1,155 @@
+"""Unit tests for the persistent on-disk fleet snapshot."""
+
+import pytest
+
+from hexagon import cache as cache_mod
+from hexagon import cli
+from hexagon.cache import FleetCache
+from hexagon.session import Session
+
+pytestmark = pytest.mark.unit
+
+
+class FakeVM:
+    def __init__(self, name, label="red"):
+        self.name = name
+        self.klass = "AppVM"
+        self.tags = {"hexagon"}
+        self.features = {}
+        self.label = label
+
+
+@pytest.fixture
+def fleet(fake_qubes):
+    for name in ("work", "personal"):
+        fake_qubes.domains[name] = FakeVM(name)
+    return fake_qubes
+
+
+def _warm(cache, session):
+    snapshot = cache.snapshot(session)
+    snapshot.load(properties=True, tags=True)
+    cache.save(snapshot)
+    return snapshot
+
+
+def _per_vm_calls(app):
+    return [c for c in app.calls if c[1] != "admin.vm.List"]
+
+
+def test_repeat_snapshot_reuses_saved_records(fleet, tmp_path):
+    session = Session(app=fleet)
+    _warm(FleetCache(str(tmp_path)), session)
+    fleet.calls.clear()
+
+    snapshot = FleetCache(str(tmp_path)).snapshot(session)
+    snapshot.load(properties=True, tags=True)
+
+    assert _per_vm_calls(fleet) == []
+    assert snapshot["work"].properties["label"] == "red"
+    assert "hexagon" in snapshot["work"].tags
+
+
+def test_dirty_vm_is_refetched(fleet, tmp_path):
+    session = Session(app=fleet)
+    _warm(FleetCache(str(tmp_path)), session)
+    fleet.domains["work"].label = "blue"
+    FleetCache(str(tmp_path)).invalidate(["work"])
+    fleet.calls.clear()
+
+    snapshot = FleetCache(str(tmp_path)).snapshot(session)
+    snapshot.load(properties=True)
+
+    assert {c[0] for c in _per_vm_calls(fleet)} == {"work"}
+    assert snapshot["work"].properties["label"] == "blue"
+
+
+def test_save_clears_consumed_dirty_marks(fleet, tmp_path):
+    session = Session(app=fleet)
+    cache = FleetCache(str(tmp_path))
+    cache.invalidate(["work"])
+    snapshot = cache.snapshot(session)
+    # Marked after the snapshot was taken: must survive the save.
+    FleetCache(str(tmp_path)).invalidate(["personal"])
+    cache.save(snapshot)
+
+    with open(cache.dirty_file) as f:
+        assert f.read() == "personal\n"
+
+
+def test_expired_records_are_refetched(fleet, tmp_path, monkeypatch):
+    session = Session(app=fleet)
+    _warm(FleetCache(str(tmp_path), max_age=60), session)
+    now = cache_mod.time.time()
+    monkeypatch.setattr(cache_mod.time, "time", lambda: now + 61)
+    fleet.calls.clear()
+
+    FleetCache(str(tmp_path), max_age=60).snapshot(session).load(properties=True)
+
+    assert {c[0] for c in _per_vm_calls(fleet)} >= {"work", "personal"}
+
+
+def test_listing_changes_drop_and_add_vms(fleet, tmp_path):
+    session = Session(app=fleet)
+    _warm(FleetCache(str(tmp_path)), session)
+    del fleet.domains["personal"]
+    fleet.domains["vault"] = FakeVM("vault")
+    fleet.domains["work"].klass = "DispVM"
+
+    snapshot = FleetCache(str(tmp_path)).snapshot(session)
+
+    assert "personal" not in snapshot
+    assert snapshot["vault"].properties is None
+    assert snapshot["work"].klass == "DispVM"
+    assert snapshot["work"].properties is None
+
+
+def test_generation_moves_only_on_change(fleet, tmp_path):
+    session = Session(app=fleet)
+    first = _warm(FleetCache(str(tmp_path)), session).generation
+    assert _warm(FleetCache(str(tmp_path)), session).generation == first
+
+    FleetCache(str(tmp_path)).invalidate(["work"])
+    assert _warm(FleetCache(str(tmp_path)), session).generation != first
+
+
+def test_watch_marks_changed_vms_dirty(fake_events, tmp_path):
+    cache = FleetCache(str(tmp_path))
+    cache.watch(fake_events)
+    fake_events.emit("work", "domain-start")
+    fake_events.emit("work", "property-set:label")
+    fake_events.emit("vault", "domain-tag-add:hexagon")
+
+    assert cache._dirty() == {"work", "vault"}
+
+
+def test_daemon_ls_answers_repeat_runs_from_the_cache(fleet, fake_events, capsys):
+    # A session following events (hexagon serve) trusts what the listener
+    # hasn't marked dirty.
+    session = Session(app=fleet, events=fake_events)
+    session.follow()
+    FleetCache().watch(fake_events)
+    for _ in range(2):
+        fleet.calls.clear()
+        with pytest.raises(SystemExit):
+            cli.main(["ls", "--tags", "hexagon"], session=session)
+
+    assert _per_vm_calls(fleet) == []
+    assert capsys.readouterr().out.split() == ["personal", "work"] * 2
+
+    fleet.domains["work"].tags.discard("hexagon")
+    fake_events.emit("work", "domain-tag-delete:hexagon")
+    with pytest.raises(SystemExit):
+        cli.main(["ls", "--tags", "hexagon"], session=session)
+    assert capsys.readouterr().out.split() == ["personal"]
+
+
+def test_cli_sees_tags_changed_between_runs(fleet, capsys):
+    # Outside the daemon nothing marks a `qvm-tags` change dirty: saved tags
+    # must not be trusted.
+    for _ in range(2):
+        with pytest.raises(SystemExit):
+            cli.main(["ls", "--tags", "hexagon"], session=Session(app=fleet))
+        fleet.domains["work"].tags.discard("hexagon")
+
+    assert capsys.readouterr().out.split() == ["personal", "work", "personal"]
@@ -0,0 +1,184 @@
+"""Unit tests for the `hexagon serve` daemon and its CLI client."""
+
+import json
+import os
+import socket
+import threading
+
+import pytest
+
+from hexagon import cli, daemon
+from hexagon.session import Session
+
+pytestmark = pytest.mark.unit
+
+
+class FakeVM:
+    def __init__(self, name, tags=()):
+        self.name = name
+        self.klass = "AppVM"
+        self.tags = set(tags)
+        self.features = {}
+
+
+@pytest.fixture
+def served(fake_qubes, fake_events, tmp_path):
+    """A Daemon over the fake fleet, serving on the test's socket."""
+    fake_qubes.domains["work"] = FakeVM("work", tags=["hexagon"])
+    fake_qubes.domains["vault"] = FakeVM("vault")
+    server = daemon.Daemon(Session(app=fake_qubes, events=fake_events))
+    server.bind()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join(5)
+
+
+def _listings(app):
+    return [c for c in app.calls if c[1] == "admin.vm.List"]
+
+
+def test_forward_relays_output_and_exit_code(served, capsys, caplog):
+    caplog.set_level("DEBUG")
+    assert daemon.forward(["--no-cache", "ls", "--tags", "hexagon"]) == 0
+    captured = capsys.readouterr()
+    assert captured.out == "work\n"
+    assert "Listing VMs" in captured.err
+
+
+def test_forward_reports_failures(served, capsys):
+    assert daemon.forward(["start", "no-such-vm"]) == 1
+    assert "Some VMs could not be found" in capsys.readouterr().err
+
+
+def test_daemon_keeps_listing_until_an_event_moves_it(served, fake_qubes, fake_events):
+    for _ in range(2):
+        daemon.forward(["--no-cache", "ls"])
+    assert len(_listings(fake_qubes)) == 1
+
+    fake_qubes.domains["new"] = FakeVM("new")
+    fake_events.emit("new", "domain-add")
+    daemon.forward(["--no-cache", "ls"])
+    assert len(_listings(fake_qubes)) == 2
+
+    # Tag changes don't alter the listing; the fleet cache handles those.
+    fake_events.emit("work", "domain-tag-add:foo")
+    daemon.forward(["--no-cache", "ls"])
+    assert len(_listings(fake_qubes)) == 2
+
+
+def test_forward_without_daemon_returns_none(tmp_path):
+    assert daemon.forward(["ls"], path=str(tmp_path / "absent.sock")) is None
+
+
+def test_bind_replaces_stale_socket(fake_qubes, tmp_path):
+    path = str(tmp_path / "stale.sock")
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+
+    server = daemon.Daemon(Session(app=fake_qubes), path=path)
+    server.bind()
+    try:
+        assert os.stat(path).st_mode & 0o077 == 0
+        with pytest.raises(RuntimeError):
+            daemon.Daemon(Session(app=fake_qubes), path=path).bind()
+    finally:
+        server._server.server_close()
+
+
+def test_cli_forwards_to_running_daemon(served, fake_qubes, monkeypatch, capsys):
+    monkeypatch.setattr(cli, "Session", lambda: pytest.fail("ran in-process"))
+    monkeypatch.setattr(cli.sys, "argv", ["hexagon", "--no-cache", "ls"])
+
+    with pytest.raises(SystemExit) as excinfo:
+        cli.main()
+
+    assert excinfo.value.code == 0
+    assert {"vault", "work"} <= set(capsys.readouterr().out.split())
+
+
+def test_cli_no_daemon_runs_in_process(served, fake_qubes, monkeypatch, capsys):
+    monkeypatch.setattr(cli.daemon_mod, "forward", lambda argv: pytest.fail("forwarded"))
+    monkeypatch.setattr(cli.sys, "argv", ["hexagon", "--no-daemon", "--no-cache", "ls"])
+
+    with pytest.raises(SystemExit) as excinfo:
+        cli.main()
+
+    assert excinfo.value.code == 0
+    assert "work" in capsys.readouterr().out.split()
+
+
+class _Buffer(object):
+    def __init__(self):
+        self.text = ""
+
+    def write(self, text):
+        self.text += text
+
+    def flush(self):
+        pass
+
+
+def _request(path, argv):
+    # forward() prints to sys.stdout, which is the daemon's own while it runs.
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        with sock.makefile("rwb") as f:
+            f.write(json.dumps({"argv": argv, "cwd": None}).encode() + b"\n")
+            f.flush()
+            return [json.loads(line) for line in f]
+
+
+def test_ls_runs_while_a_mutating_command_holds_the_lock(served, monkeypatch):
+    main = cli.main
+    started, finish = threading.Event(), threading.Event()
+
+    def slow_start(argv, session=None):
+        if "start" not in argv:
+            return main(argv, session=session)
+        print("starting")
+        started.set()
+        assert finish.wait(5)
+        print("started")
+
+    monkeypatch.setattr(cli, "main", slow_start)
+    out, err = _Buffer(), _Buffer()
+    mutating = threading.Thread(target=served.run, args=(["start", "work"], None, out, err))
+    mutating.start()
+    queued = None
+    try:
+        assert started.wait(5)
+        messages = _request(served.path, ["--no-cache", "ls", "--tags", "hexagon"])
+        assert "".join(m["out"] for m in messages if "out" in m) == "work\n"
+        assert messages[-1] == {"exit": 0}
+        # Another mutating command waits its turn.
+        queued = threading.Thread(
+            target=served.run, args=(["shutdown", "work"], None, _Buffer(), _Buffer())
+        )
+        queued.start()
+        queued.join(0.1)
+        assert queued.is_alive()
+    finally:
+        finish.set()
+        mutating.join(5)
+        if queued is not None:
+            queued.join(5)
+    # Nothing ls printed reached the mutating command's client.
+    assert out.text == "starting\nstarted\n"
+
+
+def test_forward_ignores_a_socket_owned_by_someone_else(served, fake_qubes, monkeypatch, caplog):
+    uid = os.getuid()
+    monkeypatch.setattr(daemon.os, "getuid", lambda: uid + 1)
+    assert daemon.forward(["--no-cache", "ls"]) is None
+    assert "not owned by this user" in caplog.text
+    assert fake_qubes.calls == []
+
+
+def test_bind_refuses_a_directory_owned_by_someone_else(fake_qubes, tmp_path, monkeypatch):
+    uid = os.getuid()
+    monkeypatch.setattr(daemon.os, "getuid", lambda: uid + 1)
+    with pytest.raises(RuntimeError, match="not owned by this user"):
+        daemon.Daemon(Session(app=fake_qubes), path=str(tmp_path / "hexagon.sock")).bind()
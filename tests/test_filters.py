@@ -0,0 +1,88 @@
+"""Unit tests for the cost-ordered VM filter pipeline."""
+
+import pytest
+
+from hexagon import filters
+from hexagon.session import Session
+from hexagon.snapshot import FleetSnapshot, VMRecord
+
+pytestmark = pytest.mark.unit
+
+
+def _record(name, tags=(), power_state="Running", **props):
+    return VMRecord(
+        name,
+        klass="AppVM",
+        power_state=power_state,
+        properties={"name": name, **props},
+        tags=tags,
+        features={},
+    )
+
+
+def test_stages_run_cheapest_first_regardless_of_order_added():
+    pipeline = filters.FilterPipeline()
+    pipeline.add(filters.Stage("volumes", filters.VOLUMES, lambda r: True))
+    pipeline.add(filters.Stage("tags", filters.TAGS, lambda r: True))
+    pipeline.add(filters.Stage("name", filters.NAME, lambda r: True))
+    assert [s.name for s in pipeline.stages] == ["name", "tags", "volumes"]
+
+
+def test_expensive_stage_only_sees_survivors():
+    snap = FleetSnapshot([_record("a", tags={"foo"}), _record("b"), _record("c")])
+    checked = []
+
+    def outdated(record):
+        checked.append(record.name)
+        return True
+
+    pipeline = filters.compile_filters(tags="foo", outdated=outdated)
+    assert [r.name for r in pipeline.run(snap)] == ["a"]
+    assert checked == ["a"]
+    assert pipeline.discarded == [("tags", 2), ("volumes", 0)]
+
+
+def test_volume_stage_skips_halted_and_non_appvms():
+    halted = _record("halted", power_state="Halted")
+    template = _record("tpl")
+    template.klass = "TemplateVM"
+    snap = FleetSnapshot([halted, template, _record("running")])
+    checked = []
+    pipeline = filters.compile_filters(outdated=lambda r: checked.append(r.name) or True)
+    assert [r.name for r in pipeline.run(snap)] == ["running"]
+    assert checked == ["running"]
+
+
+def test_property_filters_compile_to_one_stage():
+    snap = FleetSnapshot(
+        [
+            _record("a", template="fedora-43", vcpus="2"),
+            _record("b", template="fedora-43", vcpus="4"),
+            _record("c", template="debian-13", vcpus="2"),
+            _record("d"),
+        ]
+    )
+    pipeline = filters.compile_filters(template="fedora-43", properties=[("vcpus", "!4")])
+    assert [r.name for r in pipeline.run(snap)] == ["a"]
+    assert pipeline.discarded == [("properties", 3)]
+
+
+def test_stage_data_is_loaded_only_for_survivors(fake_qubes):
+    class FakeVM:
+        def __init__(self, name, tags):
+            self.name = name
+            self.klass = "AppVM"
+            self.tags = tags
+            self.vcpus = 2
+
+    for name, tags in (("a", {"foo"}), ("b", set()), ("c", set())):
+        fake_qubes.domains[name] = FakeVM(name, tags)
+    snap = FleetSnapshot.fetch(Session(app=fake_qubes), properties=False, tags=False)
+    pipeline = filters.compile_filters(names=["a", "b"], tags="foo", properties=[("vcpus", "2")])
+
+    assert [r.name for r in pipeline.run(snap)] == ["a"]
+    calls = [(dest, method) for dest, method, _arg in fake_qubes.calls]
+    assert ("a", "admin.vm.tag.List") in calls
+    assert ("b", "admin.vm.tag.List") in calls
+    assert ("c", "admin.vm.tag.List") not in calls
+    assert [d for d, m in calls if m == "admin.vm.property.GetAll"] == ["a"]
@@ -0,0 +1,146 @@
+"""Unit tests for declarative fleet files and ``reconcile --config``."""
+
+import pytest
+
+from hexagon import cli
+from hexagon import fleet
+from hexagon.qmgr import DEFAULT_TEMPLATE, HexagonQube
+
+pytestmark = pytest.mark.unit
+
+FLEET = """\
+defaults:
+  label: blue
+vms:
+  work:
+    vcpus: 2
+  personal:
+"""
+
+
+class FakeVM:
+    def __init__(self, name):
+        self.name = name
+        self.klass = "AppVM"
+        self.tags = set()
+        self.features = {}
+        self.label = "red"
+        self.vcpus = "2"
+        self.template = DEFAULT_TEMPLATE
+        self.power_state = "Halted"
+
+
+@pytest.fixture
+def fleet_app(fake_qubes):
+    for name in ("work", "personal"):
+        fake_qubes.domains[name] = FakeVM(name)
+    return fake_qubes
+
+
+@pytest.fixture
+def applied(monkeypatch, fake_power):
+    """Record which VMs HexagonQube.reconcile is asked to apply."""
+    names = []
+    monkeypatch.setattr(
+        HexagonQube, "reconcile", lambda self, plan=None, manage_power=True: names.append(self.name)
+    )
+    return names
+
+
+@pytest.fixture
+def fleet_file(tmp_path):
+    path = tmp_path / "fleet.yaml"
+    path.write_text(FLEET)
+    return path
+
+
+def _reconcile(*argv):
+    cli.main(["reconcile"] + list(argv))
+
+
+def test_fleet_configs_merge_defaults():
+    configs = fleet.fleet_configs(
+        {"defaults": {"label": "blue"}, "vms": {"a": {"label": "red"}, "b": None}}
+    )
+    assert configs == {"a": {"label": "red"}, "b": {"label": "blue"}}
+
+
+@pytest.mark.parametrize(
+    "cfg", [None, {}, {"vms": ["a"]}, {"vms": {"a": "x"}}, {"vms": {}, "defaults": 1}]
+)
+def test_fleet_configs_reject_malformed_files(cfg):
+    with pytest.raises(ValueError):
+        fleet.fleet_configs(cfg)
+
+
+def test_config_hash_compares_values_as_strings():
+    assert fleet.config_hash({"vcpus": 2, "label": "blue"}) == fleet.config_hash(
+        {"label": "blue", "vcpus": "2"}
+    )
+    assert fleet.config_hash({"vcpus": 2}) != fleet.config_hash({"vcpus": 4})
+
+
+def test_reconcile_config_stores_hashes_and_skips_unchanged_vms(fleet_app, applied, fleet_file):
+    _reconcile("--config", str(fleet_file))
+    assert sorted(applied) == ["personal", "work"]
+    stored = fleet_app.domains["work"].features[fleet.FEATURE]
+    assert stored == fleet.config_hash({"label": "blue", "vcpus": 2})
+
+    applied.clear()
+    fleet_app.calls.clear()
+    _reconcile("--config", str(fleet_file))
+    assert applied == []
+    # Just the hash check: no property diff.
+    assert {c[1] for c in fleet_app.calls} <= {"admin.vm.List", "admin.vm.feature.Get"}
+
+
+def test_reconcile_config_redoes_changed_declarations(fleet_app, applied, fleet_file):
+    _reconcile("--config", str(fleet_file))
+    fleet_file.write_text(FLEET.replace("vcpus: 2", "vcpus: 4"))
+    applied.clear()
+
+    _reconcile("--config", str(fleet_file))
+    assert applied == ["work"]
+
+    applied.clear()
+    _reconcile("--config", str(fleet_file), "--force")
+    assert sorted(applied) == ["personal", "work"]
+
+
+def test_reconcile_config_keeps_the_hash_of_a_vm_that_failed_to_start(
+    fleet_app, applied, fleet_file, monkeypatch
+):
+    fleet_app.domains["work"].power_state = "Running"
+    starts = []
+
+    def start(args, vm_name, session=None, budget=None, history=None, readiness=None):
+        starts.append(vm_name)
+        if len(starts) == 1:
+            raise RuntimeError("out of memory")
+
+    monkeypatch.setattr(cli, "start_vm", start)
+    with pytest.raises(SystemExit) as e:
+        _reconcile("--config", str(fleet_file))
+    assert e.value.code == 1
+    # work was reconciled but never came back up: it isn't up to date.
+    assert fleet.FEATURE not in fleet_app.domains["work"].features
+    assert fleet.FEATURE in fleet_app.domains["personal"].features
+
+    applied.clear()
+    _reconcile("--config", str(fleet_file))
+    assert applied == ["work"]
+    assert fleet.FEATURE in fleet_app.domains["work"].features
+
+
+def test_reconcile_config_narrows_to_named_vms(fleet_app, applied, fleet_file):
+    _reconcile("--config", str(fleet_file), "work")
+    assert applied == ["work"]
+    with pytest.raises(SystemExit) as e:
+        _reconcile("--config", str(fleet_file), "vault")
+    assert e.value.code == 1
+
+
+def test_reconcile_config_requires_the_file(fleet_app, applied, tmp_path):
+    with pytest.raises(SystemExit) as e:
+        _reconcile("--config", str(tmp_path / "missing.yaml"))
+    assert e.value.code == 1
@@ -0,0 +1,116 @@
+"""Unit tests for learned operation durations (history.py)."""
+
+import json
+
+import pytest
+
+from hexagon import cli, qmgr
+from hexagon.history import (
+    DEFAULT_TIMEOUT,
+    MAX_TIMEOUT,
+    MIN_TIMEOUT,
+    SAMPLES,
+    SHUTDOWN,
+    START,
+    DurationHistory,
+)
+from hexagon.session import Session
+
+from .base import PoweredFakeVM
+from .fakequbes import build_fleet
+
+pytestmark = pytest.mark.unit
+
+
+def test_timeouts_follow_the_slowest_recent_halt(tmp_path):
+    history = DurationHistory(str(tmp_path))
+    assert history.timeout("new") == DEFAULT_TIMEOUT
+    history.record("disp", SHUTDOWN, 1.2)
+    assert history.timeout("disp") == MIN_TIMEOUT
+    for seconds in (40, 35, 42):
+        history.record("standalone", SHUTDOWN, seconds)
+    assert history.timeout("standalone") == 2 * 42 + 5
+    history.record("stuck", SHUTDOWN, 600)
+    assert history.timeout("stuck") == MAX_TIMEOUT
+
+
+def test_estimates_are_recent_medians(tmp_path):
+    history = DurationHistory(str(tmp_path))
+    assert history.estimate("work", START) is None
+    for seconds in [100] + [4, 6, 5] * 4:
+        history.record("work", START, seconds)
+    assert len(history.samples("work", START)) == SAMPLES
+    assert history.estimate("work", START) == 5
+
+
+def test_longest_first_puts_unknown_then_slow_vms_first(tmp_path):
+    history = DurationHistory(str(tmp_path))
+    history.record("fast", SHUTDOWN, 2)
+    history.record("slow", SHUTDOWN, 20)
+    history.record("slow", START, 1)
+    assert history.longest_first([["fast", "slow", "new"], ["x"]], SHUTDOWN) == [
+        ["new", "slow", "fast"],
+        ["x"],
+    ]
+    assert history.cost(SHUTDOWN, START)("slow") == 21
+
+
+def test_save_merges_with_other_runs(tmp_path):
+    one = DurationHistory(str(tmp_path))
+    two = DurationHistory(str(tmp_path))
+    one.record("work", SHUTDOWN, 3)
+    two.record("work", SHUTDOWN, 5)
+    two.record("dev", START, 7)
+    one.save()
+    two.save()
+    assert DurationHistory(str(tmp_path)).samples("work", SHUTDOWN) == [3, 5]
+    assert DurationHistory(str(tmp_path)).estimate("dev", START) == 7
+
+
+def test_unreadable_history_is_ignored(tmp_path):
+    (tmp_path / "durations.json").write_text("{not json")
+    assert DurationHistory(str(tmp_path)).timeout("work") == DEFAULT_TIMEOUT
+
+
+def test_cli_records_durations_and_uses_them(monkeypatch, tmp_path):
+    app = build_fleet(4, latency=0.001)
+    session = Session(app=app, events=app.events)
+    cli.main(["--no-cache", "shutdown", "vm-0000", "vm-0002"], session=session)
+    cli.main(["--no-cache", "start", "vm-0000"], session=session)
+    with open(tmp_path / "cache" / "hexagon" / "durations.json") as f:
+        saved = json.load(f)["vms"]
+    assert set(saved) == {"vm-0000", "vm-0002"}
+    assert set(saved["vm-0000"]) == {SHUTDOWN, START}
+
+    # vm-0002 halts slowly: it goes first, and gets longer to do it.
+    history = DurationHistory()
+    history.record("vm-0000", SHUTDOWN, 1)
+    history.record("vm-0002", SHUTDOWN, 50)
+    history.save()
+    timeouts = {}
+
+    def ensure_halted(self, timeout=30, **kwargs):
+        timeouts[self.name] = timeout
+        return False
+
+    monkeypatch.setattr(qmgr.HexagonQube, "ensure_halted", ensure_halted)
+    cli.main(
+        ["--no-cache", "shutdown", "--max-concurrency", "1", "vm-0000", "vm-0002"],
+        session=session,
+    )
+    assert list(timeouts) == ["vm-0002", "vm-0000"]
+    assert timeouts == {"vm-0002": 105, "vm-0000": MIN_TIMEOUT}
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_cli_does_not_record_a_killed_halt(engine, fake_qubes, fake_events, monkeypatch):
+    fake_qubes.domains["stuck"] = stuck = PoweredFakeVM("stuck", halt_after=None)
+    fake_qubes.domains["quick"] = PoweredFakeVM("quick", events=fake_events)
+    monkeypatch.setattr(DurationHistory, "timeout", lambda self, name, default=None: 0.2)
+    session = Session(app=fake_qubes, events=fake_events)
+    cli.main(["--no-cache", "--engine", engine, "shutdown", "stuck", "quick"], session=session)
+    assert stuck.killed
+    history = DurationHistory()
+    # The kill took as long as the timeout allowed; that's no sample.
+    assert history.samples("stuck", SHUTDOWN) == []
+    assert len(history.samples("quick", SHUTDOWN)) == 1
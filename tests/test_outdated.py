@@ -0,0 +1,97 @@
+"""Unit tests for the template-keyed outdated index."""
+
+import pytest
+
+from hexagon import cli
+from hexagon.outdated import OutdatedIndex
+from hexagon.session import Session
+from hexagon.snapshot import FleetSnapshot
+
+pytestmark = pytest.mark.unit
+
+
+class FakeVM:
+    def __init__(self, name, template="fedora-43", start_time=None, klass="AppVM"):
+        self.name = name
+        self.klass = klass
+        self.tags = set()
+        self.features = {}
+        self.template = template
+        self.start_time = start_time
+        self.power_state = "Halted" if start_time is None else "Running"
+
+
+@pytest.fixture
+def fleet(fake_qubes):
+    # fedora-43 was updated at t=100; debian-13 at t=10.
+    for i in range(8):
+        fake_qubes.domains["f{}".format(i)] = FakeVM("f{}".format(i), start_time=50 + 20 * i)
+    for i in range(3):
+        fake_qubes.domains["d{}".format(i)] = FakeVM(
+            "d{}".format(i), template="debian-13", start_time=20 + i
+        )
+    fake_qubes.domains["halted"] = FakeVM("halted")
+    fake_qubes.domains["lost"] = FakeVM("lost", template="fedora-43", start_time="")
+    fake_qubes.updated = {"fedora-43": 100, "debian-13": 10}
+    return fake_qubes
+
+
+@pytest.fixture
+def volume_checks(fleet):
+    """The per-volume check, answering from the fake templates' update times."""
+    checked = []
+
+    def check(name):
+        checked.append(name)
+        vm = fleet.domains[name]
+        return bool(vm.start_time) and float(vm.start_time) < fleet.updated[vm.template]
+
+    check.checked = checked
+    return check
+
+
+def _snapshot(fleet):
+    return FleetSnapshot.fetch(Session(app=fleet), properties=False, tags=False)
+
+
+def test_index_checks_log_n_children_per_template(fleet, volume_checks):
+    snapshot = _snapshot(fleet)
+    index = OutdatedIndex(snapshot, volume_checks)
+    index.prepare(list(snapshot))
+
+    outdated = sorted(r.name for r in snapshot if index(r))
+    assert outdated == ["f0", "f1", "f2"]
+    # 8 fedora children: 3 checks; 3 debian children: 2; "lost" has no
+    # start time and is checked on its own; "halted" is never checked.
+    assert len(volume_checks.checked) == 3 + 2 + 1
+    assert "lost" in volume_checks.checked
+    assert "halted" not in volume_checks.checked
+
+
+def test_index_remembers_template_bounds(fleet, volume_checks):
+    snapshot = _snapshot(fleet)
+    index = OutdatedIndex(snapshot, volume_checks)
+    index.prepare([snapshot["f0"], snapshot["f7"]])
+    volume_checks.checked.clear()
+
+    # Both sit outside the bounds the first search found.
+    fleet.domains["f8"] = FakeVM("f8", start_time=40)
+    fleet.domains["f9"] = FakeVM("f9", start_time=500)
+    snapshot = _snapshot(fleet)
+    index.snapshot = snapshot
+    assert index(snapshot["f8"])
+    assert not index(snapshot["f9"])
+    assert volume_checks.checked == []
+
+
+def test_cli_ls_outdated_uses_the_index(fleet, volume_checks, monkeypatch, capsys):
+    monkeypatch.setattr(
+        cli.HexagonQube, "is_outdated", lambda self: volume_checks(self.name), raising=False
+    )
+    monkeypatch.setattr(
+        cli.HexagonQube, "__init__", lambda self, name, session=None: setattr(self, "name", name)
+    )
+    with pytest.raises(SystemExit):
+        cli.main(["--no-cache", "ls", "--outdated"])
+    assert capsys.readouterr().out.split() == ["f0", "f1", "f2"]
+    assert len(volume_checks.checked) == 6
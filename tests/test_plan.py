@@ -0,0 +1,235 @@
+"""Unit tests for the snapshot-based reconcile planner and its plan files."""
+
+import pytest
+
+from hexagon import cli
+from hexagon import plan as plan_mod
+from hexagon.plan import PowerPlan, ReconcilePlan, VMPlan, plan_reconcile
+from hexagon.qmgr import DEFAULT_TEMPLATE, HexagonQube
+from hexagon.session import Session
+from hexagon.snapshot import FleetSnapshot
+
+pytestmark = pytest.mark.unit
+
+
+class FakeVM:
+    def __init__(self, name, label="red", power_state="Halted"):
+        self.name = name
+        self.klass = "AppVM"
+        self.tags = {"hexagon"}
+        self.features = {}
+        self.label = label
+        self.template = DEFAULT_TEMPLATE
+        self.power_state = power_state
+
+
+@pytest.fixture
+def fleet(fake_qubes):
+    fake_qubes.domains["work"] = FakeVM("work", power_state="Running")
+    fake_qubes.domains["personal"] = FakeVM("personal", label="blue")
+    return fake_qubes
+
+
+@pytest.fixture
+def applied(monkeypatch, fake_power):
+    """Record what HexagonQube.reconcile is asked to apply, instead of applying it."""
+    calls = []
+    monkeypatch.setattr(
+        HexagonQube,
+        "reconcile",
+        lambda self, plan=None, manage_power=True: calls.append((self.name, plan)),
+    )
+    return calls
+
+
+def _reads(app):
+    return [c for c in app.calls if c[1] != "admin.vm.List"]
+
+
+def test_plan_diffs_against_one_snapshot(fleet):
+    snapshot = FleetSnapshot.fetch(Session(app=fleet), properties=False, tags=False)
+    fleet.calls.clear()
+    plan = plan_reconcile(
+        snapshot,
+        {"work": {"label": "blue"}, "personal": {"label": "blue"}, "new": {"label": "green"}},
+    )
+
+    # One bulk read per existing target, nothing per desired key.
+    assert sorted(_reads(fleet)) == [
+        ("personal", "admin.vm.property.GetAll", None),
+        ("work", "admin.vm.property.GetAll", None),
+    ]
+    assert plan["work"].changes == [("label", "red", "blue", True)]
+    assert plan["work"].reboot
+    assert plan["personal"].changes == []
+    assert not plan["personal"].reboot
+    assert not plan["new"].exists
+    assert ("label", None, "green", True) in plan["new"].changes
+    assert plan["new"].desired["template"] == DEFAULT_TEMPLATE
+
+
+def test_plan_reboots_outdated_running_vms_only(fleet):
+    snapshot = FleetSnapshot.fetch(Session(app=fleet), properties=False, tags=False)
+    configs = {"work": {}, "personal": {}}
+    plan = plan_reconcile(snapshot, configs, outdated=lambda record: True)
+    assert plan["work"].reboot
+    assert not plan["personal"].reboot
+
+
+def test_plan_rejects_a_missing_template(fleet):
+    snapshot = FleetSnapshot.fetch(Session(app=fleet), properties=False, tags=False)
+    with pytest.raises(Exception, match="Target TemplateVM does not exist"):
+        plan_reconcile(snapshot, {"work": {"template": "nope"}})
+
+
+def test_plan_round_trips_through_a_file(fleet, tmp_path):
+    snapshot = FleetSnapshot.fetch(Session(app=fleet), properties=False, tags=False)
+    plan = plan_reconcile(snapshot, {"work": {"label": "blue"}}, generation="3:abc")
+    path = str(tmp_path / "plan.json")
+    plan.save(path)
+
+    loaded = ReconcilePlan.load(path)
+    assert loaded.to_dict() == plan.to_dict()
+    assert loaded.format() == plan.format()
+    assert "work: reboot; label: red -> blue" in loaded.format()
+    assert loaded.is_current("3:abc", max_age=60)
+    assert not loaded.is_current("4:abc", max_age=60)
+    assert not ReconcilePlan(plan.vms, generation=None).is_current(None, max_age=60)
+
+
+def test_plan_load_rejects_other_files(tmp_path):
+    path = tmp_path / "plan.json"
+    path.write_text('{"version": 99}')
+    with pytest.raises(ValueError):
+        ReconcilePlan.load(str(path))
+
+
+def test_cli_dry_run_prints_and_saves_the_plan(fleet, applied, tmp_path, capsys):
+    path = str(tmp_path / "plan.json")
+    with pytest.raises(SystemExit) as e:
+        cli.main(["--dry-run", "reconcile", "--plan", path, "--label", "blue", "work", "personal"])
+    assert e.value.code == 0
+    out = capsys.readouterr().out
+    assert "work: reboot; label: red -> blue" in out
+    assert "personal: no changes" in out
+    assert ReconcilePlan.load(path).names() == ["work", "personal"]
+    assert applied == []
+
+
+@pytest.mark.parametrize(
+    "content",
+    [None, "{not json", '{"version": 99}', '{{"version": {}}}'.format(plan_mod.FORMAT_VERSION)],
+)
+def test_cli_rejects_an_unreadable_plan(fleet, applied, tmp_path, content, caplog):
+    path = tmp_path / "plan.json"
+    if content is not None:
+        path.write_text(content)
+    with pytest.raises(SystemExit) as e:
+        cli.main(["reconcile", "--plan", str(path)])
+    assert e.value.code == 1
+    assert "Could not read plan" in caplog.text
+    assert applied == []
+
+
+def test_cli_applies_a_current_plan_without_rediffing(fleet, applied, tmp_path):
+    path = str(tmp_path / "plan.json")
+    with pytest.raises(SystemExit):
+        cli.main(["--dry-run", "reconcile", "--plan", path, "--label", "blue", "work"])
+    fleet.calls.clear()
+
+    cli.main(["reconcile", "--plan", path])
+
+    assert _reads(fleet) == []
+    [(name, plan)] = applied
+    assert name == "work"
+    assert plan.changes == [("label", "red", "blue", True)]
+
+
+def test_cli_replans_when_the_fleet_moved(fleet, applied, tmp_path):
+    path = str(tmp_path / "plan.json")
+    with pytest.raises(SystemExit):
+        cli.main(["--dry-run", "reconcile", "--plan", path, "--label", "blue", "work"])
+    # Someone else already relabelled it.
+    fleet.domains["work"].label = "blue"
+    fleet.domains["work"].power_state = "Halted"
+
+    cli.main(["reconcile", "--plan", path])
+
+    [(name, plan)] = applied
+    assert name == "work"
+    assert plan.changes == []
+    assert not plan.reboot
+
+
+def _vm(name, netvm=None, reboot=True, running=True, **kwargs):
+    return VMPlan(name, {}, reboot=reboot, running=running, netvm=netvm, **kwargs)
+
+
+def test_power_plan_cycles_a_netvm_subtree_once():
+    power = PowerPlan(
+        [
+            _vm("work", netvm="sys-firewall"),
+            _vm("personal", netvm="sys-firewall", reboot=False),
+            _vm("sys-firewall", netvm="sys-net"),
+            _vm("sys-net"),
+            _vm("vault", reboot=False, running=False),
+        ]
+    )
+    assert power.shutdown_waves() == [["work"], ["sys-firewall"], ["sys-net"]]
+    assert power.start_waves() == [["sys-net"], ["sys-firewall"], ["work"]]
+    assert power.subtrees == {"sys-net": ["work", "sys-firewall", "sys-net"]}
+    # Alone and in this order, work would cycle again after sys-firewall's
+    # cycle and after sys-net's, and sys-firewall again after sys-net's.
+    assert (power.per_vm_halts, power.per_vm_starts) == (6, 6)
+    assert (len(power.halt), len(power.start)) == (3, 3)
+    assert power.avoided == 3
+    assert "3 power-cycle(s) in 1 netvm subtree(s), 3 avoided" in power.format()
+
+
+def test_power_plan_avoids_nothing_when_netvms_come_first():
+    power = PowerPlan(
+        [
+            _vm("sys-net"),
+            _vm("sys-firewall", netvm="sys-net"),
+            _vm("work", netvm="sys-firewall"),
+        ]
+    )
+    assert power.subtrees == {"sys-net": ["sys-net", "sys-firewall", "work"]}
+    assert power.per_vm_halts == len(power.halt) == 3
+    assert power.avoided == 0
+
+
+def test_power_plan_starts_halted_autostart_vms_and_new_netvms_first():
+    power = PowerPlan(
+        [
+            _vm(
+                "work", netvm="sys-firewall", changes=[("netvm", "sys-firewall", "sys-vpn", False)]
+            ),
+            _vm("sys-vpn", running=False, reboot=False, autostart=True),
+            _vm("sys-firewall", reboot=False),
+        ]
+    )
+    assert power.halt == ["work"]
+    # work comes back behind its new netvm, which autostart brings up.
+    assert power.start_waves() == [["sys-vpn"], ["work"]]
+    assert power.avoided == 0
+    assert "start only: sys-vpn" in power.format()
+
+
+def test_cli_reconcile_halts_and_starts_each_vm_once(fake_qubes, applied, fake_power, capsys):
+    net = FakeVM("sys-net", power_state="Running")
+    net.provides_network = "True"
+    client = FakeVM("work", power_state="Running")
+    client.netvm = "sys-net"
+    fake_qubes.domains["sys-net"] = net
+    fake_qubes.domains["work"] = client
+
+    cli.main(["reconcile", "--label", "blue", "work", "sys-net"])
+
+    assert fake_power == [
+        ("halt", "work"),
+        ("halt", "sys-net"),
+        ("start", "sys-net"),
+        ("start", "work"),
+    ]
+    assert sorted(name for name, _plan in applied) == ["sys-net", "work"]
@@ -159,13 +159,21 @@ def test_qubes_proxy_grants_present():
         assert svc in body, "missing qubes_proxy grant: {}".format(svc)
 
 
+def test_wait_ready_session_service_granted_into_managed_vms():
+    # `start --wait-ready` calls qubes.WaitForSession in each started VM; a
+    # regular qrexec call into the VM, so no target=dom0 redirect.
+    body = policy.render_policy(admin_qubes=[ADMIN_QUBE])
+    rules = [r for r in _rules(body) if r[0] == "qubes.WaitForSession"]
+    assert [(r[2], r[3], r[4]) for r in rules] == [(ADMIN, TARGET, ["allow"])]
+
+
 def test_cli_policy_command_prints_and_exits(monkeypatch, capsys):
     # `hexagon policy` must emit the rendered policy and exit 0 without ever
     # constructing a Qubes app (works in any AppVM, no qrexec grants).
     def boom(*a, **k):
         raise AssertionError("policy must not touch the Admin API")
 
-    monkeypatch.setattr(cli.qubesadmin, "Qubes", boom, raising=False)
+    monkeypatch.setattr("qubesadmin.Qubes", boom, raising=False)
     monkeypatch.setattr(cli.sys, "argv", ["hexagon", "policy"])
 
     with pytest.raises(SystemExit) as exc:
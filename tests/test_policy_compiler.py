@@ -0,0 +1,108 @@
+"""Unit tests for the ahead-of-time compiled policy renderer.
+
+The compiled module must be a drop-in for Jinja2: every test renders through
+both paths and compares bytes. The Jinja2 template stays the source of truth.
+"""
+
+import sys
+import types
+
+import pytest
+
+from hexagon import policy, policy_compiler
+
+pytestmark = pytest.mark.unit
+
+jinja2 = pytest.importorskip("jinja2")
+
+VARIANTS = [
+    {},
+    {"admin_qubes": ["fleet"]},
+    {"admin_qubes": ["fleet", "petrichor", "ops-admin"]},
+    {"admin_qubes": []},
+    {"admin_tag": "ops-admin", "target_tag": "ops", "admin_qubes": ["fleet"]},
+    {"sys_vms": [], "admin_qubes": ["fleet"]},
+    {"sys_vms": ["sys-net", "sys-whonix"], "mgmt_dispvm": "custom-mgmt-dvm"},
+    {"admin_qubes": ["quote'n\\back%s"], "target_tag": "t%d"},
+]
+
+
+@pytest.fixture(autouse=True)
+def _fresh_renderer():
+    policy.compiled_renderer.cache_clear()
+    yield
+    policy.compiled_renderer.cache_clear()
+
+
+def _module(source):
+    module = types.ModuleType("hexagon._policy_compiled")
+    exec(source, module.__dict__)
+    return module
+
+
+@pytest.fixture
+def build_time(monkeypatch):
+    """Install a freshly generated ``hexagon._policy_compiled``, as the build does."""
+    module = _module(policy_compiler.compile_policy())
+    monkeypatch.setitem(sys.modules, "hexagon._policy_compiled", module)
+    return module
+
+
+def _jinja(monkeypatch, **kwargs):
+    with monkeypatch.context() as m:
+        m.setattr(policy, "compiled_renderer", lambda: None)
+        return policy.render_policy(**kwargs)
+
+
+@pytest.mark.parametrize("kwargs", VARIANTS)
+def test_compiled_output_is_byte_identical_to_jinja(monkeypatch, build_time, kwargs):
+    assert policy.compiled_renderer() is build_time.render
+    assert policy.render_policy(**kwargs) == _jinja(monkeypatch, **kwargs)
+
+
+def test_stale_renderer_is_ignored(monkeypatch):
+    stale = _module(policy_compiler.compile_template("stale {{ x }}", policy.JINJA_OPTIONS))
+    monkeypatch.setitem(sys.modules, "hexagon._policy_compiled", stale)
+    assert policy.compiled_renderer() is None
+    assert policy.render_policy(admin_qubes=["fleet"]).startswith("# 30-mgmtvm.policy")
+
+
+def test_nothing_is_compiled_at_run_time(monkeypatch, tmp_path):
+    # No build-time module: Jinja2 renders, and nothing lands in the cache dir.
+    monkeypatch.setitem(sys.modules, "hexagon._policy_compiled", None)
+    monkeypatch.setattr(policy_compiler, "compile_policy", pytest.fail)
+    assert policy.compiled_renderer() is None
+    assert policy.render_policy(admin_qubes=["fleet"]) == _jinja(monkeypatch, admin_qubes=["fleet"])
+    assert not (tmp_path / "cache" / "hexagon").exists()
+
+
+def test_template_edits_change_the_hash():
+    a = policy_compiler.source_hash(policy.POLICY_TEMPLATE, policy.JINJA_OPTIONS)
+    b = policy_compiler.source_hash(policy.POLICY_TEMPLATE + "#\n", policy.JINJA_OPTIONS)
+    assert a != b
+
+
+@pytest.mark.parametrize(
+    "source,context",
+    [
+        ("{% for a, b in pairs %}{% set c = a ~ b %}{{ c }};{% endfor %}{{ c }}", {"c": "x"}),
+        ("{% if n > 1 and not flag %}many{% elif n == 1 %}one{% else %}none{% endif %}", {}),
+        ("{% macro m(x, y=2) %}{{ x * y }}{% endmacro %}{{ m(3) }}{{ m(x=1, y=5) }}", {}),
+        ("{{ missing }}|{{ '%05.1f'|format(n + 0.25) }}", {}),
+    ],
+)
+def test_compiler_matches_jinja_on_supported_constructs(source, context):
+    context = dict({"pairs": [("a", "b"), ("c", "d")], "n": 1, "flag": False}, **context)
+    namespace = {}
+    exec(policy_compiler.compile_template(source, policy.JINJA_OPTIONS), namespace)
+    expected = jinja2.Template(source, **policy.JINJA_OPTIONS).render(**context)
+    assert namespace["render"](**context) == expected
+
+
+def test_unsupported_constructs_fall_back_to_jinja():
+    with pytest.raises(policy_compiler.CompileError):
+        policy_compiler.compile_template("{{ x|upper }}", policy.JINJA_OPTIONS)
+    with pytest.raises(policy_compiler.CompileError):
+        policy_compiler.compile_template(
+            "{% for x in xs %}{{ loop.index }}{% endfor %}", policy.JINJA_OPTIONS
+        )
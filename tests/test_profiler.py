@@ -0,0 +1,60 @@
+"""Unit tests for the Admin API call profiler behind --profile."""
+
+import json
+
+import pytest
+
+from hexagon import cli
+from hexagon.profiler import Profiler
+
+pytestmark = pytest.mark.unit
+
+
+class FakeApp:
+    def qubesd_call(self, dest, method, arg=None, payload=None):
+        if dest == "missing":
+            raise KeyError(dest)
+        return b""
+
+
+def read_label(app, name):
+    return app.qubesd_call(name, "admin.vm.property.Get", "label")
+
+
+def test_profiler_records_calls_and_callers():
+    ticks = iter([0.0, 0.010, 0.0, 0.002, 0.0, 0.001, 0.0, 0.030])
+    app = FakeApp()
+    profiler = Profiler(clock=lambda: next(ticks)).install(app)
+    read_label(app, "work")
+    read_label(app, "personal")
+    with pytest.raises(KeyError):
+        read_label(app, "missing")
+    app.qubesd_call("dom0", "admin.vm.List")
+    profiler.uninstall()
+    app.qubesd_call("dom0", "admin.vm.List")
+
+    assert len(profiler.calls) == 4
+    first = profiler.calls[0]
+    assert (first.method, first.dest, first.arg) == ("admin.vm.property.Get", "work", "label")
+    assert first.caller == "{}.read_label".format(__name__)
+    assert profiler.calls[2].error == "KeyError"
+    # Sorted by total time: one 30ms List beats three Gets totalling 13ms.
+    assert [row[:2] for row in profiler.summary()] == [
+        ("admin.vm.List", 1),
+        ("admin.vm.property.Get", 3),
+    ]
+    assert "qubesd_call" not in vars(app)
+
+
+def test_cli_profile(fake_qubes, tmp_path, capsys):
+    path = tmp_path / "profile.json"
+    with pytest.raises(SystemExit) as e:
+        cli.main(["--no-cache", "--profile", "--profile-json", str(path), "ls"])
+    assert e.value.code == 0
+    err = capsys.readouterr().err
+    assert "Admin API calls: 1 in" in err
+    data = json.loads(path.read_text())
+    assert data["calls"] == 1
+    [record] = data["records"]
+    assert record["method"] == "admin.vm.List"
+    assert record["caller"] == "hexagon.session.listing"
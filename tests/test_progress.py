@@ -0,0 +1,161 @@
+"""Unit tests for streamed results, failure budgets and the outcome summary."""
+
+import asyncio
+import time
+
+import pytest
+
+from hexagon import cli
+from hexagon.progress import CANCELLED, FAILED, OK, SKIPPED, Cancelled, Progress
+from hexagon.session import Session
+
+from .fakequbes import build_fleet
+
+pytestmark = pytest.mark.unit
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _op(clock, fail=(), seconds=1.0):
+    def op(name):
+        clock.now += seconds
+        if name in fail:
+            raise RuntimeError("boom: {}".format(name))
+
+    return op
+
+
+def _run(progress, phase, names, op):
+    tracked = progress.track(phase, [names], op)
+    errors = {}
+    for name in names:
+        try:
+            tracked(name)
+        except Exception as e:
+            errors[name] = e
+    return errors
+
+
+def test_results_are_logged_as_they_complete(caplog):
+    caplog.set_level("INFO")
+    clock = FakeClock()
+    progress = Progress(clock=clock)
+    _run(progress, "shutdown", ["a", "b", "c", "d"], _op(clock, fail={"b"}))
+    lines = [r.getMessage() for r in caplog.records]
+    assert lines[0] == "shutdown 1/4: a ok in 1.0s (0 failed, 1.00 VMs/s, ~3s left)"
+    assert lines[1].startswith("shutdown 2/4: b failed in 1.0s (1 failed, 1.00 VMs/s, ~2s left)")
+    assert "RuntimeError('boom: b')" in lines[1]
+    assert lines[-1] == "shutdown 4/4: d ok in 1.0s (1 failed, 1.00 VMs/s)"
+
+
+def test_failure_budget_cancels_queued_work():
+    clock = FakeClock()
+    progress = Progress(max_failures=1, clock=clock)
+    errors = _run(progress, "shutdown", ["a", "b", "c", "d", "e"], _op(clock, fail={"a", "c"}))
+    assert sorted(errors) == ["a", "c", "d", "e"]
+    assert isinstance(errors["d"], Cancelled)
+    assert progress.stopped
+    # Later phases cancel everything, and skip what already failed.
+    errors = _run(progress, "start", ["b"], _op(clock))
+    assert isinstance(errors["b"], Cancelled)
+    assert progress.counts("shutdown") == {FAILED: 2, OK: 1, CANCELLED: 2}
+    assert progress.counts("start") == {CANCELLED: 1}
+
+
+def test_fail_fast_is_a_budget_of_zero():
+    clock = FakeClock()
+    progress = Progress(max_failures=0, clock=clock)
+    errors = _run(progress, "start", ["a", "b"], _op(clock, fail={"a"}))
+    assert isinstance(errors["b"], Cancelled)
+
+
+def test_async_operations_are_tracked():
+    clock = FakeClock()
+    progress = Progress(clock=clock)
+
+    async def op(name):
+        clock.now += 2.0
+
+    tracked = progress.track_async("halt", [["a"]], op)
+    asyncio.run(tracked("a"))
+    assert progress.outcomes[("halt", "a")].duration == 2.0
+
+
+def test_summary_lists_each_vm_slowest_first():
+    clock = FakeClock()
+    progress = Progress(clock=clock)
+    _run(progress, "shutdown", ["fast", "slow"], _op(clock, fail={"slow"}))
+    progress.outcomes[("shutdown", "slow")].duration = 30.0
+    progress.track("start", [["fast", "slow"]], _op(clock))("fast")
+    lines = progress.format().splitlines()
+    assert lines[0].split() == ["VM", "shutdown", "start", "total"]
+    assert lines[1].split() == ["slow", FAILED, "30.0s", SKIPPED, "30.0s"]
+    assert lines[2].split() == ["fast", OK, "1.0s", OK, "1.0s", "2.0s"]
+    assert lines[3:] == ["shutdown: 1 ok, 1 failed", "start: 1 ok, 1 skipped"]
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_cli_fail_fast_stops_the_batch(engine, monkeypatch, capsys):
+    app = build_fleet(6)
+    halted = []
+
+    def halt(args, vm_name, session=None, history=None, clients=None):
+        halted.append(vm_name)
+        if vm_name == "vm-0000":
+            raise RuntimeError("stuck")
+
+    monkeypatch.setattr(cli, "halt_vm", halt)
+    monkeypatch.setattr("hexagon.aio.AsyncEngine.halt", lambda self, name: _acall(halt, name))
+    argv = ["--no-cache", "--engine", engine, "shutdown", "--max-concurrency", "1", "--fail-fast"]
+    with pytest.raises(SystemExit) as e:
+        cli.main(argv + ["vm-0000", "vm-0001", "vm-0002"], session=Session(app=app))
+    assert e.value.code == 1
+    assert halted == ["vm-0000"]
+    assert capsys.readouterr().err.splitlines()[-1] == "shutdown: 1 failed, 2 cancelled"
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_cli_fail_fast_cancels_within_a_single_wave(engine, monkeypatch, capsys):
+    # No --max-concurrency: the budget alone bounds the wave, leaving VMs queued.
+    app = build_fleet(20)
+    names = ["vm-{:04d}".format(i) for i in range(20)]
+    halted = []
+
+    def halt(args, vm_name, session=None, history=None, clients=None):
+        halted.append(vm_name)
+        time.sleep(0.01)
+        raise RuntimeError("stuck")
+
+    async def ahalt(self, vm_name):
+        halted.append(vm_name)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("stuck")
+
+    monkeypatch.setattr(cli, "halt_vm", halt)
+    monkeypatch.setattr("hexagon.aio.AsyncEngine.halt", ahalt)
+    with pytest.raises(SystemExit):
+        cli.main(
+            ["--no-cache", "--engine", engine, "shutdown", "--fail-fast"] + names,
+            session=Session(app=app),
+        )
+    assert len(halted) == cli.FAILURE_BUDGET_CONCURRENCY
+    assert capsys.readouterr().err.splitlines()[-1] == "shutdown: {} failed, {} cancelled".format(
+        len(halted), 20 - len(halted)
+    )
+
+
+async def _acall(halt, name):
+    halt(None, name)
+
+
+def test_fail_fast_and_max_failures_are_exclusive(capsys):
+    with pytest.raises(SystemExit):
+        cli.parse_args(["shutdown", "--fail-fast", "--max-failures", "2", "vm"])
+    assert cli.parse_args(["reboot", "--fail-fast", "vm"]).max_failures == 0
+    assert cli.parse_args(["reconcile", "--max-failures", "3", "vm"]).max_failures == 3
@@ -0,0 +1,229 @@
+"""Unit tests for the offline qrexec policy model and optimizer.
+
+The optimizer must never change a decision, so most tests lean on
+``find_differences`` -- and one checks that it does catch a bad reordering.
+"""
+
+import os
+
+import pytest
+
+from hexagon import cli
+from hexagon import policy
+from hexagon import qrexec
+from hexagon.session import Session
+
+from .fakequbes import build_fleet
+
+pytestmark = pytest.mark.unit
+
+ADMIN = qrexec.Domain("mgmt", tags=["hexagon-admin"], klass="AppVM")
+WORK = qrexec.Domain("work", tags=["hexagon"], klass="AppVM")
+
+
+def _policy(*lines):
+    return qrexec.parse_policy("\n".join(lines) + "\n")
+
+
+def test_parse_skips_comments_and_keeps_params():
+    rules = _policy(
+        "# header",
+        "",
+        "admin.vm.List  *  @tag:a  dom0  allow target=dom0",
+    )
+    assert len(rules) == 1
+    rule = rules[0]
+    assert (rule.service, rule.argument, rule.source, rule.target) == (
+        "admin.vm.List",
+        "*",
+        "@tag:a",
+        "@adminvm",
+    )
+    assert rule.decision == "allow target=dom0"
+    assert rule.lineno == 3
+
+
+def test_parse_rejects_directives():
+    with pytest.raises(ValueError):
+        _policy("!include-service admin.vm.List * some-file")
+
+
+def test_first_match_and_token_semantics():
+    rules = _policy(
+        "admin.vm.Kill  *  @anyvm  @tag:hexagon  deny",
+        "*              *  @tag:hexagon-admin  @anyvm  allow target=dom0",
+    )
+    assert qrexec.decide(rules, "admin.vm.Kill", "", ADMIN, WORK) == "deny"
+    assert qrexec.decide(rules, "admin.vm.Start", "", ADMIN, WORK) == "allow target=dom0"
+    # @anyvm never matches dom0, and neither do tags.
+    dom0 = qrexec.Domain("dom0", tags=["hexagon"])
+    assert qrexec.decide(rules, "admin.vm.Start", "", ADMIN, dom0) == "deny"
+    rule, scanned = qrexec.evaluate(rules, "admin.vm.Start", "", ADMIN, WORK)
+    assert scanned == 2
+
+
+def test_optimize_drops_covered_rules():
+    rules = _policy(
+        "admin.vm.List  *  @tag:a  @anyvm  allow target=dom0",
+        "admin.vm.List  *  @tag:a  @tag:b  allow target=dom0",
+        "admin.vm.List  *  @tag:a  @anyvm  allow target=dom0",
+    )
+    kept, dropped = qrexec.optimize(rules)
+    assert kept == rules[:1]
+    assert dropped == rules[1:]
+    assert qrexec.find_differences(rules, kept) == []
+
+
+def test_optimize_never_reorders_conflicting_rules():
+    rules = _policy(
+        "qubes.Rare             *  @tag:a  @tag:b  deny",
+        "admin.vm.property.Get  *  @tag:a  @tag:c  allow target=dom0",
+        "*                      *  @tag:a  @tag:c  deny",
+        "admin.vm.property.Get  *  @tag:a  @tag:b  allow target=dom0",
+    )
+    kept, dropped = qrexec.optimize(rules)
+    assert dropped == []
+    # The hot read moves up past the disjoint rare rule, but the last rule
+    # can't pass the wildcard deny: a qube tagged both b and c hits both.
+    assert kept.index(rules[1]) < kept.index(rules[0])
+    assert kept.index(rules[2]) < kept.index(rules[3])
+    assert qrexec.find_differences(rules, kept) == []
+
+
+def test_checker_finds_a_bad_reordering():
+    rules = _policy(
+        "admin.vm.Start  *  @tag:a  @tag:frozen  deny",
+        "admin.vm.Start  *  @tag:a  @tag:b  allow target=dom0",
+    )
+    differences = qrexec.find_differences(rules, rules[::-1])
+    assert differences
+    service, _arg, _source, target, before, after = differences[0]
+    assert service == "admin.vm.Start"
+    assert target.tags == {"frozen", "b"}
+    assert (before, after) == ("deny", "allow target=dom0")
+
+
+def test_rendered_policy_optimizes_equivalently():
+    text = policy.render_policy(admin_qubes=["fleet", "fleet2"])
+    rules = qrexec.parse_policy(text)
+    kept, dropped = qrexec.optimize(rules)
+    # The per-admin qube sections repeat admin-wide grants.
+    assert dropped
+    assert qrexec.find_differences(rules, kept) == []
+    optimized = qrexec.format_optimized(text, kept, dropped)
+    assert len(optimized.splitlines()) < len(text.splitlines())
+    assert [r.line for r in qrexec.parse_policy(optimized)] == [r.line for r in kept]
+
+
+def test_cli_optimize(capsys):
+    with pytest.raises(SystemExit) as e:
+        cli.main(["policy", "--admin-qube", "fleet", "--admin-qube", "fleet2", "--optimize"])
+    assert e.value.code == 0
+    out = capsys.readouterr().out
+    assert "Optimized by `hexagon policy --optimize`" in out
+    full = qrexec.parse_policy(policy.render_policy(admin_qubes=["fleet", "fleet2"]))
+    assert qrexec.find_differences(full, qrexec.parse_policy(out)) == []
+
+
+def test_cli_optimize_refuses_a_changed_policy(monkeypatch, capsys):
+    monkeypatch.setattr(qrexec, "optimize", lambda rules: (rules[1:], []))
+    with pytest.raises(SystemExit) as e:
+        cli.main(["policy", "--admin-qube", "fleet", "--optimize"])
+    assert e.value.code == 1
+    assert capsys.readouterr().out == ""
+
+
+TEST_POLICY = os.path.join(
+    os.path.dirname(__file__), os.pardir, "qubes", "policy.d", "30-hexagon-test.policy"
+)
+
+# Mean rules dom0 scans per call, per subcommand, for the default rendered
+# policy; ~1.5x today's figures, so a template change that makes lookups
+# markedly costlier fails here.
+SCAN_BUDGET = {"ls": 6, "start": 9, "shutdown": 9, "reboot": 10, "reconcile": 12}
+
+
+def test_evaluator_counts_rules_scanned():
+    rules = _policy(
+        "admin.vm.List   *  @tag:hexagon-admin  @adminvm      allow target=dom0",
+        "admin.vm.Start  *  @tag:hexagon-admin  @tag:hexagon  allow target=dom0",
+    )
+    evaluator = qrexec.PolicyEvaluator(rules, tags={"mgmt": ["hexagon-admin"], "work": ["hexagon"]})
+    assert evaluator.allowed("admin.vm.List", None, "mgmt", "dom0")
+    assert evaluator.query("admin.vm.Start", None, "mgmt", "work") == "allow target=dom0"
+    assert not evaluator.allowed("admin.vm.Start", None, "mgmt", "other")
+    assert (evaluator.lookups, evaluator.scanned, evaluator.max_scanned) == (3, 5, 2)
+
+
+def test_test_policy_grants_every_call_hexagon_makes():
+    rules = qrexec.load_policy(TEST_POLICY, mgmt_qube="mgmt")
+    vms = ["test-a", "test-b"]
+    evaluator = qrexec.PolicyEvaluator(rules, tags={vm: ["hexagon-test"] for vm in vms})
+    for command in qrexec.CALL_MIX:
+        assert qrexec.replay(evaluator, command, "mgmt", vms) == {}, command
+    # Untagged VMs stay out of reach of anything but reads.
+    assert not evaluator.allowed("admin.vm.Start", None, "mgmt", "personal")
+
+
+# A command line per CALL_MIX entry, run against a fake fleet below.
+COMMANDS = {
+    "ls": ["ls", "--tags", "work"],
+    "start": ["start", "vm-0001"],
+    "start --wait-ready": ["start", "--wait-ready", "vm-0001"],
+    "shutdown": ["shutdown", "vm-0000"],
+    "reboot": ["reboot", "vm-0000"],
+    "reboot --outdated": ["reboot", "--outdated"],
+    "reconcile": ["reconcile", "--property", "memory=800", "vm-0000"],
+}
+
+
+def test_rendered_policy_grants_every_call_hexagon_makes():
+    rules = qrexec.parse_policy(policy.render_policy(admin_qubes=["mgmt"]))
+    vms, tags = qrexec._fleet(3, policy.DEFAULT_TARGET_TAG, (policy.DEFAULT_ADMIN_TAG,), "mgmt")
+    evaluator = qrexec.PolicyEvaluator(rules, tags)
+    for command in qrexec.CALL_MIX:
+        assert qrexec.replay(evaluator, command, "mgmt", vms) == {}, command
+
+
+@pytest.mark.parametrize("command", sorted(COMMANDS))
+def test_call_mix_lists_every_call_a_command_makes(command, capsys):
+    # Every Admin API call the fake fleet sees is in the command's CALL_MIX
+    # (so the replays above cover it), and the rendered policy allows it.
+    # admin.Events and qrexec services into the guest don't go through
+    # qubesd_call; CALL_MIX lists them by hand.
+    app = build_fleet(4)
+    try:
+        cli.main(["--no-cache"] + COMMANDS[command], session=Session(app=app, events=app.events))
+    except SystemExit as e:
+        assert e.code == 0
+    per_run, per_vm = qrexec.CALL_MIX[command]
+    listed = {service for service, _arg, _target in per_run + per_vm}
+    tags = {name: [policy.DEFAULT_TARGET_TAG] for name in app.vms}
+    tags["mgmt"] = [policy.DEFAULT_ADMIN_TAG]
+    evaluator = qrexec.PolicyEvaluator(
+        qrexec.parse_policy(policy.render_policy(admin_qubes=["mgmt"])), tags
+    )
+    assert app.calls
+    for dest, method, arg in app.calls:
+        assert method in listed, (command, method)
+        assert evaluator.allowed(method, arg, "mgmt", dest), (command, method, arg, dest)
+
+
+def test_rendered_policy_lookup_cost_within_budget():
+    vms, tags = qrexec._fleet(50, policy.DEFAULT_TARGET_TAG, (policy.DEFAULT_ADMIN_TAG,), "mgmt")
+    rules = qrexec.parse_policy(policy.render_policy(admin_qubes=["mgmt"]))
+    optimized, _dropped = qrexec.optimize(rules)
+    plain = qrexec.benchmark(rules, tags, "mgmt", vms, repeat=1)
+    fast = qrexec.benchmark(optimized, tags, "mgmt", vms, repeat=1)
+    for command, budget in SCAN_BUDGET.items():
+        assert plain[command][1] <= budget, command
+        assert fast[command][1] <= plain[command][1], command
+
+
+def test_benchmark_main(capsys):
+    qrexec.main(["--vms", "3", TEST_POLICY])
+    out = capsys.readouterr().out
+    assert "hexagon policy --optimize" in out
+    assert "30-hexagon-test.policy" in out
+    for command in qrexec.CALL_MIX:
+        assert "\n  {} ".format(command) in out
@@ -0,0 +1,160 @@
+"""Unit tests for the qubesd stand-in (tests/qubesd.py), over a real socket."""
+
+import queue
+import socket
+import time
+
+import pytest
+
+from hexagon import cli
+from hexagon.session import SOCKET_ENV, Session
+
+from .fakequbes import build_fleet
+from .qubesd import QubesdServer, parse_request
+
+pytestmark = pytest.mark.unit
+
+
+def _request(path, method, dest="dom0", arg=None, payload=b""):
+    # What qubesadmin's QubesLocal sends: one connection per call.
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall("{}+{} dom0 name {}\0".format(method, arg or "", dest).encode() + payload)
+        s.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
+
+
+class _SocketApp(object):
+    """Just enough of a qubesadmin app for cli.main, over the socket."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def qubesd_call(self, dest, method, arg=None, payload=None):
+        data = _request(self.path, method, dest, arg, payload or b"")
+        if data.startswith(b"2\0"):
+            _code, exc_type, _tb, message, _args = data.split(b"\0", 4)
+            raise RuntimeError("{}: {}".format(exc_type.decode(), message.decode()))
+        assert data.startswith(b"0\0")
+        return data[2:]
+
+
+@pytest.fixture
+def server(tmp_path):
+    with QubesdServer(build_fleet(8), str(tmp_path / "qubesd.sock")) as server:
+        yield server
+
+
+def test_parse_request():
+    assert parse_request(b"admin.vm.property.Get+netvm dom0 name work\0") == (
+        "admin.vm.property.Get",
+        "netvm",
+        "work",
+        None,
+    )
+    assert parse_request(b"admin.vm.List+ dom0 keyword adminvm\0")[2] == "dom0"
+    with pytest.raises(ValueError):
+        parse_request(b"admin.vm.List+ dom0 name dom0")
+    # The NUL-separated form: source, method, dest, arg.
+    assert parse_request(b"dom0\0admin.Events\0work\0\0") == ("admin.Events", None, "work", None)
+    assert parse_request(b"dom0\0admin.vm.property.Get\0work\0netvm\0") == (
+        "admin.vm.property.Get",
+        "netvm",
+        "work",
+        None,
+    )
+    with pytest.raises(ValueError):
+        parse_request(b"dom0\0admin.Events\0work\0")
+
+
+def test_answers_calls_in_the_wire_format(server):
+    listing = _request(server.path, "admin.vm.List")
+    assert listing.startswith(b"0\0")
+    assert b"vm-0000 class=AppVM state=Running\n" in listing
+    assert _request(server.path, "admin.vm.property.Get", "vm-0001", "label") == (
+        b"0\0default=False type=label red"
+    )
+    assert server.model.count("admin.vm.property.Get") == 1
+
+
+def test_refusals_are_error_frames(server):
+    data = _request(server.path, "admin.vm.property.Get", "nope", "label")
+    assert data.split(b"\0")[:2] == [b"2", b"QubesVMNotFoundError"]
+    data = _request(server.path, "admin.vm.feature.Get", "vm-0001", "nope")
+    assert data.split(b"\0")[:2] == [b"2", b"QubesFeatureNotFoundError"]
+
+
+def _wait_for_subscriber(server):
+    # The subscription lands once the server has read the request.
+    deadline = time.monotonic() + 5
+    while not server.model.events.callbacks and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize(
+    "header",
+    [b"admin.Events+ dom0 name dom0\0", b"dom0\0admin.Events\0dom0\0\0"],
+    ids=["qrexec", "nul"],
+)
+@pytest.mark.parametrize("shutdown", [False, True], ids=["open", "eof"])
+def test_streams_events(server, header, shutdown):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as events:
+        events.connect(server.path)
+        events.sendall(header)
+        if shutdown:
+            events.shutdown(socket.SHUT_WR)
+        events.settimeout(5)
+        _wait_for_subscriber(server)
+        assert _request(server.path, "admin.vm.Start", "vm-0001") == b"0\0"
+        data = b""
+        while not data.endswith(b"\0\0"):
+            data += events.recv(65536)
+    assert data == b"1\0vm-0001\0domain-start\0\0"
+
+
+def test_cli_runs_against_the_socket(server, capsys):
+    with pytest.raises(SystemExit) as e:
+        cli.main(
+            ["--no-cache", "ls", "--tags", "work,hexagon"],
+            session=Session(app=_SocketApp(server.path)),
+        )
+    assert e.value.code == 0
+    assert capsys.readouterr().out.split() == ["vm-0000", "vm-0006"]
+    assert server.model.count("admin.vm.List") == 1
+
+
+def test_real_client_against_the_socket(server, monkeypatch):
+    qubesadmin = pytest.importorskip("qubesadmin.app", reason="qubesadmin not installed")
+    monkeypatch.setenv(SOCKET_ENV, server.path)
+    from hexagon.session import _new_app
+
+    app = _new_app()
+    assert isinstance(app, qubesadmin.QubesLocal)
+    assert "vm-0001" in app.domains
+    assert app.domains["vm-0001"].label.name == "red"
+
+
+def test_real_client_events_against_the_socket(server, monkeypatch):
+    pytest.importorskip("qubesadmin.events", reason="qubesadmin not installed")
+    monkeypatch.setenv(SOCKET_ENV, server.path)
+    from hexagon.events import QubesEventSource
+    from hexagon.session import _new_app
+
+    received = queue.Queue()
+    QubesEventSource(_new_app()).subscribe(lambda name, event: received.put((name, event)))
+    _wait_for_subscriber(server)
+    assert server.model.events.callbacks, "EventsDispatcher never subscribed"
+    assert _request(server.path, "admin.vm.Start", "vm-0001") == b"0\0"
+    seen = []
+    deadline = time.monotonic() + 5
+    while ("vm-0001", "domain-start") not in seen and time.monotonic() < deadline:
+        try:
+            seen.append(received.get(timeout=0.1))
+        except queue.Empty:
+            pass
+    assert ("vm-0001", "domain-start") in seen
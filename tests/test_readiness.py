@@ -0,0 +1,103 @@
+"""Unit tests for ``--wait-ready`` (readiness.py)."""
+
+import threading
+import time
+
+import pytest
+
+from hexagon import cli
+from hexagon.qmgr import HexagonQube
+from hexagon.readiness import NotReady, Readiness
+from hexagon.session import Session
+
+from .fakequbes import FakeEventSource, build_fleet
+
+pytestmark = pytest.mark.unit
+
+
+@pytest.fixture
+def fleet():
+    return build_fleet(6)
+
+
+def _qube(fleet, name, events=True):
+    session = Session(app=fleet, events=fleet.events if events else None)
+    return HexagonQube(name, session=session)
+
+
+def _start(readiness, qube):
+    waiter = readiness.expect(qube)
+    requested = time.monotonic()
+    qube.vm.start()
+    readiness.wait(qube, waiter, requested, time.monotonic())
+
+
+def test_waits_for_the_start_event_then_the_session(fleet):
+    fleet.session_delay = 0.05
+    readiness = Readiness(timeout=5)
+    _start(readiness, _qube(fleet, "vm-0001"))
+    started, agent, ready = readiness.latencies["vm-0001"]
+    assert started <= agent < ready
+    assert ready >= 0.05
+
+
+def test_a_start_that_never_reports_times_out(fleet):
+    # A separate event source: qubesd's domain-start never reaches it.
+    qube = HexagonQube("vm-0001", session=Session(app=fleet, events=FakeEventSource()))
+    readiness = Readiness(timeout=0.1)
+    with pytest.raises(NotReady, match="no qrexec agent"):
+        _start(readiness, qube)
+    assert readiness.latencies == {}
+
+
+def test_a_failed_start_event_fails_fast(fleet):
+    qube = _qube(fleet, "vm-0001")
+    readiness = Readiness(timeout=30)
+    waiter = readiness.expect(qube)
+    threading.Timer(0.01, fleet.events.emit, ("vm-0001", "domain-start-failed")).start()
+    start = time.monotonic()
+    with pytest.raises(NotReady, match="domain-start-failed"):
+        readiness.wait(qube, waiter, start, start)
+    assert time.monotonic() - start < 5
+
+
+def test_session_timeout_and_no_event_fallback(fleet):
+    fleet.session_delay = 10
+    with pytest.raises(NotReady, match="no user session"):
+        _start(Readiness(timeout=0.1), _qube(fleet, "vm-0001", events=False))
+    # Halted VMs never get a session.
+    qube = _qube(fleet, "vm-0003", events=False)
+    with pytest.raises(NotReady, match="not running"):
+        Readiness().wait(qube, None, 0, 0)
+
+
+def test_report_lists_slowest_first():
+    readiness = Readiness()
+    readiness.latencies = {"a": (1.0, 1.0, 3.0), "b": (2.0, 2.5, 9.0), "c": (1.0, 1.2, 4.0)}
+    lines = readiness.format().splitlines()
+    assert [line.split()[0] for line in lines[1:4]] == ["b", "c", "a"]
+    assert lines[1].split() == ["b", "2.0s", "2.5s", "9.0s"]
+    assert lines[-1] == "ready: 3 VMs, p50 4.0s, p90 4.0s, max 9.0s"
+    assert Readiness().format() == ""
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+@pytest.mark.parametrize("command", ["start", "reboot"])
+def test_cli_wait_ready(engine, command, fleet, capsys):
+    fleet.session_delay = 0.02
+    targets = ["vm-0001", "vm-0003", "vm-0005"]
+    if command == "reboot":
+        for name in targets:
+            fleet.vms[name].power_state = "Running"
+    session = Session(app=fleet, events=fleet.events)
+    cli.main(["--no-cache", "--engine", engine, command, "--wait-ready"] + targets, session=session)
+    err = capsys.readouterr().err
+    assert "ready: 3 VMs" in err
+    assert {line.split()[0] for line in err.splitlines()[-4:-1]} == set(targets)
+
+
+def test_cli_wait_ready_passes_readiness_to_the_start_path(fleet, fake_power):
+    fleet.vms["vm-0001"].power_state = "Running"
+    session = Session(app=fleet, events=fleet.events)
+    cli.main(["--no-cache", "reboot", "--wait-ready", "vm-0001"], session=session)
+    assert fake_power == [("halt", "vm-0001"), ("start", "vm-0001")]
@@ -1,13 +1,15 @@
 """Integration tests for reboot behavior against the live Qubes Admin API.
 
-These start real VMs, so they're slower than the rest of the suite.
+These start real VMs, so they're slower than the rest of the suite, and
+they're marked ``live``: the qubesd stand-in can't boot a guest or run
+``poweroff`` inside one.
 """
 
 import pytest
 
 from .base import vm_name
 
-pytestmark = pytest.mark.integration
+pytestmark = [pytest.mark.integration, pytest.mark.live]
 
 
 def test_reboot_resets_uptime(make_test_vm):
@@ -0,0 +1,209 @@
+"""Unit tests for the netvm-aware wave scheduler."""
+
+import threading
+import time
+
+import pytest
+
+from hexagon import cli
+from hexagon.qmgr import DEFAULT_TEMPLATE
+from hexagon.scheduler import NetvmClients, WaveScheduler, netvm_graph
+from hexagon.session import Session
+from hexagon.snapshot import FleetSnapshot
+
+from .fakequbes import FakeQubes, build_fleet
+
+pytestmark = pytest.mark.unit
+
+# sys-net <- sys-firewall <- {work, personal}; vault has no targeted netvm.
+GRAPH = {
+    "sys-net": None,
+    "sys-firewall": "sys-net",
+    "work": "sys-firewall",
+    "personal": "sys-firewall",
+    "vault": None,
+}
+
+
+def test_start_waves_put_netvms_first():
+    waves = WaveScheduler(GRAPH).start_waves()
+    assert [sorted(w) for w in waves] == [
+        ["sys-net", "vault"],
+        ["sys-firewall"],
+        ["personal", "work"],
+    ]
+
+
+def test_shutdown_waves_put_clients_first():
+    waves = WaveScheduler(GRAPH).shutdown_waves()
+    assert sorted(waves[0]) == ["personal", "work"]
+    assert waves[-1] == ["sys-net", "vault"]
+
+
+def test_untargeted_netvm_adds_no_wave():
+    assert WaveScheduler({"work": None}).start_waves() == [["work"]]
+
+
+def test_run_respects_wave_order_and_concurrency_cap():
+    order = []
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def op(name):
+        with lock:
+            running.append(name)
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.remove(name)
+            order.append(name)
+
+    scheduler = WaveScheduler(GRAPH, max_concurrency=1)
+    results = scheduler.run(scheduler.start_waves(), op)
+    assert max(peak) == 1
+    assert order.index("sys-net") < order.index("sys-firewall") < order.index("work")
+    assert all(e is None for _name, e in results)
+
+
+def test_run_reports_failures_and_honors_skip():
+    def op(name):
+        if name == "sys-net":
+            raise RuntimeError("boom")
+
+    scheduler = WaveScheduler(GRAPH)
+    results = dict(scheduler.run(scheduler.start_waves(), op, skip={"vault"}))
+    assert isinstance(results["sys-net"], RuntimeError)
+    assert "vault" not in results
+
+
+def test_netvm_graph_from_snapshot(fake_qubes):
+    class FakeVM:
+        def __init__(self, name, netvm):
+            self.name = name
+            self.klass = "AppVM"
+            self.tags = set()
+            self.netvm = netvm
+
+    for name, netvm in (("sys-net", None), ("sys-firewall", "sys-net"), ("work", "sys-firewall")):
+        fake_qubes.domains[name] = FakeVM(name, netvm)
+    snapshot = FleetSnapshot.fetch(Session(app=fake_qubes), properties=False, tags=False)
+    assert netvm_graph(snapshot, ["sys-firewall", "work"]) == {
+        "sys-firewall": None,
+        "work": "sys-firewall",
+    }
+
+
+def test_reboot_dry_run_logs_halt_and_start_waves(fake_qubes, monkeypatch, caplog):
+    caplog.set_level("DEBUG")
+
+    class FakeVM:
+        def __init__(self, name, netvm):
+            self.name = name
+            self.klass = "AppVM"
+            self.tags = set()
+            self.netvm = netvm
+
+    fake_qubes.domains["sys-firewall"] = FakeVM("sys-firewall", None)
+    fake_qubes.domains["work"] = FakeVM("work", "sys-firewall")
+    monkeypatch.setattr(cli.sys, "argv", ["hexagon", "--dry-run", "reboot", "work", "sys-firewall"])
+
+    with pytest.raises(SystemExit) as excinfo:
+        cli.main()
+
+    assert excinfo.value.code == 0
+    assert "Would shutdown in 2 waves: [['work'], ['sys-firewall']]" in caplog.text
+    assert "Would start in 2 waves: [['sys-firewall'], ['work']]" in caplog.text
+
+
+def test_rolling_waves_batch_each_start_wave():
+    waves = WaveScheduler(GRAPH).rolling_waves(2)
+    # A netvm never shares a batch with its clients.
+    assert waves == [["sys-net", "vault"], ["sys-firewall"], ["work", "personal"]]
+    assert WaveScheduler(GRAPH).rolling_waves(1)[:2] == [["sys-net"], ["vault"]]
+
+
+def test_run_pauses_between_waves_only():
+    ran = []
+    scheduler = WaveScheduler(GRAPH, pause=0.05)
+    start = time.monotonic()
+    scheduler.run([["a"], [], ["b"], ["c"]], lambda name: ran.append(time.monotonic() - start))
+    assert ran[0] < 0.05
+    assert ran[1] >= 0.05 and ran[2] >= 0.1
+
+
+@pytest.mark.parametrize("engine", ["threads", "asyncio"])
+def test_rolling_reboot_takes_a_batch_down_at_a_time(engine, monkeypatch):
+    app = build_fleet(6, latency=0.002)
+    down = set()
+    peak = []
+    lock = threading.Lock()
+    real_halt, real_start = FakeQubes._admin_vm_Shutdown, FakeQubes._admin_vm_Start
+
+    def halt(self, vm, arg, payload):
+        with lock:
+            down.add(vm.name)
+            peak.append(len(down))
+        return real_halt(self, vm, arg, payload)
+
+    def start(self, vm, arg, payload):
+        with lock:
+            down.discard(vm.name)
+        return real_start(self, vm, arg, payload)
+
+    monkeypatch.setattr(FakeQubes, "_admin_vm_Shutdown", halt)
+    monkeypatch.setattr(FakeQubes, "_admin_vm_Start", start)
+    monkeypatch.setattr(FakeQubes, "_admin_vm_Kill", halt)
+    # qubesd starts a halted netvm for its client (see FakeQubes). If sys-net
+    # shared a batch with sys-firewall, a slow start of its own would find it
+    # already running.
+    real_call = FakeQubes.qubesd_call
+
+    def qubesd_call(self, dest, method, *args, **kwargs):
+        if (dest, method) == ("sys-net", "admin.vm.Start"):
+            time.sleep(0.05)
+        return real_call(self, dest, method, *args, **kwargs)
+
+    monkeypatch.setattr(FakeQubes, "qubesd_call", qubesd_call)
+    targets = ["sys-net", "sys-firewall", "vm-0000", "vm-0002", "vm-0004"]
+    argv = ["--no-cache", "--engine", engine, "reboot", "--batch-size", "2"]
+    cli.main(argv + targets, session=Session(app=app, events=app.events))
+    assert len(peak) == len(targets) and max(peak) <= 2
+    assert all(app.vms[n].power_state == "Running" for n in targets)
+
+
+def test_rolling_reboot_dry_run_and_validation(fake_qubes, caplog):
+    caplog.set_level("DEBUG")
+    fake_qubes.domains["work"] = type(fake_qubes.domains[DEFAULT_TEMPLATE])("work")
+    with pytest.raises(SystemExit) as excinfo:
+        cli.main(["--dry-run", "--no-cache", "reboot", "--max-unavailable", "1", "work"])
+    assert excinfo.value.code == 0
+    assert "Would reboot in 1 waves: [['work']]" in caplog.text
+    with pytest.raises(SystemExit) as excinfo:
+        cli.parse_args(["reboot", "--pause", "5", "work"])
+    assert excinfo.value.code == 2
+    with pytest.raises(SystemExit):
+        cli.parse_args(["reboot", "--batch-size", "0", "work"])
+
+
+def test_netvm_clients_reads_the_fleet_once():
+    app = build_fleet(6)
+    session = Session(app=app)
+    clients = NetvmClients(FleetSnapshot.fetch(session, properties=False, tags=False))
+    app.reset_calls()
+    assert clients.get("sys-firewall") == ["vm-0000", "vm-0002", "vm-0004"]
+    assert clients.get("sys-net") == ["sys-firewall"]
+    assert clients.get("vm-0000") == []
+    # One property read per running domain, however many halts ask.
+    assert app.count() == app.count("admin.vm.property.GetAll") == 5
+
+
+def test_cli_shutdown_reads_no_netvm_per_halt():
+    app = build_fleet(40)
+    cli.main(
+        ["--no-cache", "shutdown", "--tags", "work"], session=Session(app=app, events=app.events)
+    )
+    assert app.count("admin.vm.Shutdown") == 7
+    # Each running domain's netvm is read once, in one GetAll, not per halt.
+    assert app.count("admin.vm.property.Get") == 0
+    assert app.count("admin.vm.property.GetAll") <= len(app.vms)
@@ -0,0 +1,136 @@
+"""Unit tests for the shared Admin API session. No Qubes required."""
+
+import concurrent.futures
+import queue
+import sys
+import types
+
+import pytest
+
+from hexagon import cli
+from hexagon import qmgr
+from hexagon import session as session_mod
+from hexagon.session import Session
+
+pytestmark = pytest.mark.unit
+
+
+class CountingDomains(dict):
+    """Domain collection that counts refreshes, like qubesadmin's VMCollection
+    re-running admin.vm.List after ``clear_cache()``."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cleared = 0
+
+    def __iter__(self):
+        return iter(self.values())
+
+    def clear_cache(self):
+        self.cleared += 1
+
+
+class FakeVM:
+    def __init__(self, name):
+        self.name = name
+        self.tags = set()
+
+
+def test_session_creates_app_lazily_and_once(fake_qubes, monkeypatch):
+    built = []
+    monkeypatch.setattr("qubesadmin.Qubes", lambda: built.append(1) or fake_qubes)
+    session = Session()
+    assert built == []
+    session.app
+    session.app
+    assert built == [1]
+
+
+def test_hexagonqube_uses_injected_session(fake_qubes):
+    fake_qubes.domains["work"] = FakeVM("work")
+    session = Session(app=fake_qubes)
+    vm = qmgr.HexagonQube("work", session=session)
+    assert vm.session is session
+    assert vm.vm is fake_qubes.domains["work"]
+
+
+def test_invalidate_clears_domain_cache_and_bumps_generation():
+    app = type("App", (), {})()
+    app.domains = CountingDomains()
+    session = Session(app=app)
+    session.invalidate()
+    assert app.domains.cleared == 1
+    assert session.generation == 1
+
+
+def test_followed_listing_is_cached_until_a_lifecycle_event(fake_qubes, fake_events):
+    session = Session(app=fake_qubes, events=fake_events)
+    session.listing()
+    session.listing()
+    assert len(fake_qubes.calls) == 2  # not following: always fresh
+
+    assert session.follow() is fake_events
+    session.listing()
+    session.listing()
+    assert len(fake_qubes.calls) == 3
+
+    fake_events.emit("work", "domain-feature-set:foo")
+    session.listing()
+    assert len(fake_qubes.calls) == 3
+    fake_events.emit("work", "domain-start")
+    session.listing()
+    assert len(fake_qubes.calls) == 4
+
+
+def test_session_shared_across_threads(fake_qubes):
+    session = Session(app=fake_qubes)
+    for n in range(20):
+        fake_qubes.domains["vm-{}".format(n)] = FakeVM("vm-{}".format(n))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        found = list(executor.map(lambda n: "vm-{}".format(n) in session, range(20)))
+    assert all(found)
+
+
+def test_ls_builds_a_single_app(fake_qubes, monkeypatch, capsys):
+    built = []
+    monkeypatch.setattr("qubesadmin.Qubes", lambda *a, **k: built.append(1) or fake_qubes)
+    for n in range(5):
+        fake_qubes.domains["vm-{}".format(n)] = FakeVM("vm-{}".format(n))
+    fake_qubes.domains = CountingDomains(fake_qubes.domains)
+    monkeypatch.setattr(cli.sys, "argv", ["hexagon", "ls"])
+
+    with pytest.raises(SystemExit):
+        cli.main()
+
+    assert built == [1]
+    assert "vm-4" in capsys.readouterr().out
+
+
+def test_event_dispatcher_gets_an_app_of_its_own(fake_qubes, monkeypatch):
+    dispatched = queue.Queue()
+
+    class EventsDispatcher(object):
+        def __init__(self, app):
+            self.app = app
+            self.handlers = []
+
+        def add_handler(self, event, handler):
+            self.handlers.append(handler)
+
+        async def listen_for_events(self):
+            dispatched.put(self.app)
+            for handler in self.handlers:
+                handler("work", "domain-start")
+
+    module = types.ModuleType("qubesadmin.events")
+    module.EventsDispatcher = EventsDispatcher
+    monkeypatch.setitem(sys.modules, "qubesadmin.events", module)
+    monkeypatch.setattr(sys.modules["qubesadmin"], "events", module, raising=False)
+    own_app = object()
+    monkeypatch.setattr(session_mod, "_new_app", lambda: own_app)
+    received = queue.Queue()
+    session = Session(app=fake_qubes)
+    session.follow().subscribe(lambda name, event: received.put((name, event)))
+    # The dispatcher thread never touches the app the workers share.
+    assert dispatched.get(timeout=5) is own_app
+    assert received.get(timeout=5) == ("work", "domain-start")
@@ -0,0 +1,108 @@
+"""Unit tests for the bulk fleet snapshot and the `ls` filters built on it."""
+
+import pytest
+
+from hexagon import cli
+from hexagon import snapshot
+from hexagon.session import Session
+
+pytestmark = pytest.mark.unit
+
+
+class FakeVM:
+    def __init__(self, name, tags=(), features=None, **props):
+        self.name = name
+        self.klass = "AppVM"
+        self.tags = set(tags)
+        self.features = features or {}
+        for k, v in props.items():
+            setattr(self, k, v)
+
+
+@pytest.fixture
+def fleet(fake_qubes):
+    for vm in (
+        FakeVM("work", tags={"foo"}, template="fedora-43", vcpus=2, netvm="sys-firewall"),
+        FakeVM("vault", tags={"foo"}, template="debian-13", vcpus=2, netvm=None),
+        FakeVM("dev", features={"updates-available": "1"}, template="fedora-43", vcpus=4),
+    ):
+        fake_qubes.domains[vm.name] = vm
+    return fake_qubes
+
+
+def test_parse_vm_list():
+    data = b"dom0 class=AdminVM state=Running\nwork class=AppVM state=Halted\n"
+    assert snapshot.parse_vm_list(data) == {
+        "dom0": ("AdminVM", "Running"),
+        "work": ("AppVM", "Halted"),
+    }
+
+
+def test_parse_property_get_all_unescapes_and_normalizes_unset_vm():
+    data = (
+        b"netvm default=True type=vm \n"
+        b"vcpus default=False type=int 2\n"
+        b"kernelopts default=False type=str a\\nb \\\\c\n"
+    )
+    assert snapshot.parse_property_get_all(data) == {
+        "netvm": "None",
+        "vcpus": "2",
+        "kernelopts": "a\nb \\c",
+    }
+
+
+def test_fetch_builds_records_with_one_call_per_kind(fleet):
+    snap = snapshot.FleetSnapshot.fetch(
+        Session(app=fleet), names=["work", "dev"], features=("updates-available",)
+    )
+    assert snap.names() == ["dev", "work"]
+    assert snap["work"].properties["netvm"] == "sys-firewall"
+    assert snap["work"].tags == {"foo"}
+    assert snap["dev"].features == {"updates-available": "1"}
+    methods = [m for _d, m, _a in fleet.calls]
+    assert methods.count("admin.vm.List") == 1
+    assert methods.count("admin.vm.property.GetAll") == 2
+    assert "admin.vm.property.Get" not in methods
+
+
+def test_fetch_without_get_all_falls_back_to_per_property_reads(fleet):
+    bulk = fleet.qubesd_call
+
+    def no_get_all(dest, method, arg=None, payload=None):
+        if method == "admin.vm.property.GetAll":
+            raise snapshot.QubesException("no such method")
+        if method == "admin.vm.property.List":
+            return b"vcpus\n"
+        if method == "admin.vm.property.Get":
+            return "default=False type=int {}".format(fleet.domains[dest].vcpus).encode()
+        return bulk(dest, method, arg, payload)
+
+    fleet.qubesd_call = no_get_all
+    snap = snapshot.FleetSnapshot.fetch(Session(app=fleet), names=["dev"])
+    assert snap["dev"].properties["vcpus"] == "4"
+
+
+def _ls(monkeypatch, capsys, *argv):
+    monkeypatch.setattr(cli.sys, "argv", ["hexagon", "ls", *argv])
+    with pytest.raises(SystemExit) as excinfo:
+        cli.main()
+    assert excinfo.value.code == 0
+    return capsys.readouterr().out.split()
+
+
+def test_ls_property_filters_run_against_snapshot(fleet, monkeypatch, capsys):
+    argv = ("--template", "fedora-43", "--property", "vcpus=2", "--property", "netvm=!None")
+    assert _ls(monkeypatch, capsys, *argv) == ["work"]
+    # Three filters, still exactly one GetAll per VM.
+    get_alls = [d for d, m, _a in fleet.calls if m == "admin.vm.property.GetAll"]
+    assert sorted(get_alls) == sorted(fleet.domains)
+
+
+def test_ls_updatable_and_tags(fleet, monkeypatch, capsys):
+    assert _ls(monkeypatch, capsys, "--updatable") == ["dev"]
+    assert _ls(monkeypatch, capsys, "--tags", "foo") == ["vault", "work"]
+
+
+def test_ls_without_filters_is_a_single_list_call(fleet, monkeypatch, capsys):
+    assert "work" in _ls(monkeypatch, capsys)
+    assert [m for _d, m, _a in fleet.calls] == ["admin.vm.List"]
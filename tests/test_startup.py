@@ -0,0 +1,93 @@
+"""Import-time benchmark for the CLI: guards startup cost against regressions.
+
+Each check runs in a fresh interpreter, since this process has long since
+imported everything. ``-X importtime`` reports what ``import hexagon.cli``
+pulls in and what it costs; the module list is the real guard, the time
+budget a backstop generous enough for a loaded CI machine.
+"""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytestmark = pytest.mark.unit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only needed once a command actually talks to the Admin API (or reads YAML,
+# or asks for --version); see the comment at the top of hexagon/cli.py.
+DEFERRED = (
+    "qubesadmin",
+    "yaml",
+    "jinja2",
+    "importlib.metadata",
+    "concurrent.futures",
+    "asyncio",
+    "hexagon.cache",
+    "hexagon.snapshot",
+    "hexagon.scheduler",
+    "hexagon.admission",
+    "hexagon.aio",
+    "hexagon.qrexec",
+    "hexagon.plan",
+    "hexagon.fleet",
+    "hexagon.outdated",
+    "hexagon.tags",
+    "hexagon.profiler",
+    "hexagon.progress",
+    "hexagon.history",
+    "hexagon.readiness",
+)
+
+# Cumulative microseconds for `import hexagon.cli`; ~25ms on a laptop.
+IMPORT_BUDGET_US = 150000
+
+
+def _python(*args):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    return subprocess.run(
+        [sys.executable, *args], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+
+
+def _import_times(module):
+    """``{module: cumulative us}`` from ``-X importtime``."""
+    times = {}
+    for line in _python("-X", "importtime", "-c", "import " + module).stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _self, cumulative, name = line[len("import time:") :].split("|")
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def test_cli_import_defers_heavy_modules():
+    imported = _import_times("hexagon.cli")
+    assert "hexagon.cli" in imported
+    assert [m for m in DEFERRED if m in imported] == []
+
+
+def test_cli_import_time_budget():
+    # Best of three, to ride out a noisy neighbour.
+    best = min(_import_times("hexagon.cli")["hexagon.cli"] for _ in range(3))
+    assert best < IMPORT_BUDGET_US
+
+
+def test_version_and_help_stay_off_the_admin_api():
+    code = (
+        "import sys\n"
+        "from hexagon import cli\n"
+        "for argv in (['--version'], ['--help'], ['policy', '--help']):\n"
+        "    try:\n"
+        "        cli.main(argv)\n"
+        "    except SystemExit:\n"
+        "        pass\n"
+        "print(sorted(m for m in ('qubesadmin', 'yaml') if m in sys.modules))\n"
+    )
+    out = _python("-c", code).stdout
+    prog, version = out.splitlines()[0].split(" ")
+    assert version != "0.0.0+unknown"
+    assert out.rstrip().endswith("[]")
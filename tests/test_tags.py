@@ -0,0 +1,89 @@
+"""Unit tests for --tags expressions and the inverted tag index."""
+
+import pytest
+
+from hexagon import cli
+from hexagon.session import Session
+from hexagon.snapshot import FleetSnapshot, VMRecord
+from hexagon.tags import TagExpression, TagIndex, select
+
+pytestmark = pytest.mark.unit
+
+FLEET = {
+    "work": {"hexagon", "work"},
+    "dev": {"hexagon", "dev"},
+    "personal": {"work"},
+    "sys-net": {"hexagon", "sys-net"},
+    "sys-firewall": {"hexagon", "sys-firewall"},
+    "vault": set(),
+}
+
+
+@pytest.fixture
+def index():
+    return TagIndex(VMRecord(name, tags=tags) for name, tags in FLEET.items())
+
+
+@pytest.mark.parametrize(
+    "expression, selected",
+    [
+        ("hexagon", {"work", "dev", "sys-net", "sys-firewall"}),
+        ("hexagon,!sys-*", {"work", "dev"}),
+        ("hexagon & !sys-*", {"work", "dev"}),
+        ("(work|dev)&hexagon", {"work", "dev"}),
+        ("work|dev&hexagon", {"work", "dev", "personal"}),
+        ("!hexagon", {"personal", "vault"}),
+        ("!!hexagon,work", {"work"}),
+        ("sys-?et", {"sys-net"}),
+        ("nope", set()),
+    ],
+)
+def test_index_and_per_vm_evaluation_agree(index, expression, selected):
+    assert index.select(expression) == selected
+    parsed = TagExpression(expression)
+    assert {name for name, tags in FLEET.items() if parsed.matches(tags)} == selected
+
+
+@pytest.mark.parametrize("expression", ["", "a,", "(a|b", "a)", "a b", "!", "a;b", "|a"])
+def test_malformed_expressions_are_rejected(expression):
+    with pytest.raises(ValueError):
+        TagExpression(expression)
+
+
+def test_select_loads_tags_once_for_candidates_only(fake_qubes):
+    class FakeVM:
+        def __init__(self, name, tags):
+            self.name = name
+            self.klass = "AppVM"
+            self.tags = tags
+
+    for name, tags in FLEET.items():
+        fake_qubes.domains[name] = FakeVM(name, tags)
+    snapshot = FleetSnapshot.fetch(Session(app=fake_qubes), properties=False, tags=False)
+    fake_qubes.calls.clear()
+
+    assert select(snapshot, "hexagon,!sys-*", names=["work", "personal", "sys-net"]) == ["work"]
+    assert sorted(dest for dest, _method, _arg in fake_qubes.calls) == [
+        "personal",
+        "sys-net",
+        "work",
+    ]
+
+
+def test_cli_tags_expression(fake_qubes, capsys):
+    class FakeVM:
+        def __init__(self, name, tags):
+            self.name = name
+            self.klass = "AppVM"
+            self.tags = tags
+
+    for name, tags in FLEET.items():
+        fake_qubes.domains[name] = FakeVM(name, tags)
+    with pytest.raises(SystemExit) as e:
+        cli.main(["--no-cache", "ls", "--tags", "(work|dev)&hexagon"])
+    assert e.value.code == 0
+    assert capsys.readouterr().out.split() == ["dev", "work"]
+
+    with pytest.raises(SystemExit) as e:
+        cli.main(["--no-cache", "shutdown", "--tags", "(work"])
+    assert e.value.code == 1
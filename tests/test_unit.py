@@ -4,12 +4,17 @@ These run in the Nix dev shell and CI. `qubesadmin` is stubbed by
 tests/conftest.py and the `fake_qubes` fixture supplies an in-memory app.
 """
 
+import threading
+import time
 import types
 
 import pytest
 
 from hexagon import qmgr
 from hexagon import cli
+from hexagon.session import Session
+
+from .base import PoweredFakeVM
 
 pytestmark = pytest.mark.unit
 
@@ -240,35 +245,66 @@ def test_no_vms_matching_tag_errors(fake_qubes, monkeypatch):
     assert excinfo.value.code == 1
 
 
-def test_qvm_reboot_main_execs_hexagon_reboot(monkeypatch):
-    # qvm_reboot_main() is a thin wrapper that execs "hexagon reboot <args>".
-    # Verify it dispatches correctly: right binary, right subcommand, passthrough argv.
+def test_qvm_reboot_main_dispatches_hexagon_reboot(monkeypatch):
+    # qvm_reboot_main() is a thin wrapper around "hexagon reboot <args>", run
+    # in-process rather than by exec'ing a second interpreter.
     captured = {}
 
-    def fake_execvp(file, args):
-        captured["file"] = file
-        captured["args"] = args
-
-    monkeypatch.setattr(cli.os, "execvp", fake_execvp)
+    monkeypatch.setattr(cli, "main", lambda argv=None: captured.setdefault("argv", argv))
     monkeypatch.setattr(cli.sys, "argv", ["qvm-reboot", "sys-net", "sys-firewall"])
 
     cli.qvm_reboot_main()
 
-    assert captured["file"] == "hexagon"
-    assert captured["args"] == ["hexagon", "reboot", "sys-net", "sys-firewall"]
+    assert captured["argv"] == ["reboot", "sys-net", "sys-firewall"]
 
 
 def test_qvm_reboot_main_passes_no_args(monkeypatch):
     # With no extra argv, qvm-reboot should still inject "reboot".
     captured = {}
 
-    def fake_execvp(file, args):
-        captured["file"] = file
-        captured["args"] = args
-
-    monkeypatch.setattr(cli.os, "execvp", fake_execvp)
+    monkeypatch.setattr(cli, "main", lambda argv=None: captured.setdefault("argv", argv))
     monkeypatch.setattr(cli.sys, "argv", ["qvm-reboot"])
 
     cli.qvm_reboot_main()
 
-    assert captured["args"] == ["hexagon", "reboot"]
+    assert captured["argv"] == ["reboot"]
+
+
+def _powered_qube(fake_qubes, vm, events=None):
+    fake_qubes.domains[vm.name] = vm
+    return qmgr.HexagonQube(vm.name, session=Session(app=fake_qubes, events=events))
+
+
+def test_ensure_halted_returns_on_shutdown_event(fake_qubes, fake_events):
+    vm = PoweredFakeVM("work", events=fake_events)
+    qube = _powered_qube(fake_qubes, vm, events=fake_events)
+    start = time.monotonic()
+    qube.ensure_halted(poll_interval=5)
+    # Far below the 5s poll interval: the event woke us, not a poll.
+    assert time.monotonic() - start < 2
+    assert vm.state == "Halted"
+    assert not vm.killed
+
+
+def test_ensure_halted_polls_without_events(fake_qubes):
+    vm = PoweredFakeVM("work")
+    qube = _powered_qube(fake_qubes, vm)
+    qube.ensure_halted(poll_interval=0.1)
+    assert vm.state == "Halted"
+    assert not vm.killed
+
+
+def test_ensure_halted_kills_after_timeout(fake_qubes, fake_events):
+    vm = PoweredFakeVM("work", halt_after=None, events=fake_events)
+    qube = _powered_qube(fake_qubes, vm, events=fake_events)
+    qube.ensure_halted(poll_interval=0.05, timeout=0.2)
+    assert vm.killed
+    assert qube.killed
+
+
+def test_ensure_halted_ignores_other_vms_events(fake_qubes, fake_events):
+    vm = PoweredFakeVM("work", halt_after=None, events=fake_events)
+    qube = _powered_qube(fake_qubes, vm, events=fake_events)
+    threading.Timer(0.05, fake_events.emit, ("other", "domain-shutdown")).start()
+    qube.ensure_halted(poll_interval=0.05, timeout=0.3)
+    assert vm.killed